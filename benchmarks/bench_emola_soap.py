@@ -0,0 +1,194 @@
+"""
+Microbenchmark do codec SOAP eMola: versão atual (payments_emola.soap) contra
+a implementação anterior de send_soap_request (reproduzida abaixo sem os
+prints de debug, para medir apenas montagem e parse).
+
+Uso:
+    python benchmarks/bench_emola_soap.py [--number 20000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payments_emola import soap  # noqa: E402
+
+PARAMS = {
+    'partnerCode': 'PARTNER01',
+    'msisdn': '258860000000',
+    'smsContent': 'Pagamento de teste',
+    'transAmount': '100',
+    'transId': '3f2b9c1e-7a4d-4c2b-9f1e-2a7d4c',
+    'language': 'pt',
+    'refNo': 'REF123',
+    'key': 'SECRET_KEY',
+}
+
+INNER_RESPONSE = (
+    '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+    '<ns2:gwOperationResponse xmlns:ns2="http://services.wsfw.vas.viettel.com/"><ns2:return>'
+    '<errorCode>0</errorCode><message>Success</message><orgResponseCode>01</orgResponseCode>'
+    '<requestId>20251015133000123</requestId><balance>15000.00</balance>'
+    '</ns2:return></ns2:gwOperationResponse></S:Body></S:Envelope>'
+)
+
+RESPONSE = (
+    '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+    '<ns2:gwOperationResponse xmlns:ns2="http://webservice.bccsgw.viettel.com/"><Result>'
+    '<error>0</error><description>Success</description>'
+    f'<original>{escape(INNER_RESPONSE)}</original>'
+    '</Result></ns2:gwOperationResponse></S:Body></S:Envelope>'
+)
+
+
+def legacy_build_envelope(username, password, wscode, params):
+    """Versão anterior: concatenação de f-strings sem escaping."""
+    param_xml = ''
+    for name, value in params.items():
+        param_xml += f'<param name="{name}" value="{value}"/>'
+
+    body = f"""<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:web="http://webservice.bccsgw.viettel.com/">
+        <soapenv:Header/>
+        <soapenv:Body>
+            <web:gwOperation>
+                <Input>
+                    <username>{username}</username>
+                    <password>{password}</password>
+                    <wscode>{wscode}</wscode>
+                    {param_xml}
+                    <rawData></rawData>
+                </Input>
+            </web:gwOperation>
+        </soapenv:Body>
+    </soapenv:Envelope>"""
+
+    return body
+
+
+def legacy_parse_response(status_code, text):
+    """Versão anterior: ElementTree completo, sem os prints de debug."""
+    if status_code != 200:
+        return {'error': 'HTTP error', 'code': status_code, 'content': text}
+
+    # Parse da resposta
+    try:
+        root = ET.fromstring(text)
+        
+        # Namespaces
+        ns1 = {'S': 'http://schemas.xmlsoap.org/soap/envelope/'}
+        ns2 = {'ns2': 'http://webservice.bccsgw.viettel.com/'}
+        
+        # Encontrar elementos
+        result_elem = root.find('.//S:Body/ns2:gwOperationResponse/Result', {**ns1, **ns2})
+        
+        if result_elem is None:
+            return {'error': 'Invalid response format', 'content': text}
+            
+        error_elem = result_elem.find('error')
+        description_elem = result_elem.find('description')
+        original_elem = result_elem.find('original')
+        
+        error = error_elem.text if error_elem is not None else 'UNKNOWN'
+        description = description_elem.text if description_elem is not None else ''
+        original = original_elem.text if original_elem is not None else ''
+
+        if error != '0':
+            return {'error': error, 'description': description, 'gateway_error': True}
+
+        # Parse do XML interno se existir
+        if original and original.strip():
+            try:
+                # Limpar CDATA se existir
+                clean_original = original.replace('<![CDATA[', '').replace(']]>', '').strip()
+                inner_root = ET.fromstring(clean_original)
+                
+                # Tentar diferentes namespaces para compatibilidade
+                inner_ns = {
+                    'ns2': 'http://services.wsfw.vas.viettel.com/',
+                    'S': 'http://schemas.xmlsoap.org/soap/envelope/'
+                }
+                
+                # Procurar o elemento return em diferentes locais
+                return_elem = None
+                for ns_prefix, ns_url in inner_ns.items():
+                    return_elem = inner_root.find(f'.//{{{ns_url}}}return')
+                    if return_elem is not None:
+                        break
+                
+                if return_elem is not None:
+                    error_code_elem = return_elem.find('errorCode')
+                    message_elem = return_elem.find('message')
+                    request_id_elem = return_elem.find('requestId')  # CORRIGIDO: era 'reqeustId'
+                    
+                    inner_error = error_code_elem.text if error_code_elem is not None else 'UNKNOWN'
+                    inner_message = message_elem.text if message_elem is not None else ''
+                    request_id = request_id_elem.text if request_id_elem is not None else ''
+                    
+                    return {
+                        'errorCode': inner_error, 
+                        'message': inner_message, 
+                        'requestId': request_id,  # CORRIGIDO
+                        'original': original
+                    }
+                else:
+                    return {'error': 'No return element found', 'original': original}
+                    
+            except Exception as inner_e:
+                return {'error': 'Inner parse error', 'description': str(inner_e), 'original': original}
+        
+        return {'error': '0', 'description': description}
+        
+    except Exception as parse_e:
+        return {'error': 'Parse error', 'description': str(parse_e), 'content': text}
+
+
+def legacy_query_status(text):
+    """Fluxo anterior de check_status: parse da resposta + terceiro parse do 'original'."""
+    result = legacy_parse_response(200, text)
+    inner_root = ET.fromstring(result['original'])
+    inner_ns = {'ns2': 'http://services.wsfw.vas.viettel.com/'}
+    return inner_root.find('.//ns2:return/orgResponseCode', inner_ns).text
+
+
+def current_query_status(text):
+    """Fluxo atual: um único parse já devolve orgResponseCode."""
+    return soap.parse_response(200, text).org_response_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    # Os dois caminhos devem produzir o mesmo resultado
+    assert legacy_query_status(RESPONSE) == current_query_status(RESPONSE) == '01'
+    legacy = legacy_parse_response(200, RESPONSE)
+    current = soap.parse_response(200, RESPONSE).to_dict()
+    assert all(current[k] == legacy[k] for k in legacy)
+
+    cases = [
+        ('montagem do envelope',
+         lambda: legacy_build_envelope('user', 'pass', 'pushUsedMessage', PARAMS),
+         lambda: soap.build_envelope('user', 'pass', 'pushUsedMessage', PARAMS)),
+        ('parse da resposta',
+         lambda: legacy_parse_response(200, RESPONSE),
+         lambda: soap.parse_response(200, RESPONSE)),
+        ('parse + orgResponseCode',
+         lambda: legacy_query_status(RESPONSE),
+         lambda: current_query_status(RESPONSE)),
+    ]
+
+    print(f"{'caso':<26}{'anterior (us)':>15}{'atual (us)':>13}{'ganho':>9}")
+    for name, old, new in cases:
+        old_us = min(timeit.repeat(old, number=args.number, repeat=3)) / args.number * 1e6
+        new_us = min(timeit.repeat(new, number=args.number, repeat=3)) / args.number * 1e6
+        print(f"{name:<26}{old_us:>15.2f}{new_us:>13.2f}{old_us / new_us:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Servidores simulados do M-Pesa e da eMola para testes de carga.
+
+Um servidor HTTP/1.1 mínimo em asyncio (keep-alive, milhares de pedidos
+pendentes sem threads) responde:
+  - M-Pesa: POST /ipg/v1x/c2bPayment/singleStage/ (porta 18352),
+            POST /ipg/v1x/b2cPayment/ (porta 18345) e
+            GET /ipg/v1x/queryTransactionStatus/ (porta 18353), em JSON
+  - eMola:  POST de um envelope SOAP gwOperation (qualquer caminho)
+
+A latência segue uma distribuição configurável (para imitar o tempo que o
+cliente leva a introduzir o PIN USSD) e uma fração dos pedidos devolve códigos
+de erro (ex.: INS-9, INS-6, INS-2006).
+
+Uso isolado:
+    python benchmarks/fake_upstreams.py --mpesa-latency lognormal:8,0.6 --mpesa-errors INS-9=0.05
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import uuid
+from xml.sax.saxutils import escape
+
+MPESA_C2B_PORT = 18352
+MPESA_B2C_PORT = 18345
+MPESA_QUERY_PORT = 18353
+EMOLA_PORT = 18999
+
+_WSCODE_RE = re.compile(r'<wscode>(.*?)</wscode>')
+_TRANS_ID_RE = re.compile(r'name="transId" value="(.*?)"')
+
+
+class Latency:
+    """
+    Distribuição de latência em segundos, definida por texto:
+      fixed:0.2 | uniform:1,5 | lognormal:MEDIANA,SIGMA
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, args = spec.partition(':')
+        values = [float(v) for v in args.split(',') if v]
+        if kind == 'fixed':
+            self._sample = lambda: values[0]
+        elif kind == 'uniform':
+            self._sample = lambda: random.uniform(values[0], values[1])
+        elif kind == 'lognormal':
+            mu = math.log(values[0])
+            self._sample = lambda: random.lognormvariate(mu, values[1])
+        else:
+            raise ValueError(f"Distribuição de latência desconhecida: {spec}")
+
+    def sample(self):
+        return max(0.0, self._sample())
+
+
+def parse_error_mix(spec):
+    """Converte 'INS-9=0.05,INS-6=0.02' em [(código, probabilidade), ...]."""
+    mix = []
+    for item in filter(None, (spec or '').split(',')):
+        code, _, probability = item.partition('=')
+        mix.append((code.strip(), float(probability)))
+    return mix
+
+
+def pick_code(mix, success_code):
+    """Sorteia um código de erro segundo as probabilidades ou devolve o de sucesso."""
+    roll = random.random()
+    for code, probability in mix:
+        if roll < probability:
+            return code
+        roll -= probability
+    return success_code
+
+
+class FakeServer:
+    """Servidor HTTP/1.1 mínimo; `handler(method, path, body)` devolve (status, content_type, corpo)."""
+
+    def __init__(self, handler, latency, host='127.0.0.1'):
+        self.handler = handler
+        self.latency = latency
+        self.host = host
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._servers = []
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+
+                self.requests += 1
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    await asyncio.sleep(self.latency.sample())
+                    status, content_type, payload = self.handler(method, path, body.decode('utf-8'))
+                finally:
+                    self.in_flight -= 1
+
+                data = payload.encode('utf-8')
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, port):
+        server = await asyncio.start_server(self._handle, self.host, port, backlog=4096)
+        self._servers.append(server)
+        return server
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+
+
+def mpesa_handler(error_mix):
+    """Handler do M-Pesa: responde no formato JSON da API IPG."""
+    def handle(method, path, body):
+        if method == 'GET' and 'queryTransactionStatus' in path:
+            return 200, 'application/json', json.dumps({
+                'output_ResponseCode': 'INS-0',
+                'output_ResponseDesc': 'Request processed successfully',
+                'output_ResponseTransactionStatus': random.choice(['Completed', 'Completed', 'Cancelled', 'Expired']),
+                'output_ConversationID': uuid.uuid4().hex,
+            })
+        try:
+            data = json.loads(body or '{}')
+        except ValueError:
+            return 400, 'application/json', json.dumps({'output_ResponseCode': 'INS-996'})
+        code = pick_code(error_mix, 'INS-0')
+        response = {
+            'output_ResponseCode': code,
+            'output_ResponseDesc': 'Request processed successfully' if code == 'INS-0' else 'Simulated error',
+            'output_ConversationID': uuid.uuid4().hex,
+            'output_ThirdPartyReference': data.get('input_ThirdPartyReference', ''),
+        }
+        if code == 'INS-0':
+            response['output_TransactionID'] = uuid.uuid4().hex[:10].upper()
+        status = 201 if code == 'INS-0' else 400
+        return status, 'application/json', json.dumps(response)
+    return handle
+
+
+def emola_handler(error_mix):
+    """Handler da eMola: responde com um envelope gwOperationResponse."""
+    def handle(method, path, body):
+        match = _WSCODE_RE.search(body)
+        wscode = match.group(1) if match else 'unknown'
+        trans_id = _TRANS_ID_RE.search(body)
+        code = pick_code(error_mix, '0')
+        inner = (
+            '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+            f'<ns2:{wscode}Response xmlns:ns2="http://services.wsfw.vas.viettel.com/"><ns2:return>'
+            f'<errorCode>{code}</errorCode><message>{"Success" if code == "0" else "Simulated error"}</message>'
+            f'<requestId>{trans_id.group(1) if trans_id else uuid.uuid4().hex}</requestId>'
+            '<orgResponseCode>01</orgResponseCode><balance>1000000.00</balance>'
+            f'</ns2:return></ns2:{wscode}Response></S:Body></S:Envelope>'
+        )
+        outer = (
+            '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+            '<ns2:gwOperationResponse xmlns:ns2="http://webservice.bccsgw.viettel.com/"><Result>'
+            f'<error>0</error><description>Success</description><original>{escape(inner)}</original>'
+            '</Result></ns2:gwOperationResponse></S:Body></S:Envelope>'
+        )
+        return 200, 'text/xml; charset=utf-8', outer
+    return handle
+
+
+async def start_fakes(mpesa_latency, mpesa_errors, emola_latency, emola_errors, host='127.0.0.1'):
+    """Inicia os três servidores simulados e devolve {nome: FakeServer}."""
+    mpesa = FakeServer(mpesa_handler(parse_error_mix(mpesa_errors)), Latency(mpesa_latency), host)
+    emola = FakeServer(emola_handler(parse_error_mix(emola_errors)), Latency(emola_latency), host)
+    await mpesa.start(MPESA_C2B_PORT)
+    await mpesa.start(MPESA_B2C_PORT)
+    await mpesa.start(MPESA_QUERY_PORT)
+    await emola.start(EMOLA_PORT)
+    return {'mpesa': mpesa, 'emola': emola}
+
+
+def add_fake_arguments(parser):
+    """Argumentos de linha de comando partilhados com o runner de carga."""
+    parser.add_argument('--mpesa-latency', default='lognormal:8,0.6',
+                        help="Latência M-Pesa: fixed:S | uniform:A,B | lognormal:MEDIANA,SIGMA")
+    parser.add_argument('--mpesa-errors', default='INS-9=0.03,INS-6=0.02,INS-2006=0.01',
+                        help="Frações de erro M-Pesa, ex.: INS-9=0.05,INS-6=0.02")
+    parser.add_argument('--emola-latency', default='lognormal:6,0.6', help="Latência eMola")
+    parser.add_argument('--emola-errors', default='1=0.03', help="Frações de errorCode eMola")
+
+
+async def _serve_forever(args):
+    servers = await start_fakes(args.mpesa_latency, args.mpesa_errors, args.emola_latency, args.emola_errors)
+    print(f"M-Pesa simulado em :{MPESA_C2B_PORT}/:{MPESA_B2C_PORT}/:{MPESA_QUERY_PORT}, eMola simulada em :{EMOLA_PORT}")
+    while True:
+        await asyncio.sleep(10)
+        print(' | '.join(f"{name}: {s.requests} pedidos, {s.in_flight} em curso" for name, s in servers.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidores M-Pesa/eMola simulados.")
+    add_fake_arguments(parser)
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,290 @@
+"""
+Teste de carga ponta-a-ponta do gateway contra M-Pesa/eMola simulados.
+
+Inicia os servidores simulados (benchmarks/fake_upstreams.py), opcionalmente
+arranca o gateway via uvicorn apontado para eles, e gera carga em malha aberta
+(taxa fixa de pedidos por segundo, independentemente das respostas) sobre:
+  - POST /oauth/token
+  - POST /v1/c2b/mpesa-payment/<wallet_id>
+  - POST /initiate/   (eMola C2B)
+  - POST /callback/   (callback eMola)
+
+No fim mostra throughput, percentis de latência, taxa de erro por endpoint e,
+com --db-counts, o número de linhas criadas nas tabelas de transações.
+
+Exemplo (base de dados configurada via .env como em produção):
+    python benchmarks/loadtest.py --start-server --workers 2 --rate 200 --duration 60 \\
+        --mpesa-latency lognormal:8,0.6 --mpesa-errors INS-9=0.05,INS-6=0.02
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from fake_upstreams import EMOLA_PORT, add_fake_arguments, start_fakes  # noqa: E402
+
+# Credenciais de um comerciante de teste (python manage.py register_merchant)
+DEFAULT_CLIENT_ID = os.getenv('LOADTEST_CLIENT_ID', 'a0140c9f-4c66-426e-beea-73bef5ac5023')
+DEFAULT_CLIENT_SECRET = os.getenv('LOADTEST_CLIENT_SECRET')
+
+
+class Stats:
+    """Latências e resultados agregados por cenário."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def record(self, scenario, latency, status):
+        self.latencies[scenario].append(latency)
+        self.statuses[scenario][status] += 1
+
+    def report(self, elapsed):
+        """Retorna o relatório por cenário como dicionário."""
+        report = {}
+        for scenario, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            total = len(values)
+            errors = sum(n for status, n in self.statuses[scenario].items()
+                         if not isinstance(status, int) or status >= 400)
+            report[scenario] = {
+                'requests': total,
+                'throughput_rps': round(total / elapsed, 2),
+                'error_rate': round(errors / total, 4) if total else 0,
+                'p50_ms': round(_percentile(values, 50) * 1000, 1),
+                'p90_ms': round(_percentile(values, 90) * 1000, 1),
+                'p99_ms': round(_percentile(values, 99) * 1000, 1),
+                'max_ms': round(values[-1] * 1000, 1) if values else 0,
+                'statuses': {str(k): v for k, v in self.statuses[scenario].items()},
+            }
+        return report
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+def parse_mix(spec):
+    """Converte 'c2b=0.7,emola=0.2,callback=0.1' em [(cenário, peso)]."""
+    mix = []
+    for item in filter(None, spec.split(',')):
+        name, _, weight = item.partition('=')
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+
+class LoadGenerator:
+    """Executa os cenários contra o gateway e acumula estatísticas."""
+
+    def __init__(self, client, args, stats):
+        self.client = client
+        self.args = args
+        self.stats = stats
+        self.token = None
+
+    async def _timed(self, scenario, coro):
+        self.stats.in_flight += 1
+        self.stats.max_in_flight = max(self.stats.max_in_flight, self.stats.in_flight)
+        start = time.perf_counter()
+        try:
+            response = await coro
+            status = response.status_code
+        except httpx.TimeoutException:
+            status = 'timeout'
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finally:
+            self.stats.in_flight -= 1
+        self.stats.record(scenario, time.perf_counter() - start, status)
+        return status
+
+    async def oauth(self):
+        body = {'grant_type': 'client_credentials', 'client_id': self.args.client_id,
+                'client_secret': self.args.client_secret}
+        start = time.perf_counter()
+        response = await self.client.post('/oauth/token', json=body)
+        self.stats.record('oauth', time.perf_counter() - start, response.status_code)
+        if response.status_code == 200:
+            self.token = response.json()['access_token']
+        return response.status_code
+
+    async def c2b(self):
+        body = {
+            'client_id': self.args.client_id,
+            'phone': f'84{random.randint(0, 9999999):07d}',
+            'amount': str(random.choice([10, 50, 100, 500])),
+            'reference': f'LT{uuid.uuid4().hex[:12].upper()}',
+            'fromApp': 'LoadTest',
+        }
+        headers = {'Authorization': f'Bearer {self.token}'}
+        if self.args.accept_mode:
+            headers['Prefer'] = 'respond-async'
+        return await self._timed('c2b', self.client.post(
+            f'/v1/c2b/mpesa-payment/{self.args.wallet_id}', json=body, headers=headers))
+
+    async def emola(self):
+        data = {'msisdn': f'86{random.randint(0, 9999999):07d}', 'amount': '100', 'content': 'Load test'}
+        return await self._timed('emola', self.client.post('/initiate/', data=data))
+
+    async def callback(self):
+        body = {'transId': uuid.uuid4().hex[:30], 'reqeustId': uuid.uuid4().hex, 'refNo': '',
+                'errorCode': random.choice(['0', '0', '0', '1']), 'message': 'Load test'}
+        return await self._timed('callback', self.client.post('/callback/', json=body))
+
+    async def run(self, rate, duration, mix):
+        """Dispara pedidos a `rate` por segundo durante `duration` segundos (malha aberta)."""
+        scenarios = [getattr(self, name) for name, _ in mix]
+        weights = [weight for _, weight in mix]
+        tasks = []
+        start = time.perf_counter()
+        total = int(rate * duration)
+        for i in range(total):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            scenario = random.choices(scenarios, weights)[0]
+            tasks.append(asyncio.create_task(scenario()))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+
+def db_counts():
+    """Conta as linhas das tabelas de transações (usa as settings do projeto)."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gateway.settings')
+    import django
+    django.setup()
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # O LOGGING do projeto regista cada pedido
+    from payments_mpesa.models import Transaction as MpesaTransaction
+    from payments_emola.models import Transaction as EmolaTransaction
+    return {
+        'mpesa_transactions': MpesaTransaction.objects.count(),
+        'emola_transactions': EmolaTransaction.objects.count(),
+    }
+
+
+def start_gateway(args):
+    """Arranca o gateway via uvicorn com os upstreams apontados para os simuladores."""
+    env = dict(os.environ)
+    env['MPESA_BASE_URI'] = 'http://127.0.0.1'
+    env['EMOLA_ENDPOINT'] = f'http://127.0.0.1:{EMOLA_PORT}/ws'
+    if not env.get('MPESA_PUBLIC_KEY'):
+        from run_benchmarks import _generate_public_key
+        env['MPESA_PUBLIC_KEY'] = _generate_public_key()
+        env.setdefault('MPESA_API_KEY', 'loadtest-api-key')
+        env.setdefault('MPESA_SERVICE_PROVIDER_CODE', '171717')
+    port = args.target.rsplit(':', 1)[-1].rstrip('/')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'gateway.asgi:application', '--port', port,
+         '--workers', str(args.workers), '--log-level', 'warning'],
+        cwd=ROOT_DIR, env=env
+    )
+
+
+async def wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get('/transactions/daily-report')
+            return
+        except httpx.HTTPError:
+            await asyncio.sleep(0.5)
+    raise RuntimeError("O gateway não respondeu a tempo")
+
+
+async def main_async(args):
+    fakes = await start_fakes(args.mpesa_latency, args.mpesa_errors, args.emola_latency, args.emola_errors)
+    server = start_gateway(args) if args.start_server else None
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    try:
+        async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=args.timeout) as client:
+            await wait_ready(client)
+            before = await asyncio.to_thread(db_counts) if args.db_counts else None
+
+            generator = LoadGenerator(client, args, stats)
+            await generator.oauth()
+            elapsed = await generator.run(args.rate, args.duration, parse_mix(args.mix))
+
+            after = await asyncio.to_thread(db_counts) if args.db_counts else None
+    finally:
+        for fake in fakes.values():
+            fake.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'config': {k: v for k, v in vars(args).items() if k != 'client_secret'},
+        'elapsed_s': round(elapsed, 2),
+        'max_in_flight': stats.max_in_flight,
+        'upstreams': {name: {'requests': f.requests, 'max_in_flight': f.max_in_flight} for name, f in fakes.items()},
+        'scenarios': stats.report(elapsed),
+    }
+    if before is not None:
+        report['db_rows_created'] = {k: after[k] - before[k] for k in after}
+    return report
+
+
+def print_report(report):
+    print(f"\nDuração: {report['elapsed_s']} s | pedidos simultâneos (máx.): {report['max_in_flight']}")
+    print(f"{'cenário':<10}{'pedidos':>9}{'req/s':>9}{'erro %':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}  status")
+    for name, s in report['scenarios'].items():
+        print(f"{name:<10}{s['requests']:>9}{s['throughput_rps']:>9}{s['error_rate'] * 100:>8.2f}"
+              f"{s['p50_ms']:>10}{s['p90_ms']:>10}{s['p99_ms']:>10}  {s['statuses']}")
+    for name, u in report['upstreams'].items():
+        print(f"upstream {name}: {u['requests']} pedidos, {u['max_in_flight']} simultâneos (máx.)")
+    if 'db_rows_created' in report:
+        print(f"Linhas criadas: {report['db_rows_created']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga do gateway com upstreams simulados.")
+    parser.add_argument('--target', default='http://127.0.0.1:8000', help="URL base do gateway")
+    parser.add_argument('--start-server', action='store_true', help="Arranca o gateway com uvicorn")
+    parser.add_argument('--workers', type=int, default=1, help="Workers uvicorn (com --start-server)")
+    parser.add_argument('--rate', type=float, default=50, help="Pedidos por segundo")
+    parser.add_argument('--duration', type=float, default=30, help="Duração em segundos")
+    parser.add_argument('--mix', default='c2b=0.6,emola=0.2,callback=0.15,oauth=0.05',
+                        help="Pesos dos cenários: c2b, emola, callback, oauth")
+    parser.add_argument('--accept-mode', action='store_true', help="Envia 'Prefer: respond-async' no C2B")
+    parser.add_argument('--wallet-id', default='132722')
+    parser.add_argument('--client-id', default=DEFAULT_CLIENT_ID)
+    parser.add_argument('--client-secret', default=DEFAULT_CLIENT_SECRET)
+    parser.add_argument('--max-connections', type=int, default=5000)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--db-counts', action='store_true', help="Conta as linhas criadas na base de dados")
+    parser.add_argument('--output', help="Grava o relatório em JSON")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+    if not args.client_secret:
+        parser.error("indique --client-secret ou LOADTEST_CLIENT_SECRET")
+
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Relatório gravado em {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Microbenchmarks dos caminhos quentes do gateway (executa offline).
+
+Mede, com respostas fixas em vez de rede/base de dados:
+  - Mpesa._get_token (RSA com cache frio e quente) e _get_headers
+  - Mpesa._make_request (JSON + tratamento do resultado, sessão simulada)
+  - generate_transaction_reference / generate_third_party_reference
+  - montagem do envelope SOAP eMola e parse da resposta
+  - serialização de uma página de transactions_list
+
+Uso:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json   # compara com execução anterior
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup_django():
+    """Configura o Django com as settings do projeto, mas SQLite em memória e sem logs em ficheiro."""
+    from django.conf import settings
+    from gateway import settings as project_settings
+
+    values = {name: getattr(project_settings, name) for name in dir(project_settings) if name.isupper()}
+    values['DATABASES'] = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+    values['LOGGING_CONFIG'] = None
+    values['MPESA_CONFIG'] = {**values['MPESA_CONFIG'], 'API_KEY': 'bench-api-key',
+                              'PUBLIC_KEY': _generate_public_key(), 'SERVICE_PROVIDER_CODE': '171717'}
+    settings.configure(**values)
+
+    import django
+    django.setup()
+    logging.disable(logging.INFO)  # Mede o código, não a escrita de logs
+
+
+def _generate_public_key():
+    """Gera uma chave RSA de teste no formato esperado em MPESA_CONFIG['PUBLIC_KEY']."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('ascii')
+    return ''.join(pem.strip().splitlines()[1:-1])
+
+
+class FakeResponse:
+    """Resposta HTTP fixa (equivalente ao necessário de requests.Response)."""
+
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeSession:
+    """Sessão que devolve sempre a mesma resposta, sem rede."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def request(self, **kwargs):
+        json.dumps(kwargs.get('json'))  # O corpo seria serializado pelo requests
+        return self.response
+
+
+def measure(func, iterations, batch):
+    """
+    Executa func em lotes de `batch` chamadas e devolve as estatísticas por
+    chamada (ops/s, média, p50 e p99 em microssegundos).
+    """
+    for _ in range(min(batch, 100)):
+        func()  # Aquecimento
+
+    samples = []
+    for _ in range(max(1, iterations // batch)):
+        start = time.perf_counter_ns()
+        for _ in range(batch):
+            func()
+        samples.append((time.perf_counter_ns() - start) / batch / 1000)
+
+    samples.sort()
+    mean = statistics.fmean(samples)
+    return {
+        'ops_per_sec': round(1e6 / mean, 1),
+        'mean_us': round(mean, 3),
+        'p50_us': round(samples[len(samples) // 2], 3),
+        'p99_us': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+        'iterations': len(samples) * batch,
+    }
+
+
+def build_cases():
+    """Retorna a lista (nome, função, lote) dos benchmarks."""
+    from payments_mpesa.credentials import credential_cache
+    from payments_mpesa.mpesa import Mpesa
+    from payments_mpesa.views import (
+        generate_transaction_reference, generate_third_party_reference,
+        _serialize_transaction_row, TRANSACTION_LIST_FIELDS,
+    )
+    from payments_emola import soap
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    from bench_emola_soap import PARAMS, RESPONSE
+
+    mpesa = Mpesa()
+    c2b_response = FakeResponse(201, {
+        'output_ResponseCode': 'INS-0',
+        'output_ResponseDesc': 'Request processed successfully',
+        'output_TransactionID': 'ABC123XYZ',
+        'output_ConversationID': 'f02f8f7f1b2e4b0a9d3c',
+        'output_ThirdPartyReference': 'A1B2C3D4E5F6G7H8I9J0',
+    })
+    mpesa._get_session = lambda port: FakeSession(c2b_response)
+    payload = mpesa._build_payload('MAW1015133000', '258840000000', '100', 'A1B2C3D4E5F6G7H8I9J0')
+
+    def token_cold():
+        credential_cache.reset()
+        mpesa._get_token()
+
+    rows = [
+        {
+            'id': i,
+            'transaction_type': 'C2B',
+            'transaction_reference': f'MAW10151330{i % 100:02d}',
+            'third_party_reference': 'A1B2C3D4E5F6G7H8I9J0',
+            'customer_msisdn': '258840000000',
+            'amount': Decimal('100.00'),
+            'status': 'success',
+            'message': 'Sucesso',
+            'from_app': 'CartaFacil',
+            'created_at': datetime(2025, 10, 15, 13, 30, i % 60, tzinfo=dt_timezone.utc),
+        }
+        for i in range(100)
+    ]
+    assert set(rows[0]) == set(TRANSACTION_LIST_FIELDS)
+
+    def serialize_page():
+        data = [_serialize_transaction_row(dict(row)) for row in rows]
+        json.dumps({'transactions': data, 'next_cursor': None}, cls=DjangoJSONEncoder)
+
+    return [
+        ('mpesa.get_token_cold', token_cold, 1),
+        ('mpesa.get_token_cached', mpesa._get_token, 100),
+        ('mpesa.get_headers', mpesa._get_headers, 100),
+        ('mpesa.make_request_c2b', lambda: mpesa._make_request('/ipg/v1x/c2bPayment/singleStage/', 18352, 'POST', payload), 50),
+        ('views.generate_transaction_reference', generate_transaction_reference, 100),
+        ('views.generate_third_party_reference', generate_third_party_reference, 100),
+        ('emola.build_envelope', lambda: soap.build_envelope('user', 'pass', 'pushUsedMessage', PARAMS), 100),
+        ('emola.parse_response', lambda: soap.parse_response(200, RESPONSE), 20),
+        ('views.transactions_list_page_100', serialize_page, 5),
+    ]
+
+
+def compare(results, baseline_path):
+    """Imprime a variação de cada benchmark face a um ficheiro JSON anterior."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"\nComparação com {baseline_path}:")
+    for name, stats in results.items():
+        old = baseline.get(name)
+        if not old:
+            print(f"  {name:<40} (novo)")
+            continue
+        change = (stats['p50_us'] - old['p50_us']) / old['p50_us'] * 100
+        print(f"  {name:<40} p50 {old['p50_us']:>10.2f} -> {stats['p50_us']:>10.2f} us ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks dos caminhos quentes do gateway.")
+    parser.add_argument('--iterations', type=int, default=2000, help="Chamadas por benchmark")
+    parser.add_argument('--filter', default='', help="Executa apenas benchmarks cujo nome contém o texto")
+    parser.add_argument('--output', help="Grava os resultados em JSON")
+    parser.add_argument('--compare', help="JSON de uma execução anterior para comparação")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    setup_django()
+
+    results = {}
+    print(f"{'benchmark':<40}{'ops/s':>14}{'p50 (us)':>12}{'p99 (us)':>12}")
+    for name, func, batch in build_cases():
+        if args.filter not in name:
+            continue
+        iterations = args.iterations if batch > 1 else max(20, args.iterations // 50)
+        stats = measure(func, iterations, batch)
+        results[name] = stats
+        print(f"{name:<40}{stats['ops_per_sec']:>14,.1f}{stats['p50_us']:>12.2f}{stats['p99_us']:>12.2f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'timestamp': datetime.now(dt_timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'iterations': args.iterations,
+                },
+                'results': results,
+            }, f, indent=2)
+        print(f"\nResultados gravados em {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
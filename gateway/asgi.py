@@ -3,6 +3,15 @@ ASGI config for gateway project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+As views de pagamento (M-Pesa C2B e eMola) são assíncronas; servidas por ASGI
+um único worker mantém milhares de pagamentos em curso sem bloquear:
+
+    uvicorn gateway.asgi:application --workers 4
+
+LifespanApplication regista o event loop do servidor, onde os clientes
+httpx.AsyncClient do M-Pesa e da eMola são criados uma vez e reutilizados, e
+fecha-os no shutdown (o Django não trata o scope 'lifespan').
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -13,4 +22,31 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gateway.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from payments_mpesa.asyncclients import aclose_all, register_serving_loop  # noqa: E402 (depois do setup)
+
+
+class LifespanApplication:
+    """Trata o scope 'lifespan' e passa os restantes pedidos à aplicação Django."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    register_serving_loop()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await aclose_all()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        # Servidores sem lifespan: o loop que serve os pedidos é o do processo
+        register_serving_loop()
+        await self.app(scope, receive, send)
+
+
+application = LifespanApplication(django_application)
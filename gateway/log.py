@@ -0,0 +1,173 @@
+"""
+Pipeline de logging sem bloqueio (LOGGING_CONFIG = 'gateway.log.configure_logging').
+
+O Django aplica LOGGING com dictConfig e, em seguida, os handlers de cada
+logger configurado são trocados por um QueuedHandler: o pedido só coloca o
+LogRecord numa fila em memória e uma thread de escrita por processo formata a
+mensagem (logger.info("... %s", data) só é formatado nessa thread) e escreve
+nos handlers originais (consola, RotatingFileHandler).
+
+  - amostragem: LOG_PIPELINE_CONFIG['SAMPLING'] = {'payments_mpesa.mpesa': 0.1}
+    mantém 10% dos registos INFO/DEBUG desse logger (e sub-loggers); registos
+    com `reference` são amostrados por referência (mantidos ou descartados em
+    bloco). WARNING e acima nunca são amostrados;
+  - fila cheia: registos abaixo de ERROR são descartados (e contados); ERROR e
+    acima esperam por espaço;
+  - JsonFormatter: uma linha JSON por registo, com a referência da transação
+    (logger.info(..., extra={'reference': ref})) e os restantes campos `extra`.
+"""
+
+import atexit
+import json
+import logging
+import logging.config
+import os
+import queue
+import random
+import sys
+import threading
+import zlib
+from datetime import datetime, timezone
+
+DEFAULT_LOG_PIPELINE_CONFIG = {
+    'ENABLED': True,
+    'QUEUE_SIZE': 10000,
+    'SAMPLING': {},
+}
+
+# Atributos padrão de um LogRecord (o resto veio de `extra`)
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formata cada registo como uma linha JSON (campos `extra` incluídos)."""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.thread,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogPipeline:
+    """Fila e thread de escrita do processo (recriada após fork)."""
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # Processo filho: a fila herdada pode ter itens e locks do pai
+                    self.queue = queue.Queue(self.queue.maxsize)
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='log-writer', daemon=True).start()
+
+    def put(self, handlers, record):
+        self.ensure_started()
+        try:
+            self.queue.put_nowait((handlers, record))
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                self.queue.put((handlers, record))
+            else:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            handlers, record = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            self.queue.task_done()
+
+    def stop(self):
+        """Escreve o que está na fila e termina a thread (atexit)."""
+        if self._pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.queue.join()
+        self._pid = None
+        if self.dropped:
+            sys.stderr.write(f"{self.dropped} registos de log descartados (fila cheia)\n")
+
+
+class QueuedHandler(logging.Handler):
+    """Envia os registos para a thread de escrita, com amostragem de INFO/DEBUG."""
+
+    def __init__(self, pipeline, handlers, sampling):
+        super().__init__()
+        self.pipeline = pipeline
+        self.handlers = tuple(handlers)
+        self.sampling = sorted(sampling.items(), key=lambda item: -len(item[0]))  # Prefixo mais longo primeiro
+
+    def _sample_rate(self, name):
+        for prefix, rate in self.sampling:
+            if name == prefix or name.startswith(prefix + '.'):
+                return rate
+        return 1.0
+
+    def _keep(self, record):
+        if record.levelno >= logging.WARNING or not self.sampling:
+            return True
+        rate = self._sample_rate(record.name)
+        if rate >= 1.0:
+            return True
+        reference = getattr(record, 'reference', None)
+        if reference:
+            return zlib.crc32(str(reference).encode()) % 10000 < rate * 10000
+        return random.random() < rate
+
+    def emit(self, record):
+        if self._keep(record):
+            self.pipeline.put(self.handlers, record)
+
+    def handle(self, record):
+        # Sem o lock de Handler: a fila já é thread-safe
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+
+def configure_logging(logging_settings):
+    """Aplica LOGGING e passa os handlers dos loggers configurados para a fila."""
+    logging.config.dictConfig(logging_settings)
+
+    from django.conf import settings
+    config = {**DEFAULT_LOG_PIPELINE_CONFIG, **getattr(settings, 'LOG_PIPELINE_CONFIG', {})}
+    if not config['ENABLED']:
+        return
+
+    pipeline = LogPipeline(config['QUEUE_SIZE'])
+    names = list(logging_settings.get('loggers', {}))
+    loggers = [logging.getLogger(name) for name in names] + [logging.getLogger()]
+    for logger in loggers:
+        handlers = [h for h in logger.handlers if not isinstance(h, QueuedHandler)]
+        if not handlers:
+            continue
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(QueuedHandler(pipeline, handlers, config['SAMPLING']))
+    pipeline.ensure_started()
+    atexit.register(pipeline.stop)
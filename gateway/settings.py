@@ -36,6 +36,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments_mpesa.middleware.MetricsMiddleware',
+    'payments_mpesa.middleware.ReplicaPinningMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     
     'django.middleware.security.SecurityMiddleware',
@@ -84,13 +86,41 @@ DATABASES = {
     }
 }
 
-# Para desenvolvimento local, pode usar SQLite descomentando:
-# DATABASES = {
-#     'default': {
-#         'ENGINE': 'django.db.backends.sqlite3',
-#         'NAME': BASE_DIR / 'db.sqlite3',
-#     }
-# }
+# Réplica de leitura (relatórios, listagens, changelist do admin)
+if os.getenv('MYSQL_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.getenv('MYSQL_REPLICA_HOST'),
+        'PORT': os.getenv('MYSQL_REPLICA_PORT', DATABASES['default']['PORT']),
+        'USER': os.getenv('MYSQL_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv('MYSQL_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Para desenvolvimento local: DB_ENGINE=sqlite (DB_REPLICA_SQLITE=ficheiro simula a réplica;
+# o esquema e os dados chegam-lhe copiando o ficheiro principal)
+if os.getenv('DB_ENGINE') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+    if os.getenv('DB_REPLICA_SQLITE'):
+        DATABASES['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_REPLICA_SQLITE'),
+            'TEST': {'MIRROR': 'default'},
+        }
+
+# Leituras de relatório na réplica, quando existe (payments_mpesa/replicas.py)
+DATABASE_ROUTERS = ['payments_mpesa.replicas.ReplicaRouter']
+READ_REPLICA_CONFIG = {
+    'ALIAS': 'replica',
+    'PIN_SECONDS': int(os.getenv('DB_REPLICA_PIN_SECONDS', '5')),  # Leituras no primário após uma escrita do cliente
+    'MAX_LAG': float(os.getenv('DB_REPLICA_MAX_LAG', '10')),  # Acima disto (segundos) lê do primário
+    'LAG_CHECK_INTERVAL': float(os.getenv('DB_REPLICA_LAG_CHECK_INTERVAL', '5')),
+}
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -187,6 +217,10 @@ CSRF_TRUSTED_ORIGINS = [
 LOGS_DIR = BASE_DIR / 'logs'
 LOGS_DIR.mkdir(exist_ok=True)
 
+# 'json': ficheiros com uma linha JSON por registo (campo reference = referência da transação)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+FILE_FORMATTER = 'json' if LOG_FORMAT == 'json' else 'verbose'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -199,6 +233,9 @@ LOGGING = {
             'format': '[{levelname}] {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'gateway.log.JsonFormatter',
+        },
     },
     'filters': {
         'require_debug_true': {
@@ -217,7 +254,7 @@ LOGGING = {
             'filename': LOGS_DIR / 'mpesa_transactions.log',
             'maxBytes': 1024 * 1024 * 5,  # 5 MB
             'backupCount': 5,
-            'formatter': 'verbose',
+            'formatter': FILE_FORMATTER,
         },
         'file_errors': {
             'level': 'ERROR',
@@ -225,7 +262,7 @@ LOGGING = {
             'filename': LOGS_DIR / 'errors.log',
             'maxBytes': 1024 * 1024 * 5,  # 5 MB
             'backupCount': 5,
-            'formatter': 'verbose',
+            'formatter': FILE_FORMATTER,
         },
     },
     'loggers': {
@@ -251,14 +288,172 @@ LOGGING = {
     },
 }
 
+# Escrita dos logs numa thread por processo (gateway/log.py); o pedido só enfileira o registo
+LOGGING_CONFIG = 'gateway.log.configure_logging'
+LOG_PIPELINE_CONFIG = {
+    'ENABLED': os.getenv('LOG_PIPELINE_ENABLED', 'True') == 'True',
+    'QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),  # Cheia: descarta abaixo de ERROR
+    # Fração mantida dos INFO/DEBUG por logger, ex.: LOG_SAMPLING=payments_mpesa.mpesa=0.1,payments_emola=0.5
+    'SAMPLING': {
+        name: float(rate)
+        for name, rate in (item.split('=') for item in os.getenv('LOG_SAMPLING', '').split(',') if item)
+    },
+}
+
 
 # ==================== CONFIGURAÇÕES DO M-PESA ====================
 MPESA_CONFIG = {
     'API_KEY': os.getenv('MPESA_API_KEY'),
     'PUBLIC_KEY': os.getenv('MPESA_PUBLIC_KEY'),
     'ENV': os.getenv('MPESA_ENV', 'sandbox'),
+    'BASE_URI': os.getenv('MPESA_BASE_URI'),  # Opcional: sobrepõe o host derivado de ENV (ex.: http://127.0.0.1)
     'SERVICE_PROVIDER_CODE': os.getenv('MPESA_SERVICE_PROVIDER_CODE'),
     'THIRD_PARTY_REFERENCE': os.getenv('MPESA_THIRD_PARTY_REFERENCE', 'DEFAULT_REF_123'),
+    'TOKEN_TTL': int(os.getenv('MPESA_TOKEN_TTL', '3600')),  # Rotação do token Bearer (segundos)
+    'POOL_SIZE': int(os.getenv('MPESA_POOL_SIZE', '20')),  # Conexões keep-alive por porta
+    'RETRIES': int(os.getenv('MPESA_RETRIES', '2')),  # Retries apenas em falhas de conexão
+    'CONNECT_TIMEOUT': float(os.getenv('MPESA_CONNECT_TIMEOUT', '10')),
+    'READ_TIMEOUT': float(os.getenv('MPESA_READ_TIMEOUT', '90')),  # Inclui o tempo do PIN USSD
+    'ASYNC_MAX_CONNECTIONS': int(os.getenv('MPESA_ASYNC_MAX_CONNECTIONS', '1000')),  # Pagamentos simultâneos por worker ASGI
+}
+
+
+# ==================== CONFIGURAÇÕES DE AUTENTICAÇÃO ====================
+# Limpeza periódica: python manage.py purge_oauth_tokens
+OAUTH_CONFIG = {
+    'TOKEN_CACHE_SIZE': int(os.getenv('OAUTH_TOKEN_CACHE_SIZE', '10000')),  # Tokens validados em memória por processo
+    'TOKEN_CACHE_MAX_TTL': int(os.getenv('OAUTH_TOKEN_CACHE_MAX_TTL', '300')),  # Segundos máx. sem reconsultar a BD
+    'PURGE_BATCH_SIZE': int(os.getenv('OAUTH_PURGE_BATCH_SIZE', '1000')),
+}
+
+# Registo de comerciantes/carteiras em memória (payments_mpesa/merchants.py)
+# Gestão: admin ou python manage.py register_merchant
+MERCHANT_REGISTRY_CONFIG = {
+    'CHECK_INTERVAL': float(os.getenv('MERCHANT_REGISTRY_CHECK_INTERVAL', '5')),  # Segundos entre verificações da versão
+    'VERIFY_CACHE_SIZE': int(os.getenv('MERCHANT_VERIFY_CACHE_SIZE', '10000')),
+    'VERIFY_TTL': int(os.getenv('MERCHANT_VERIFY_TTL', '300')),  # Segredo verificado dispensa novo hash durante este tempo
+}
+
+# Roteamento de POST /v1/c2b/payment pelo prefixo nacional do número (payments_mpesa/routing.py)
+# Regras por comerciante: Merchant.routing_rules (admin)
+PAYMENT_ROUTING_CONFIG = {
+    'PREFIXES': {
+        '84': 'mpesa',
+        '85': 'mpesa',
+        '86': 'emola',
+        '87': 'emola',
+    },
+}
+
+
+# ==================== FILA DE PAGAMENTOS (ACEITAR-E-PROCESSAR) ====================
+# Workers: python manage.py run_payment_worker
+PAYMENT_QUEUE_CONFIG = {
+    'ENABLED': os.getenv('PAYMENT_QUEUE_ENABLED', 'False') == 'True',  # Enfileira todo C2B (senão só com "Prefer: respond-async")
+    'LEASE_SECONDS': int(os.getenv('PAYMENT_QUEUE_LEASE_SECONDS', '150')),  # Deve exceder o READ_TIMEOUT do M-Pesa
+    'MAX_ATTEMPTS': int(os.getenv('PAYMENT_QUEUE_MAX_ATTEMPTS', '3')),
+    'RETRY_BACKOFF': int(os.getenv('PAYMENT_QUEUE_RETRY_BACKOFF', '30')),  # Segundos x tentativa
+    'BATCH_SIZE': int(os.getenv('PAYMENT_QUEUE_BATCH_SIZE', '10')),
+    'POLL_INTERVAL': float(os.getenv('PAYMENT_QUEUE_POLL_INTERVAL', '1.0')),
+    'PROVIDER_CONCURRENCY': {  # Chamadas em paralelo por fornecedor, em cada worker
+        'mpesa': int(os.getenv('PAYMENT_QUEUE_MPESA_CONCURRENCY', '10')),
+        'emola': int(os.getenv('PAYMENT_QUEUE_EMOLA_CONCURRENCY', '5')),
+    },
+}
+
+# Desembolsos B2C em massa (processados pelos mesmos workers)
+BULK_DISBURSEMENT_CONFIG = {
+    'MAX_ITEMS': int(os.getenv('BULK_DISBURSEMENT_MAX_ITEMS', '50000')),
+    'INSERT_BATCH_SIZE': int(os.getenv('BULK_DISBURSEMENT_INSERT_BATCH_SIZE', '1000')),
+}
+
+
+# Rollup diário TransactionDailyStats (payments_mpesa/stats.py): deltas gravados em lote por processo
+DAILY_STATS_CONFIG = {
+    'BUFFER_ENABLED': os.getenv('DAILY_STATS_BUFFER_ENABLED', 'True') == 'True',  # False: grava após cada commit
+    'FLUSH_INTERVAL': float(os.getenv('DAILY_STATS_FLUSH_INTERVAL', '1.0')),  # Segundos
+}
+
+# Reconciliação de C2B/B2C com resultado ambíguo: python manage.py reconcile_transactions
+RECONCILIATION_CONFIG = {
+    'MIN_AGE': int(os.getenv('RECONCILIATION_MIN_AGE', '180')),  # Segundos após a criação antes da 1ª consulta
+    'LOOKBACK_HOURS': int(os.getenv('RECONCILIATION_LOOKBACK_HOURS', '72')),
+    'BATCH_SIZE': int(os.getenv('RECONCILIATION_BATCH_SIZE', '100')),
+    'CONCURRENCY': int(os.getenv('RECONCILIATION_CONCURRENCY', '4')),  # Consultas ao M-Pesa em paralelo
+    'MAX_ATTEMPTS': int(os.getenv('RECONCILIATION_MAX_ATTEMPTS', '6')),
+    'BACKOFF': int(os.getenv('RECONCILIATION_BACKOFF', '60')),  # Segundos x 2^(tentativa-1)
+    'INTERVAL': int(os.getenv('RECONCILIATION_INTERVAL', '60')),  # Pausa entre ciclos sem trabalho
+}
+
+# Arquivo das transações antigas (payments_mpesa/archive.py): python manage.py archive_transactions
+ARCHIVE_CONFIG = {
+    'HOT_MONTHS': int(os.getenv('ARCHIVE_HOT_MONTHS', '6')),  # Meses completos mantidos na tabela Transaction
+    'BATCH_SIZE': int(os.getenv('ARCHIVE_BATCH_SIZE', '1000')),
+    'COMPRESS_LEVEL': int(os.getenv('ARCHIVE_COMPRESS_LEVEL', '6')),  # zlib 1-9
+    'BATCH_PAUSE': float(os.getenv('ARCHIVE_BATCH_PAUSE', '0')),  # Segundos entre lotes
+}
+
+# Respostas completas dos upstreams (Transaction.raw_response) em TransactionPayload (payments_mpesa/payloads.py)
+PAYLOAD_CONFIG = {
+    'COMPRESS_LEVEL': int(os.getenv('PAYLOAD_COMPRESS_LEVEL', '6')),  # zlib 1-9
+}
+
+# ==================== CIRCUIT BREAKERS DOS UPSTREAMS ====================
+# Um breaker por operação (mpesa.c2b, mpesa.b2c, emola.<wscode>); estado em GET /internal/circuit-breakers
+CIRCUIT_BREAKER_CONFIG = {
+    'ENABLED': os.getenv('CIRCUIT_BREAKER_ENABLED', 'True') == 'True',
+    'FAILURE_THRESHOLD': int(os.getenv('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '5')),  # Falhas consecutivas para abrir
+    'SLOW_CALL_RATIO': float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_RATIO', '0.8')),  # Chamada lenta: >= 80% do timeout máximo
+    'RESET_TIMEOUT': int(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', '30')),  # Segundos aberto antes da sonda
+    'HALF_OPEN_MAX_CALLS': int(os.getenv('CIRCUIT_BREAKER_HALF_OPEN_MAX_CALLS', '1')),
+    'WINDOW_SIZE': int(os.getenv('CIRCUIT_BREAKER_WINDOW_SIZE', '200')),  # Latências recentes guardadas
+    'MIN_SAMPLES': int(os.getenv('CIRCUIT_BREAKER_MIN_SAMPLES', '50')),  # Antes disto usa o timeout configurado
+    'TIMEOUT_PERCENTILE': int(os.getenv('CIRCUIT_BREAKER_TIMEOUT_PERCENTILE', '99')),
+    'TIMEOUT_MULTIPLIER': float(os.getenv('CIRCUIT_BREAKER_TIMEOUT_MULTIPLIER', '2.0')),
+    'MIN_TIMEOUT': float(os.getenv('CIRCUIT_BREAKER_MIN_TIMEOUT', '5')),
+    # Push USSD (esperam pelo PIN do cliente): sem chamada lenta = falha nem timeout adaptativo
+    'USSD_OPERATIONS': ('mpesa.c2b', 'emola.pushUsedMessage'),
+    'OVERRIDES': {},  # Ex.: {'emola.queryAccountBalance': {'FAILURE_THRESHOLD': 3}}
+}
+
+# ==================== MÉTRICAS ====================
+# Formato Prometheus em GET /internal/metrics
+METRICS_CONFIG = {
+    'ENABLED': os.getenv('METRICS_ENABLED', 'True') == 'True',
+    'MULTIPROCESS_DIR': os.getenv('METRICS_MULTIPROCESS_DIR') or None,  # Vários workers: diretório partilhado
+    'WRITE_INTERVAL': float(os.getenv('METRICS_WRITE_INTERVAL', '5')),  # Segundos entre snapshots por processo
+    'TOKEN': os.getenv('METRICS_TOKEN') or None,  # Token estático do scraper (senão exige OAuth)
+}
+
+# ==================== IDEMPOTÊNCIA DOS PAGAMENTOS ====================
+# Limpeza periódica: python manage.py purge_idempotency_keys
+IDEMPOTENCY_CONFIG = {
+    'TTL': int(os.getenv('IDEMPOTENCY_TTL', '86400')),  # Segundos durante os quais um pedido repetido recebe a resposta original
+    'LOCK_SECONDS': int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '150')),  # Deve exceder o READ_TIMEOUT do M-Pesa
+    'WAIT_TIMEOUT': float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', '120')),  # Espera máx. de um duplicado pelo original
+    'POLL_INTERVAL': float(os.getenv('IDEMPOTENCY_POLL_INTERVAL', '0.25')),
+    'PURGE_BATCH_SIZE': int(os.getenv('IDEMPOTENCY_PURGE_BATCH_SIZE', '1000')),
+}
+
+# ==================== CONTROLO DE ADMISSÃO ====================
+# Token buckets por client_id, fromApp e MSISDN (429 + Retry-After)
+# Limpeza periódica: python manage.py purge_rate_limit_buckets
+RATE_LIMIT_CONFIG = {
+    'ENABLED': os.getenv('RATE_LIMIT_ENABLED', 'True') == 'True',
+    'BACKEND': os.getenv('RATE_LIMIT_BACKEND', 'database'),  # 'database' (partilhado pelos workers) ou 'local'
+    'BUCKETS': {  # RATE: tokens/segundo, BURST: capacidade
+        'client': {'RATE': float(os.getenv('RATE_LIMIT_CLIENT_RATE', '20')),
+                   'BURST': int(os.getenv('RATE_LIMIT_CLIENT_BURST', '60'))},
+        'app': {'RATE': float(os.getenv('RATE_LIMIT_APP_RATE', '10')),
+                'BURST': int(os.getenv('RATE_LIMIT_APP_BURST', '30'))},
+        'msisdn': {'RATE': float(os.getenv('RATE_LIMIT_MSISDN_RATE', '0.05')),  # 1 pedido a cada 20 s
+                   'BURST': int(os.getenv('RATE_LIMIT_MSISDN_BURST', '3'))},
+    },
+    'OVERRIDES': {},  # Ex.: {'app:CartaFacil': {'RATE': 50, 'BURST': 100}}
+    # Chamadas síncronas ao upstream em curso: globais com BACKEND 'database' (UpstreamSlot), por worker com 'local'
+    'MAX_IN_FLIGHT': int(os.getenv('RATE_LIMIT_MAX_IN_FLIGHT', '500')),
+    'IN_FLIGHT_LEASE': int(os.getenv('RATE_LIMIT_IN_FLIGHT_LEASE', '300')),  # Segundos; acima do maior READ_TIMEOUT
+    'PURGE_BATCH_SIZE': int(os.getenv('RATE_LIMIT_PURGE_BATCH_SIZE', '1000')),
 }
 
 
@@ -269,6 +464,27 @@ EMOLA_CONFIG = {
     'KEY': os.getenv('EMOLA_KEY'),
     'PARTNER_CODE': os.getenv('EMOLA_PARTNER_CODE'),
     'ENDPOINT': os.getenv('EMOLA_ENDPOINT', 'https://api.emola.com'),
+    'POOL_SIZE': int(os.getenv('EMOLA_POOL_SIZE', '20')),  # Conexões keep-alive
+    'RETRIES': int(os.getenv('EMOLA_RETRIES', '2')),  # Retries apenas em falhas de conexão
+    'CONNECT_TIMEOUT': float(os.getenv('EMOLA_CONNECT_TIMEOUT', '5')),
+    # Timeouts de leitura por operação (segundos): curtos para consultas, longos para push USSD
+    'TIMEOUTS': {
+        'pushUsedMessage': float(os.getenv('EMOLA_TIMEOUT_PUSH', '90')),
+        'pushUsedDisbursementB2C': float(os.getenv('EMOLA_TIMEOUT_DISBURSEMENT', '60')),
+        'pushUsedQueryTrans': float(os.getenv('EMOLA_TIMEOUT_QUERY', '15')),
+        'queryBeneficiaryName': float(os.getenv('EMOLA_TIMEOUT_NAME', '10')),
+        'queryAccountBalance': float(os.getenv('EMOLA_TIMEOUT_BALANCE', '10')),
+    },
+}
+
+# Callbacks eMola: gravados em PendingCallback antes da confirmação e aplicados em lote (por tamanho ou tempo)
+EMOLA_CALLBACK_CONFIG = {
+    'BUFFER_ENABLED': os.getenv('EMOLA_CALLBACK_BUFFER_ENABLED', 'True') == 'True',  # False: aplica em cada pedido
+    'FLUSH_SIZE': int(os.getenv('EMOLA_CALLBACK_FLUSH_SIZE', '200')),
+    'FLUSH_INTERVAL': float(os.getenv('EMOLA_CALLBACK_FLUSH_INTERVAL', '0.5')),  # Segundos
+    'PENDING_BATCH_SIZE': int(os.getenv('EMOLA_CALLBACK_PENDING_BATCH_SIZE', '500')),
+    'PENDING_INTERVAL': float(os.getenv('EMOLA_CALLBACK_PENDING_INTERVAL', '5')),  # Segundos
+    'PENDING_TTL_HOURS': int(os.getenv('EMOLA_CALLBACK_PENDING_TTL_HOURS', '72')),  # Callbacks sem transação
 }
 
 
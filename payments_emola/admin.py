@@ -1,3 +1,7 @@
 from django.contrib import admin
+from .models import PendingCallback
 
-# Register your models here.
+@admin.register(PendingCallback)
+class PendingCallbackAdmin(admin.ModelAdmin):
+    list_display = ("trans_id", "error_code", "request_id", "received_at")
+    search_fields = ("trans_id", "request_id")
@@ -0,0 +1,251 @@
+"""
+Ingestão de callbacks da eMola.
+
+A view valida o corpo e grava o callback em PendingCallback antes de confirmar:
+um callback confirmado nunca se perde, mesmo que o processo morra a seguir. A
+atualização das Transaction é feita a partir dessa tabela, em lotes, por uma
+thread de fundo (acordada ao fim de FLUSH_SIZE callbacks ou a cada
+FLUSH_INTERVAL segundos) e pelo comando reconcile_transactions.
+
+  - duplicados: PendingCallback é indexado por transId (o último callback
+    prevalece) e as linhas que já estão no estado pedido não são regravadas;
+  - estados finais: só uma transação 'pending' passa a 'success'/'failed'; um
+    callback que contradiga um estado final é ignorado (e registado);
+  - callback antes da transação: a view initiate_payment só grava a linha
+    depois de a eMola responder, pelo que o callback pode chegar primeiro. Fica
+    em PendingCallback até a linha existir (verificação a cada PENDING_INTERVAL
+    segundos) e é descartado após PENDING_TTL_HOURS.
+"""
+
+import atexit
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction as db_transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from .models import Transaction, PendingCallback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CALLBACK_CONFIG = {
+    'BUFFER_ENABLED': True,
+    'FLUSH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.5,
+    'PENDING_BATCH_SIZE': 500,
+    'PENDING_INTERVAL': 5,
+    'PENDING_TTL_HOURS': 72,
+}
+
+FINAL_STATUSES = ('success', 'failed')
+CALLBACK_FIELDS = ('trans_id', 'request_id', 'ref_no', 'error_code', 'message')
+
+
+class InvalidCallback(ValueError):
+    """Corpo de callback que não pode ser aceite."""
+
+
+def get_callback_config():
+    """Retorna EMOLA_CALLBACK_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_CALLBACK_CONFIG, **getattr(settings, 'EMOLA_CALLBACK_CONFIG', {})}
+
+
+def _field(data, *names):
+    for name in names:
+        value = data.get(name)
+        if value is not None:
+            return str(value).strip()
+    return ''
+
+
+def parse_callback(body):
+    """
+    Valida o corpo JSON de um callback.
+
+    Retorna dict com trans_id, request_id, ref_no, error_code e message.
+    A documentação da eMola escreve 'reqeustId'; 'requestId' também é aceite.
+    """
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCallback('JSON inválido')
+    if not isinstance(data, dict):
+        raise InvalidCallback('O corpo deve ser um objeto JSON')
+
+    trans_id = _field(data, 'transId')
+    error_code = _field(data, 'errorCode')
+    if not trans_id:
+        raise InvalidCallback('transId em falta')
+    if len(trans_id) > 30:
+        raise InvalidCallback('transId inválido')
+    if not error_code:
+        raise InvalidCallback('errorCode em falta')
+
+    return {
+        'trans_id': trans_id,
+        'request_id': _field(data, 'reqeustId', 'requestId')[:50],
+        'ref_no': _field(data, 'refNo')[:20],
+        'error_code': error_code[:20],
+        'message': _field(data, 'message'),
+    }
+
+
+def status_for(error_code):
+    """Status local correspondente ao errorCode do callback."""
+    return 'success' if error_code == '0' else 'failed'
+
+
+def apply_callbacks(callbacks):
+    """
+    Aplica callbacks (dicts de parse_callback, um por trans_id) às transações.
+
+    Só as transações 'pending' são atualizadas (UPDATE condicional por estado
+    final); um estado final nunca é alterado. Retorna (atualizadas,
+    inalteradas, sem transação).
+    """
+    if not callbacks:
+        return 0, 0, []
+    now = timezone.now()
+    by_id = {cb['trans_id']: cb for cb in callbacks}
+    current = dict(Transaction.objects.filter(trans_id__in=list(by_id)).values_list('trans_id', 'status'))
+    missing = [cb for trans_id, cb in by_id.items() if trans_id not in current]
+
+    updated = 0
+    for status in FINAL_STATUSES:
+        group = [cb for cb in by_id.values() if cb['trans_id'] in current and status_for(cb['error_code']) == status]
+        if not group:
+            continue
+        conflicting = [cb['trans_id'] for cb in group if current[cb['trans_id']] in FINAL_STATUSES
+                       and current[cb['trans_id']] != status]
+        if conflicting:
+            logger.warning(f"Callbacks eMola '{status}' ignorados (estado final diferente): {', '.join(conflicting)}")
+        fields = {'status': status, 'updated_at': now}
+        request_ids = [When(trans_id=cb['trans_id'], then=Value(cb['request_id'])) for cb in group if cb['request_id']]
+        if request_ids:
+            fields['request_id'] = Case(*request_ids, default=F('request_id'))
+        updated += Transaction.objects.filter(
+            trans_id__in=[cb['trans_id'] for cb in group], status='pending'
+        ).update(**fields)
+    return updated, len(current) - updated, missing
+
+
+def store_pending(callbacks):
+    """Grava callbacks em PendingCallback (o mais recente de cada transId prevalece)."""
+    if not callbacks:
+        return
+    ids = [cb['trans_id'] for cb in callbacks]
+    with db_transaction.atomic():
+        PendingCallback.objects.filter(trans_id__in=ids).delete()
+        PendingCallback.objects.bulk_create([PendingCallback(**cb) for cb in callbacks], ignore_conflicts=True)
+
+
+def apply_pending(config=None):
+    """
+    Aplica, em lotes de PENDING_BATCH_SIZE, os callbacks gravados cuja transação
+    já existe e descarta os expirados. Retorna o número de transações atualizadas.
+    """
+    config = config or get_callback_config()
+    cutoff = timezone.now() - timedelta(hours=config['PENDING_TTL_HOURS'])
+    expired, _ = PendingCallback.objects.filter(received_at__lt=cutoff).delete()
+    if expired:
+        logger.warning(f"{expired} callbacks eMola descartados sem transação correspondente")
+
+    updated = 0
+    while True:
+        ready = list(
+            PendingCallback.objects.filter(
+                trans_id__in=Transaction.objects.filter(
+                    trans_id__in=PendingCallback.objects.values('trans_id')
+                ).values('trans_id')
+            ).order_by('received_at')[:config['PENDING_BATCH_SIZE']]
+        )
+        if not ready:
+            return updated
+        with db_transaction.atomic():
+            applied, _, _ = apply_callbacks([{field: getattr(p, field) for field in CALLBACK_FIELDS} for p in ready])
+            # Por pk: um callback mais recente do mesmo transId (nova linha) fica para o próximo lote
+            PendingCallback.objects.filter(pk__in=[p.pk for p in ready]).delete()
+        updated += applied
+        if len(ready) < config['PENDING_BATCH_SIZE']:
+            return updated
+
+
+class CallbackApplier:
+    """Thread de fundo que aplica os callbacks gravados, por número recebido ou por tempo."""
+
+    def __init__(self, config=None):
+        self.config = config or get_callback_config()
+        self._received = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self._pending_checked_at = 0.0
+
+    def notify(self):
+        """Assinala um callback gravado; acorda a thread ao fim de FLUSH_SIZE callbacks."""
+        with self._cond:
+            self._received += 1
+            if not self.config['BUFFER_ENABLED']:
+                return
+            self._ensure_thread()
+            if self._received >= self.config['FLUSH_SIZE']:
+                self._cond.notify()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='emola-callback-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopped and self._received < self.config['FLUSH_SIZE']:
+                    self._cond.wait(self.config['FLUSH_INTERVAL'])
+                if self._stopped:
+                    return
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Erro ao aplicar callbacks eMola: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """
+        Aplica os callbacks gravados: de imediato se chegaram novos, senão a cada
+        PENDING_INTERVAL segundos (callbacks à espera da transação).
+        """
+        with self._flush_lock:
+            with self._cond:
+                received, self._received = self._received, 0
+            now = time.monotonic()
+            if not received and now - self._pending_checked_at < self.config['PENDING_INTERVAL']:
+                return 0
+            self._pending_checked_at = now
+            try:
+                updated = apply_pending(self.config)
+            except Exception:
+                with self._cond:
+                    self._received += received
+                raise
+
+        if updated:
+            logger.info(f"Callbacks eMola: {updated} transações atualizadas ({received} recebidos)")
+        return updated
+
+    def stop(self):
+        """Para a thread; os callbacks já estão gravados e são aplicados no próximo arranque."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+
+callback_applier = CallbackApplier()
+atexit.register(callback_applier.stop)
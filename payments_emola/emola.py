@@ -0,0 +1,309 @@
+"""
+Cliente do gateway eMola (SOAP gwOperation), equivalente a payments_mpesa.mpesa.Mpesa.
+
+Lê EMOLA_CONFIG uma única vez, mantém uma sessão keep-alive com pool de
+conexões e aplica timeouts por operação: curtos para consultas de saldo e nome,
+longos para os push USSD que esperam pela confirmação do cliente. Cada wscode
+tem um circuit breaker (payments_mpesa.breaker) e o timeout configurado é o
+máximo do timeout adaptativo.
+"""
+
+import asyncio
+import threading
+import time
+import weakref
+import logging
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+from payments_mpesa.breaker import breakers
+from payments_mpesa.mpesa import config_fingerprint, request_not_sent
+from payments_mpesa import asyncclients, metrics
+
+from . import soap
+
+logger = logging.getLogger(__name__)
+
+# Timeouts de leitura padrão por wscode (segundos)
+DEFAULT_TIMEOUTS = {
+    'pushUsedMessage': 90,
+    'pushUsedDisbursementB2C': 60,
+    'pushUsedQueryTrans': 15,
+    'queryBeneficiaryName': 10,
+    'queryAccountBalance': 10,
+}
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_POOL_SIZE = 20
+DEFAULT_RETRIES = 2
+DEFAULT_ASYNC_MAX_CONNECTIONS = 1000
+
+HEADERS = {'Content-Type': 'text/xml; charset=utf-8'}
+
+
+class EmolaClient:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Retorna o cliente eMola partilhado pelo processo (singleton thread-safe).
+
+        Se EMOLA_CONFIG mudou desde a criação, o cliente é reconstruído (novas
+        credenciais, timeouts e pools) e as sessões do anterior são fechadas.
+        """
+        fingerprint = config_fingerprint(settings.EMOLA_CONFIG)
+        instance = cls._instance
+        if instance is None or instance.fingerprint != fingerprint:
+            with cls._instance_lock:
+                instance = cls._instance
+                if instance is None or instance.fingerprint != fingerprint:
+                    previous = instance
+                    instance = cls._instance = cls()
+                    if previous is not None:
+                        previous.close()
+                        logger.info("EMOLA_CONFIG alterado: cliente eMola reconstruído")
+        return instance
+
+    @classmethod
+    def reset_instance(cls):
+        """Fecha a sessão do singleton atual (ex.: após alterar EMOLA_CONFIG)."""
+        with cls._instance_lock:
+            if cls._instance is not None:
+                cls._instance.close()
+            cls._instance = None
+
+    def __init__(self):
+        """Inicializa o cliente eMola com as configurações do Django."""
+        self.config = dict(settings.EMOLA_CONFIG)
+        self.fingerprint = config_fingerprint(self.config)
+        self.username = self.config['USERNAME']
+        self.password = self.config['PASSWORD']
+        self.key = self.config['KEY']
+        self.partner_code = self.config['PARTNER_CODE']
+        self.endpoint = self.config['ENDPOINT']
+        self.connect_timeout = float(self.config.get('CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT))
+        self.timeouts = {**DEFAULT_TIMEOUTS, **self.config.get('TIMEOUTS', {})}
+        self.pool_size = int(self.config.get('POOL_SIZE', DEFAULT_POOL_SIZE))
+        self.retries = int(self.config.get('RETRIES', DEFAULT_RETRIES))
+        self.async_max_connections = int(self.config.get('ASYNC_MAX_CONNECTIONS', DEFAULT_ASYNC_MAX_CONNECTIONS))
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._async_clients = weakref.WeakKeyDictionary()  # httpx.AsyncClient por event loop do servidor ASGI
+
+    # ==================== TRANSPORTE ====================
+
+    def _get_session(self):
+        """Retorna a sessão HTTP pooled (criada na primeira utilização)."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    # Só falhas de conexão são repetidas: um push USSD nunca é reenviado
+                    retry = Retry(total=self.retries, connect=self.retries, read=0, status=0,
+                                  backoff_factor=0.3, allowed_methods=None)
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.verify = False
+                    self._session = session
+        return self._session
+
+    def _get_async_client(self):
+        """
+        Retorna o httpx.AsyncClient do event loop do servidor ASGI (um por loop),
+        ou None num loop de curta duração (ver payments_mpesa.asyncclients).
+        """
+        loop = asyncio.get_running_loop()
+        if not asyncclients.is_serving_loop(loop):
+            return None
+        client = self._async_clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.async_max_connections,
+                                  max_keepalive_connections=self.pool_size)
+            transport = httpx.AsyncHTTPTransport(retries=self.retries, verify=False, limits=limits)
+            client = httpx.AsyncClient(transport=transport)
+            self._async_clients[loop] = client
+            asyncclients.track(client, loop)
+        return client
+
+    def close(self):
+        """Fecha a sessão HTTP síncrona e os clientes assíncronos (no respetivo loop)."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+        for loop, client in list(self._async_clients.items()):
+            asyncclients.close_later(client, loop)
+        self._async_clients.clear()
+
+    def timeout_for(self, wscode):
+        """Timeout de leitura configurado para o wscode."""
+        return self.timeouts.get(wscode, DEFAULT_READ_TIMEOUT)
+
+    def _breaker(self, wscode):
+        """Circuit breaker do wscode; o timeout configurado é o máximo do adaptativo."""
+        return breakers.get(f'emola.{wscode}', self.timeout_for(wscode))
+
+    @staticmethod
+    def _record_outcome(breaker, result, latency):
+        """Só erros de transporte/HTTP 5xx contam como falha; erros de negócio não."""
+        if result.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(latency)
+
+    @staticmethod
+    def _circuit_open_result(breaker):
+        """Resultado imediato enquanto o circuito está aberto (pedido não enviado)."""
+        logger.warning(f"Chamada eMola rejeitada: circuit breaker {breaker.name} aberto")
+        return soap.SoapResult(error='Circuit open', description="Serviço eMola temporariamente indisponível",
+                               status_code=503)
+
+    def _build_envelope(self, wscode, params):
+        """Completa os parâmetros com partnerCode/key e monta o envelope SOAP."""
+        params = {'partnerCode': self.partner_code, **params, 'key': self.key}
+        logger.debug(f"eMola {wscode}: a enviar pedido SOAP")
+        return soap.build_envelope(self.username, self.password, wscode, params)
+
+    def call(self, wscode, params):
+        """Executa uma operação gwOperation e retorna um SoapResult."""
+        breaker = self._breaker(wscode)
+        if not breaker.allow():
+            metrics.upstream_rejected(breaker.name)
+            return self._circuit_open_result(breaker)
+        body = self._build_envelope(wscode, params)
+        metrics.upstream_started(breaker.name)
+        start = time.monotonic()
+        try:
+            response = self._get_session().post(
+                self.endpoint,
+                data=body.encode('utf-8'),
+                headers=HEADERS,
+                timeout=(self.connect_timeout, breaker.timeout())
+            )
+            result = soap.parse_response(response.status_code, response.text)
+            self._record_outcome(breaker, result, time.monotonic() - start)
+        except requests.exceptions.ConnectionError as e:
+            breaker.record_failure()
+            # 'Connection failed': pedido não enviado; 'Connection aborted': cortado depois do envio
+            result = soap.SoapResult(error='Connection failed' if request_not_sent(e) else 'Connection aborted',
+                                     description=str(e))
+        except requests.exceptions.Timeout as e:
+            breaker.record_failure()
+            result = soap.SoapResult(error='Timeout', description=str(e))
+        except Exception as e:
+            breaker.record_failure()
+            logger.error(f"Erro na requisição eMola {wscode}: {str(e)}")
+            result = soap.SoapResult(error='Unexpected error', description=str(e))
+        finally:
+            metrics.upstream_finished(breaker.name)
+        metrics.observe_upstream('emola', breaker.name, metrics.emola_code(result), time.monotonic() - start)
+        return result
+
+    async def acall(self, wscode, params):
+        """Versão assíncrona de call()."""
+        client = self._get_async_client()
+        if client is None:
+            # Loop de curta duração (WSGI, async_to_sync): sessão síncrona pooled numa thread
+            return await sync_to_async(self.call, thread_sensitive=False)(wscode, params)
+        breaker = self._breaker(wscode)
+        if not breaker.allow():
+            metrics.upstream_rejected(breaker.name)
+            return self._circuit_open_result(breaker)
+        body = self._build_envelope(wscode, params)
+        metrics.upstream_started(breaker.name)
+        start = time.monotonic()
+        try:
+            response = await client.post(
+                self.endpoint,
+                content=body.encode('utf-8'),
+                headers=HEADERS,
+                timeout=httpx.Timeout(breaker.timeout(), connect=self.connect_timeout)
+            )
+            result = soap.parse_response(response.status_code, response.text)
+            self._record_outcome(breaker, result, time.monotonic() - start)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            breaker.record_failure()
+            result = soap.SoapResult(error='Connection failed', description=str(e))
+        except httpx.TimeoutException as e:
+            breaker.record_failure()
+            result = soap.SoapResult(error='Timeout', description=str(e))
+        except Exception as e:
+            breaker.record_failure()
+            logger.error(f"Erro na requisição eMola {wscode}: {str(e)}")
+            result = soap.SoapResult(error='Unexpected error', description=str(e))
+        finally:
+            metrics.upstream_finished(breaker.name)
+        metrics.observe_upstream('emola', breaker.name, metrics.emola_code(result), time.monotonic() - start)
+        return result
+
+    # ==================== OPERAÇÕES ====================
+
+    @staticmethod
+    def _push_message_params(msisdn, amount, content, trans_id, language, ref_no):
+        return {
+            'msisdn': msisdn,
+            'smsContent': content,
+            'transAmount': amount,
+            'transId': trans_id,
+            'language': language,
+            'refNo': ref_no,
+        }
+
+    @staticmethod
+    def _disbursement_params(msisdn, amount, trans_id, content):
+        return {
+            'msisdn': msisdn,
+            'smsContent': content,
+            'transAmount': amount,
+            'transId': trans_id,
+        }
+
+    def push_used_message(self, msisdn, amount, content, trans_id, language='pt', ref_no=''):
+        """Pagamento C2B: envia o push USSD para o cliente confirmar (pushUsedMessage)."""
+        params = self._push_message_params(msisdn, amount, content, trans_id, language, ref_no)
+        return self.call('pushUsedMessage', params)
+
+    def push_used_disbursement_b2c(self, msisdn, amount, trans_id, content=''):
+        """Desembolso B2C para o cliente (pushUsedDisbursementB2C)."""
+        return self.call('pushUsedDisbursementB2C', self._disbursement_params(msisdn, amount, trans_id, content))
+
+    def push_used_query_trans(self, trans_id, trans_type='C2B'):
+        """Consulta o estado de uma transação (pushUsedQueryTrans)."""
+        return self.call('pushUsedQueryTrans', {'transId': trans_id, 'transType': trans_type})
+
+    def query_beneficiary_name(self, msisdn, trans_id):
+        """Obtém o nome mascarado do titular da conta (queryBeneficiaryName)."""
+        return self.call('queryBeneficiaryName', {'msisdn': msisdn, 'transId': trans_id})
+
+    def query_account_balance(self, trans_id):
+        """Consulta o saldo da conta do parceiro (queryAccountBalance)."""
+        return self.call('queryAccountBalance', {'transId': trans_id})
+
+    async def apush_used_message(self, msisdn, amount, content, trans_id, language='pt', ref_no=''):
+        """Versão assíncrona de push_used_message()."""
+        params = self._push_message_params(msisdn, amount, content, trans_id, language, ref_no)
+        return await self.acall('pushUsedMessage', params)
+
+    async def apush_used_disbursement_b2c(self, msisdn, amount, trans_id, content=''):
+        """Versão assíncrona de push_used_disbursement_b2c()."""
+        return await self.acall('pushUsedDisbursementB2C', self._disbursement_params(msisdn, amount, trans_id, content))
+
+    async def apush_used_query_trans(self, trans_id, trans_type='C2B'):
+        """Versão assíncrona de push_used_query_trans()."""
+        return await self.acall('pushUsedQueryTrans', {'transId': trans_id, 'transType': trans_type})
+
+    async def aquery_beneficiary_name(self, msisdn, trans_id):
+        """Versão assíncrona de query_beneficiary_name()."""
+        return await self.acall('queryBeneficiaryName', {'msisdn': msisdn, 'transId': trans_id})
+
+    async def aquery_account_balance(self, trans_id):
+        """Versão assíncrona de query_account_balance()."""
+        return await self.acall('queryAccountBalance', {'transId': trans_id})
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_emola', '0002_alter_transaction_msisdn'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trans_id', models.CharField(max_length=30, unique=True)),
+                ('request_id', models.CharField(blank=True, max_length=50)),
+                ('ref_no', models.CharField(blank=True, max_length=20)),
+                ('error_code', models.CharField(blank=True, max_length=20)),
+                ('message', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -11,5 +11,22 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id']),  # Exportação por keyset
+        ]
+
+    def __str__(self):
+        return self.trans_id
+
+class PendingCallback(models.Model):
+    """Callback recebido e ainda não aplicado (ou à espera de a Transaction ser criada)."""
+    trans_id = models.CharField(max_length=30, unique=True)
+    request_id = models.CharField(max_length=50, blank=True)
+    ref_no = models.CharField(max_length=20, blank=True)
+    error_code = models.CharField(max_length=20, blank=True)
+    message = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
     def __str__(self):
-        return self.trans_id
\ No newline at end of file
+        return f"{self.trans_id} ({self.error_code})"
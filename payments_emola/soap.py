@@ -0,0 +1,170 @@
+"""
+Codec SOAP do gateway eMola (gwOperation).
+
+Monta envelopes a partir de templates pré-compilados, com escaping XML correto
+dos valores, e interpreta a resposta numa única passagem sobre o envelope e
+outra sobre o XML interno 'original' (que chega como texto). O resultado já
+inclui orgResponseCode e balance, dispensando novos parses nas views.
+"""
+
+import logging
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+_ENVELOPE_HEAD = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:web="http://webservice.bccsgw.viettel.com/">'
+    '<soapenv:Header/><soapenv:Body><web:gwOperation><Input>'
+    '<username>{username}</username><password>{password}</password><wscode>{wscode}</wscode>'
+)
+_ENVELOPE_TAIL = '<rawData></rawData></Input></web:gwOperation></soapenv:Body></soapenv:Envelope>'
+
+# Elementos extraídos de cada documento (nome local, sem namespace)
+_OUTER_TAGS = frozenset(('error', 'description', 'original'))
+_INNER_TAGS = frozenset(('errorCode', 'message', 'requestId', 'orgResponseCode', 'balance'))
+
+
+@lru_cache(maxsize=32)
+def _envelope_head(username, password, wscode):
+    """Início do envelope com credenciais e wscode já escapados (cacheado)."""
+    return _ENVELOPE_HEAD.format(username=_escape(username or ''), password=_escape(password or ''), wscode=_escape(wscode))
+
+
+def _escape(value):
+    """Escapa texto para conteúdo ou atributo XML delimitado por aspas duplas."""
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def _params_xml(params):
+    """Serializa os <param/>; o escaping só é aplicado se algum valor o exigir."""
+    xml = ''.join([f'<param name="{name}" value="{"" if value is None else value}"/>' for name, value in params.items()])
+    # Cada <param/> tem exatamente 1 '<', 1 '>' e 4 aspas: qualquer excesso
+    # (ou um '&') vem dos valores e obriga ao caminho com escaping.
+    count = len(params)
+    if '&' in xml or xml.count('"') != 4 * count or xml.count('<') != count or xml.count('>') != count:
+        xml = ''.join([
+            f'<param name="{_escape(str(name))}" value="{_escape("" if value is None else str(value))}"/>'
+            for name, value in params.items()
+        ])
+    return xml
+
+
+def build_envelope(username, password, wscode, params):
+    """Monta o envelope gwOperation com os parâmetros escapados."""
+    return _envelope_head(username, password, wscode) + _params_xml(params) + _ENVELOPE_TAIL
+
+
+@dataclass
+class SoapResult:
+    """Resultado tipado de uma chamada gwOperation."""
+    error: str = None
+    description: str = None
+    error_code: str = None
+    message: str = ''
+    request_id: str = ''
+    org_response_code: str = None
+    balance: str = None
+    original: str = ''
+    status_code: int = 200
+    content: str = None
+    gateway_error: bool = False
+
+    @property
+    def ok(self):
+        """True quando o gateway e a API interna devolveram código 0."""
+        return self.error_code == '0'
+
+    def to_dict(self):
+        """Dicionário no formato devolvido historicamente por send_soap_request."""
+        if self.error_code is None:
+            result = {'error': self.error}
+            if self.status_code != 200:
+                result['code'] = self.status_code
+            if self.description is not None:
+                result['description'] = self.description
+            if self.gateway_error:
+                result['gateway_error'] = True
+            if self.content is not None:
+                result['content'] = self.content
+            if self.original:
+                result['original'] = self.original
+            return result
+
+        result = {
+            'errorCode': self.error_code,
+            'message': self.message,
+            'requestId': self.request_id,
+            'original': self.original,
+        }
+        if self.org_response_code is not None:
+            result['orgResponseCode'] = self.org_response_code
+        if self.balance is not None:
+            result['balance'] = self.balance
+        return result
+
+
+def _scan(data, wanted, container=None):
+    """
+    Percorre o documento uma única vez e devolve {nome_local: texto} para as
+    tags pedidas (primeira ocorrência) e se o elemento `container` existe.
+    """
+    found = {}
+    seen_container = container is None
+    for elem in ET.fromstring(data).iter():
+        name = elem.tag.rpartition('}')[2]
+        if name in wanted:
+            if name not in found:
+                found[name] = elem.text or ''
+        elif name == container:
+            seen_container = True
+    return found, seen_container
+
+
+def parse_response(status_code, text):
+    """Interpreta a resposta HTTP do gateway eMola num SoapResult."""
+    if status_code != 200:
+        return SoapResult(error='HTTP error', status_code=status_code, content=text)
+
+    try:
+        outer, has_result = _scan(text, _OUTER_TAGS, container='Result')
+    except ET.ParseError as e:
+        logger.warning(f"Resposta eMola inválida: {e}")
+        return SoapResult(error='Parse error', description=str(e), content=text)
+
+    if not has_result:
+        return SoapResult(error='Invalid response format', content=text)
+
+    error = outer.get('error', 'UNKNOWN')
+    description = outer.get('description', '')
+    original = outer.get('original', '')
+    logger.debug(f"Resposta gateway eMola: error={error}, description={description}")
+
+    if error != '0':
+        return SoapResult(error=error, description=description, gateway_error=True)
+
+    if not original or not original.strip():
+        return SoapResult(error='0', description=description)
+
+    try:
+        clean_original = original.replace('<![CDATA[', '').replace(']]>', '').strip()
+        inner, has_return = _scan(clean_original, _INNER_TAGS, container='return')
+    except ET.ParseError as e:
+        logger.warning(f"XML interno eMola inválido: {e}")
+        return SoapResult(error='Inner parse error', description=str(e), original=original)
+
+    if not has_return:
+        return SoapResult(error='No return element found', original=original)
+
+    return SoapResult(
+        error='0',
+        description=description,
+        error_code=inner.get('errorCode', 'UNKNOWN'),
+        message=inner.get('message', ''),
+        request_id=inner.get('requestId', ''),
+        org_response_code=inner.get('orgResponseCode'),
+        balance=inner.get('balance'),
+        original=original,
+    )
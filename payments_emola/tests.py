@@ -1,3 +1,91 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
 from django.test import TestCase
+from django.utils import timezone
+
+from .callbacks import DEFAULT_CALLBACK_CONFIG, CallbackApplier, callback_applier, apply_callbacks, apply_pending, store_pending
+from .emola import EmolaClient
+from .models import PendingCallback, Transaction
+
+
+def make_callback(trans_id, error_code='0', request_id='REQ1'):
+    return {'trans_id': trans_id, 'request_id': request_id, 'ref_no': '', 'error_code': error_code, 'message': ''}
+
+
+class CallbackTests(TestCase):
+    """Callbacks gravados antes da confirmação, aplicados em lote e sem recuar estados finais."""
+
+    def _txn(self, trans_id, status='pending'):
+        return Transaction.objects.create(trans_id=trans_id, msisdn='258860000001', amount=Decimal('10.00'), status=status)
+
+    def test_pending_transaction_becomes_final(self):
+        self._txn('T1')
+        self.assertEqual(apply_callbacks([make_callback('T1')]), (1, 0, []))
+        txn = Transaction.objects.get(trans_id='T1')
+        self.assertEqual((txn.status, txn.request_id), ('success', 'REQ1'))
+
+    def test_final_status_is_never_overwritten(self):
+        self._txn('T1', status='success')
+        self._txn('T2', status='failed')
+        updated, unchanged, missing = apply_callbacks([make_callback('T1', error_code='10'), make_callback('T2')])
+        self.assertEqual((updated, unchanged, missing), (0, 2, []))
+        self.assertEqual(Transaction.objects.get(trans_id='T1').status, 'success')
+        self.assertEqual(Transaction.objects.get(trans_id='T2').status, 'failed')
+
+    def test_stored_callback_is_applied_once_transaction_exists(self):
+        store_pending([make_callback('T1')])
+        self.assertEqual(apply_pending(), 0)
+        self.assertTrue(PendingCallback.objects.filter(trans_id='T1').exists())
+        self._txn('T1')
+        self.assertEqual(apply_pending(), 1)
+        self.assertFalse(PendingCallback.objects.exists())
+        self.assertEqual(Transaction.objects.get(trans_id='T1').status, 'success')
+
+    def test_apply_pending_drains_in_batches(self):
+        for i in range(5):
+            self._txn(f'T{i}')
+        store_pending([make_callback(f'T{i}') for i in range(5)])
+        self.assertEqual(apply_pending(dict(DEFAULT_CALLBACK_CONFIG, PENDING_BATCH_SIZE=2)), 5)
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_expired_callbacks_are_discarded(self):
+        store_pending([make_callback('T1')])
+        PendingCallback.objects.update(received_at=timezone.now() - timedelta(hours=73))
+        apply_pending()
+        self.assertFalse(PendingCallback.objects.exists())
+
+    def test_callback_view_stores_before_acknowledging(self):
+        with mock.patch.dict(callback_applier.config, BUFFER_ENABLED=False):
+            response = self.client.post(
+                '/callback/', data='{"transId": "T1", "errorCode": "0", "reqeustId": "R9"}',
+                content_type='application/json'
+            )
+        self.assertEqual(response.json()['ResponseCode'], '0')
+        self.assertEqual(PendingCallback.objects.get().request_id, 'R9')
+
+    def test_applier_flush_applies_received_callbacks(self):
+        self._txn('T1')
+        store_pending([make_callback('T1')])
+        applier = CallbackApplier(dict(DEFAULT_CALLBACK_CONFIG, BUFFER_ENABLED=False))
+        applier.notify()
+        self.assertEqual(applier.flush(), 1)
+
+
+class EmolaClientInstanceTests(TestCase):
+    """O singleton eMola é reconstruído quando EMOLA_CONFIG muda, como o M-Pesa."""
+
+    def tearDown(self):
+        EmolaClient.reset_instance()
 
-# Create your tests here.
+    def test_rebuilt_when_config_changes(self):
+        EmolaClient.reset_instance()
+        first = EmolaClient.get_instance()
+        self.assertIs(EmolaClient.get_instance(), first)
+        timeouts = dict(settings.EMOLA_CONFIG.get('TIMEOUTS', {}), pushUsedMessage=5.0)
+        with self.settings(EMOLA_CONFIG=dict(settings.EMOLA_CONFIG, TIMEOUTS=timeouts)):
+            second = EmolaClient.get_instance()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.timeouts['pushUsedMessage'], 5.0)
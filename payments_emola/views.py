@@ -1,10 +1,17 @@
+import logging
 import uuid
-import requests
 import xml.etree.ElementTree as ET
 from django.http import JsonResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from asgiref.sync import sync_to_async
 from .models import Transaction
+from .emola import EmolaClient
+from .callbacks import callback_applier, parse_callback, store_pending, InvalidCallback
+from payments_mpesa.ratelimit import aadmit, upstream_slot, rejection_response, AdmissionRejected
+from payments_mpesa.routing import normalize_msisdn, InvalidMsisdn
+
+logger = logging.getLogger(__name__)
 
 # Função auxiliar para enviar requisição SOAP
 # def send_soap_request(wscode, params):
@@ -60,141 +67,13 @@ from .models import Transaction
 #     except Exception as e:
 #         return {'error': 'Parse error', 'description': str(e)}
 def send_soap_request(wscode, params):
-    username = settings.EMOLA_USERNAME
-    password = settings.EMOLA_PASSWORD
-    endpoint = settings.EMOLA_ENDPOINT
-    
-    print(f"DEBUG - Credenciais:")
-    print(f"Username: {'***' if username else 'MISSING'}")
-    print(f"Password: {'***' if password else 'MISSING'}")
-    print(f"Endpoint: {endpoint}")
-    print(f"Partner Code: {settings.EMOLA_PARTNER_CODE}")
-    print(f"Key: {'***' if settings.EMOLA_KEY else 'MISSING'}")
-    print(f"WSCode: {wscode}")
-    print(f"Params: {params}")
-
-    param_xml = ''
-    for name, value in params.items():
-        param_xml += f'<param name="{name}" value="{value}"/>'
-
-    body = f"""<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:web="http://webservice.bccsgw.viettel.com/">
-        <soapenv:Header/>
-        <soapenv:Body>
-            <web:gwOperation>
-                <Input>
-                    <username>{username}</username>
-                    <password>{password}</password>
-                    <wscode>{wscode}</wscode>
-                    {param_xml}
-                    <rawData></rawData>
-                </Input>
-            </web:gwOperation>
-        </soapenv:Body>
-    </soapenv:Envelope>"""
-    
-    print(f"DEBUG - SOAP Request Body:")
-    print(body)
+    """Executa uma operação gwOperation genérica (ver EmolaClient para as operações tipadas)."""
+    return EmolaClient.get_instance().call(wscode, params).to_dict()
 
-    headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    
-    try:
-        response = requests.post(
-            endpoint, 
-            data=body, 
-            headers=headers, 
-            timeout=30,
-            verify=False
-        )
-        
-        print(f"DEBUG - Response Status: {response.status_code}")
-        print(f"DEBUG - Response Content: {response.text}")
-        
-        if response.status_code != 200:
-            return {'error': 'HTTP error', 'code': response.status_code, 'content': response.text}
-
-        # Parse da resposta
-        try:
-            root = ET.fromstring(response.text)
-            
-            # Namespaces
-            ns1 = {'S': 'http://schemas.xmlsoap.org/soap/envelope/'}
-            ns2 = {'ns2': 'http://webservice.bccsgw.viettel.com/'}
-            
-            # Encontrar elementos
-            result_elem = root.find('.//S:Body/ns2:gwOperationResponse/Result', {**ns1, **ns2})
-            
-            if result_elem is None:
-                return {'error': 'Invalid response format', 'content': response.text}
-                
-            error_elem = result_elem.find('error')
-            description_elem = result_elem.find('description')
-            original_elem = result_elem.find('original')
-            
-            error = error_elem.text if error_elem is not None else 'UNKNOWN'
-            description = description_elem.text if description_elem is not None else ''
-            original = original_elem.text if original_elem is not None else ''
-
-            print(f"DEBUG - Gateway Response: error={error}, description={description}")
-
-            if error != '0':
-                return {'error': error, 'description': description, 'gateway_error': True}
-
-            # Parse do XML interno se existir
-            if original and original.strip():
-                try:
-                    # Limpar CDATA se existir
-                    clean_original = original.replace('<![CDATA[', '').replace(']]>', '').strip()
-                    inner_root = ET.fromstring(clean_original)
-                    
-                    # Tentar diferentes namespaces para compatibilidade
-                    inner_ns = {
-                        'ns2': 'http://services.wsfw.vas.viettel.com/',
-                        'S': 'http://schemas.xmlsoap.org/soap/envelope/'
-                    }
-                    
-                    # Procurar o elemento return em diferentes locais
-                    return_elem = None
-                    for ns_prefix, ns_url in inner_ns.items():
-                        return_elem = inner_root.find(f'.//{{{ns_url}}}return')
-                        if return_elem is not None:
-                            break
-                    
-                    if return_elem is not None:
-                        error_code_elem = return_elem.find('errorCode')
-                        message_elem = return_elem.find('message')
-                        request_id_elem = return_elem.find('requestId')  # CORRIGIDO: era 'reqeustId'
-                        
-                        inner_error = error_code_elem.text if error_code_elem is not None else 'UNKNOWN'
-                        inner_message = message_elem.text if message_elem is not None else ''
-                        request_id = request_id_elem.text if request_id_elem is not None else ''
-                        
-                        print(f"DEBUG - API Response: errorCode={inner_error}, message={inner_message}, requestId={request_id}")
-                        
-                        return {
-                            'errorCode': inner_error, 
-                            'message': inner_message, 
-                            'requestId': request_id,  # CORRIGIDO
-                            'original': original
-                        }
-                    else:
-                        return {'error': 'No return element found', 'original': original}
-                        
-                except Exception as inner_e:
-                    print(f"DEBUG - Inner parse error: {str(inner_e)}")
-                    return {'error': 'Inner parse error', 'description': str(inner_e), 'original': original}
-            
-            return {'error': '0', 'description': description}
-            
-        except Exception as parse_e:
-            print(f"DEBUG - Parse error: {str(parse_e)}")
-            return {'error': 'Parse error', 'description': str(parse_e), 'content': response.text}
-            
-    except requests.exceptions.ConnectionError as e:
-        return {'error': 'Connection failed', 'description': str(e)}
-    except requests.exceptions.Timeout as e:
-        return {'error': 'Timeout', 'description': str(e)}
-    except Exception as e:
-        return {'error': 'Unexpected error', 'description': str(e)}
+
+async def asend_soap_request(wscode, params):
+    """Versão assíncrona de send_soap_request (não bloqueia o event loop)."""
+    return (await EmolaClient.get_instance().acall(wscode, params)).to_dict()
  
     
 # View para iniciar pagamento (PushMessage - C2B)
@@ -239,7 +118,7 @@ def send_soap_request(wscode, params):
 #     return JsonResponse(result)
 # View para iniciar pagamento (PushMessage - C2B) - CORRIGIDA
 @csrf_exempt
-def initiate_payment(request):
+async def initiate_payment(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
     
@@ -252,26 +131,21 @@ def initiate_payment(request):
     if not all([msisdn, amount, content]):
         return JsonResponse({'error': 'Missing parameters'})
 
-   
-    if len(msisdn) == 9 and not msisdn.startswith(('86', '87')):
-        # Adiciona prefixo padrão 86 se não tiver
-        msisdn = '258' + msisdn
+    try:
+        msisdn = normalize_msisdn(msisdn)
+    except InvalidMsisdn as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
     trans_id = str(uuid.uuid4())[:30]
 
-    params = {
-        'partnerCode': settings.EMOLA_PARTNER_CODE,
-        'msisdn': msisdn,
-        'smsContent': content,
-        'transAmount': amount,
-        'transId': trans_id,
-        'language': language,
-        'refNo': ref_no,
-        'key': settings.EMOLA_KEY,
-    }
-
-    # CORREÇÃO: WSCode correto
-    result = send_soap_request('pushUsedMessage', params)
+    # Controlo de admissão: bucket por MSISDN e vagas de chamadas ao upstream
+    emola = EmolaClient.get_instance()
+    try:
+        await aadmit(msisdn=msisdn)
+        async with upstream_slot():
+            result = (await emola.apush_used_message(msisdn, amount, content, trans_id, language, ref_no)).to_dict()
+    except AdmissionRejected as e:
+        return rejection_response(e)
 
     # Salva transação
     txn = Transaction(
@@ -287,13 +161,13 @@ def initiate_payment(request):
         txn.request_id = result.get('requestId', '')  # CORRIGIDO
     else:
         txn.status = 'failed'
-    txn.save()
+    await txn.asave()
 
     return JsonResponse(result)
 
 # View para desembolso (B2C)
 @csrf_exempt
-def disburse(request):
+async def disburse(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
     
@@ -306,30 +180,22 @@ def disburse(request):
 
     trans_id = str(uuid.uuid4())[:30]
 
-    params = {
-        'partnerCode': settings.EMOLA_PARTNER_CODE,
-        'msisdn': msisdn,
-        'smsContent': content,
-        'transAmount': amount,
-        'transId': trans_id,
-        'key': settings.EMOLA_KEY,
-    }
-
-    result = send_soap_request('pushUsedDisbursementB2C', params)
+    emola = EmolaClient.get_instance()
+    result = (await emola.apush_used_disbursement_b2c(msisdn, amount, trans_id, content)).to_dict()
 
     txn = Transaction(trans_id=trans_id, msisdn=msisdn, amount=amount, content=content)
     if 'errorCode' in result and result['errorCode'] == '0':
         txn.status = 'success'
-        txn.request_id = result.get('reqeustId', '')
+        txn.request_id = result.get('requestId', '')
     else:
         txn.status = 'failed'
-    txn.save()
+    await txn.asave()
 
     return JsonResponse(result)
 
 # View para verificar status de transação
 @csrf_exempt
-def check_status(request):
+async def check_status(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
     
@@ -339,26 +205,17 @@ def check_status(request):
     if not trans_id:
         return JsonResponse({'error': 'Missing trans_id'})
 
-    params = {
-        'partnerCode': settings.EMOLA_PARTNER_CODE,
-        'transId': trans_id,
-        'key': settings.EMOLA_KEY,
-        'transType': trans_type,
-    }
-
-    result = send_soap_request('pushUsedQueryTrans', params)
+    emola = EmolaClient.get_instance()
+    result = (await emola.apush_used_query_trans(trans_id, trans_type)).to_dict()
 
     # Atualiza status local se necessário
     try:
-        txn = Transaction.objects.get(trans_id=trans_id)
+        txn = await Transaction.objects.aget(trans_id=trans_id)
         if 'errorCode' in result and result['errorCode'] == '0':
-            # Parse orgResponseCode
-            if 'original' in result:
-                inner_root = ET.fromstring(result['original'])
-                inner_ns = {'ns2': 'http://services.wsfw.vas.viettel.com/'}
-                org_code = inner_root.find('.//ns2:return/orgResponseCode', inner_ns).text
-                txn.status = 'success' if org_code == '01' else 'failed'
-                txn.save()
+            # orgResponseCode já vem extraído pelo codec SOAP
+            if 'orgResponseCode' in result:
+                txn.status = 'success' if result['orgResponseCode'] == '01' else 'failed'
+                await txn.asave()
     except Transaction.DoesNotExist:
         pass
 
@@ -366,7 +223,7 @@ def check_status(request):
 
 # View para obter nome do beneficiário
 @csrf_exempt
-def get_beneficiary_name(request):
+async def get_beneficiary_name(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
     
@@ -377,14 +234,8 @@ def get_beneficiary_name(request):
 
     trans_id = str(uuid.uuid4())[:30]
 
-    params = {
-        'partnerCode': settings.EMOLA_PARTNER_CODE,
-        'msisdn': msisdn,
-        'transId': trans_id,
-        'key': settings.EMOLA_KEY,
-    }
-
-    result = send_soap_request('queryBeneficiaryName', params)
+    emola = EmolaClient.get_instance()
+    result = (await emola.aquery_beneficiary_name(msisdn, trans_id)).to_dict()
 
     # Extrai nome se sucesso
     if 'errorCode' in result and result['errorCode'] == '0':
@@ -394,55 +245,40 @@ def get_beneficiary_name(request):
 
 # View para verificar saldo da conta
 @csrf_exempt
-def check_balance(request):
+async def check_balance(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
     
     # Nota: Pela doc, é para saldo do parceiro, sem msisdn
     trans_id = str(uuid.uuid4())[:30]
 
-    params = {
-        'partnerCode': settings.EMOLA_PARTNER_CODE,
-        'transId': trans_id,
-        'key': settings.EMOLA_KEY,
-    }
+    emola = EmolaClient.get_instance()
+    result = (await emola.aquery_account_balance(trans_id)).to_dict()
 
-    result = send_soap_request('queryAccountBalance', params)
-
-    # Extrai saldo se sucesso
-    if 'errorCode' in result and result['errorCode'] == '0':
-        if 'original' in result:
-            inner_root = ET.fromstring(result['original'])
-            inner_ns = {'ns2': 'http://services.wsfw.vas.viettel.com/'}
-            balance = inner_root.find('.//ns2:return/balance', inner_ns).text
-            result['balance'] = balance
+    # O saldo ('balance') já vem extraído pelo codec SOAP quando há sucesso
 
     return JsonResponse(result)
 
 # View para callback (notificações async da eMola)
 @csrf_exempt
-def callback(request):
+async def callback(request):
     if request.method != 'POST':
         return HttpResponseBadRequest('Only POST allowed')
-    
-    data = request.json()
-    request_id = data.get('reqeustId')
-    trans_id = data.get('transId')
-    ref_no = data.get('refNo')
-    error_code = data.get('errorCode')
-    message = data.get('message')
-
-    # Atualiza status da transação
+
     try:
-        txn = Transaction.objects.get(trans_id=trans_id)
-        txn.status = 'success' if error_code == '0' else 'failed'
-        txn.request_id = request_id
-        txn.save()
-    except Transaction.DoesNotExist:
-        pass  # Log se necessário
+        data = parse_callback(request.body)
+    except InvalidCallback as e:
+        logger.warning(f"Callback eMola rejeitado: {str(e)}")
+        return JsonResponse({'ResponseCode': '1', 'ResponseMessage': str(e)}, status=400)
+
+    # Gravado antes de confirmar; a transação é atualizada em lote (sem buffer, antes de responder)
+    await sync_to_async(store_pending)([data])
+    callback_applier.notify()
+    if not callback_applier.config['BUFFER_ENABLED']:
+        await sync_to_async(callback_applier.flush)()
 
     # Responde conforme doc
     return JsonResponse({
         'ResponseCode': '0',
         'ResponseMessage': 'Callback received'
-    })
\ No newline at end of file
+    })
@@ -1,8 +1,98 @@
+from django import forms
 from django.contrib import admin
-from .models import Transaction
+from .models import Transaction, TransactionArchive, PaymentJob, IdempotencyKey, DisbursementBatch, Merchant, Wallet
+from .replicas import use_replica
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ("transaction_type", "transaction_reference", "customer_msisdn", "amount", "status", "created_at")
     search_fields = ("transaction_reference", "customer_msisdn", "transaction_id")
     list_filter = ("transaction_type", "status", "created_at")
+    # Lido de TransactionPayload só na página de detalhe
+    readonly_fields = ("raw_response",)
+
+    def changelist_view(self, request, extra_context=None):
+        # A listagem (GET) lê da réplica; ações (POST) ficam no primário
+        if request.method != "GET":
+            return super().changelist_view(request, extra_context)
+        return use_replica(super().changelist_view)(request, extra_context)
+
+
+@admin.register(TransactionArchive)
+class TransactionArchiveAdmin(admin.ModelAdmin):
+    list_display = ("transaction_type", "transaction_reference", "customer_msisdn", "amount", "status", "created_at")
+    search_fields = ("transaction_reference",)
+    exclude = ("payload",)
+    readonly_fields = ("cold_fields",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method != "GET":
+            return super().changelist_view(request, extra_context)
+        return use_replica(super().changelist_view)(request, extra_context)
+
+
+@admin.register(PaymentJob)
+class PaymentJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "operation", "provider", "status", "attempts", "locked_by", "available_at", "lease_expires_at")
+    list_filter = ("operation", "provider", "status")
+    raw_id_fields = ("transaction",)
+
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ("key", "operation", "status", "response_status", "created_at", "expires_at")
+    list_filter = ("operation", "status")
+
+
+@admin.register(DisbursementBatch)
+class DisbursementBatchAdmin(admin.ModelAdmin):
+    list_display = ("id", "provider", "status", "total_items", "total_amount", "from_app", "created_at", "completed_at")
+    list_filter = ("provider", "status")
+
+
+class MerchantForm(forms.ModelForm):
+    client_secret = forms.CharField(required=False, widget=forms.PasswordInput(render_value=False),
+                                    help_text="Preencher só para definir/rodar o segredo (guardado com hash)")
+
+    class Meta:
+        model = Merchant
+        fields = ("name", "client_id", "client_secret", "routing_rules", "is_active")
+
+    def clean(self):
+        cleaned = super().clean()
+        if not self.instance.secret_hash and not cleaned.get("client_secret"):
+            self.add_error("client_secret", "Obrigatório para um novo comerciante")
+        return cleaned
+
+    def save(self, commit=True):
+        if self.cleaned_data.get("client_secret"):
+            self.instance.set_secret(self.cleaned_data["client_secret"])
+        return super().save(commit)
+
+
+class WalletInline(admin.TabularInline):
+    model = Wallet
+    extra = 0
+
+
+@admin.register(Merchant)
+class MerchantAdmin(admin.ModelAdmin):
+    form = MerchantForm
+    list_display = ("name", "client_id", "is_active", "updated_at")
+    list_filter = ("is_active",)
+    search_fields = ("name", "client_id")
+    inlines = (WalletInline,)
+
+
+@admin.register(Wallet)
+class WalletAdmin(admin.ModelAdmin):
+    list_display = ("wallet_id", "provider", "merchant", "is_active")
+    list_filter = ("provider", "is_active")
+    search_fields = ("wallet_id", "merchant__name", "merchant__client_id")
+    raw_id_fields = ("merchant",)
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class PaymentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'payments_mpesa'
+
+    def ready(self):
+        # Regista os sinais do rollup diário de transações
+        from . import signals  # noqa: F401
+
+        # Contagem de queries SQL por pedido (métricas)
+        from django.db.backends.signals import connection_created
+        from .metrics import install_query_counter
+        connection_created.connect(install_query_counter, dispatch_uid='metrics_query_counter')
@@ -0,0 +1,175 @@
+"""
+Separação quente/fria das transações M-Pesa.
+
+A tabela Transaction (cinco índices secundários) guarda apenas os meses
+recentes: python manage.py archive_transactions move, em lotes, as
+transações criadas antes do início do mês de há HOT_MONTHS meses para
+TransactionArchive, uma tabela com só dois índices em que os campos frios
+(raw_response, lido de TransactionPayload, conversation_id e dados de
+reconciliação) ficam num blob JSON comprimido com zlib. O tamanho da tabela
+quente, e com ele o custo dos inserts e o working set dos índices, deixa de
+crescer com o histórico.
+
+Consultas nos dois níveis:
+  - relatórios diário/mensal: leem TransactionDailyStats, que o arquivo não
+    altera (rebuild_day também soma as linhas arquivadas);
+  - listagem, exportação e estado de uma transação: leem a tabela quente e,
+    quando é preciso, o arquivo. Uma transação com um job por processar
+    fica na tabela quente até o job terminar, por isso os dois níveis podem
+    ter linhas intercaladas: são juntos por ordem (created_at, id).
+
+O particionamento nativo do MySQL (PARTITION BY RANGE) não é usado: exige a
+coluna de partição em todas as chaves únicas, não admite chaves estrangeiras
+(PaymentJob -> Transaction) e não é gerido pelas migrações do Django.
+"""
+
+import heapq
+import logging
+import time
+from datetime import datetime, time as dt_time
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Transaction, TransactionArchive
+from .payloads import compress_json, load_payloads
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_CONFIG = {
+    'HOT_MONTHS': 6,
+    'BATCH_SIZE': 1000,
+    'COMPRESS_LEVEL': 6,
+    'BATCH_PAUSE': 0.0,  # Segundos entre lotes (dá folga à réplica)
+}
+
+# Campos mantidos como colunas no arquivo
+ARCHIVE_FIELDS = (
+    'id', 'transaction_type', 'provider', 'transaction_id', 'transaction_reference', 'third_party_reference',
+    'customer_msisdn', 'amount', 'status', 'message', 'from_app', 'batch_id', 'created_at', 'updated_at',
+)
+# Campos guardados no payload comprimido (raw_response vem de TransactionPayload)
+COLD_FIELDS = ('raw_response', 'conversation_id', 'reconcile_attempts', 'next_reconcile_at', 'reconciled_at')
+COLD_COLUMNS = tuple(field for field in COLD_FIELDS if field != 'raw_response')
+
+# Uma transação com jobs por processar fica na tabela quente (o arquivo salta-a)
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+
+def get_archive_config():
+    """Retorna ARCHIVE_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_ARCHIVE_CONFIG, **getattr(settings, 'ARCHIVE_CONFIG', {})}
+
+
+def archive_cutoff(months=None, now=None):
+    """Início (fuso local) do mês de há `months` meses: tudo o que é anterior vai para o arquivo."""
+    months = get_archive_config()['HOT_MONTHS'] if months is None else months
+    today = timezone.localdate(now or timezone.now())
+    month_index = today.year * 12 + today.month - 1 - months
+    first_day = today.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+    return timezone.make_aware(datetime.combine(first_day, dt_time.min))
+
+
+def blocked_transactions(cutoff):
+    """Transações anteriores ao corte que ficam na tabela quente por terem um job por processar."""
+    return Transaction.objects.filter(created_at__lt=cutoff, jobs__status__in=ACTIVE_JOB_STATUSES).distinct()
+
+
+def archivable(cutoff):
+    """Transações que o próximo arquivo pode mover (antes do corte e sem jobs por processar)."""
+    return Transaction.objects.filter(created_at__lt=cutoff).exclude(jobs__status__in=ACTIVE_JOB_STATUSES)
+
+
+def archive_batch(cutoff, batch_size, level=DEFAULT_ARCHIVE_CONFIG['COMPRESS_LEVEL']):
+    """
+    Move um lote de transações anteriores a `cutoff` para o arquivo.
+
+    Cópia e remoção na mesma transação; repetir após uma falha é seguro
+    (ignore_conflicts pelo id original). Retorna o número de linhas movidas.
+    """
+    with db_transaction.atomic():
+        rows = list(
+            archivable(cutoff)
+            .order_by('created_at', 'id')
+            .values(*ARCHIVE_FIELDS, *COLD_COLUMNS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        payloads = load_payloads(row['id'] for row in rows)
+        for row in rows:
+            row['raw_response'] = payloads.get(row['id'])
+        TransactionArchive.objects.bulk_create([
+            TransactionArchive(
+                payload=compress_json({field: row[field] for field in COLD_FIELDS}, level),
+                **{field: row[field] for field in ARCHIVE_FIELDS}
+            )
+            for row in rows
+        ], ignore_conflicts=True)
+        # Os PaymentJob concluídos e os TransactionPayload destas transações são apagados em cascata
+        Transaction.objects.filter(id__in=[row['id'] for row in rows]).delete()
+    return len(rows)
+
+
+def archive_transactions(months=None, batch_size=None, max_batches=None, now=None):
+    """
+    Arquiva, lote a lote, as transações anteriores ao corte de `months` meses.
+
+    Retorna o número total de linhas movidas.
+    """
+    config = get_archive_config()
+    batch_size = batch_size or config['BATCH_SIZE']
+    cutoff = archive_cutoff(months, now)
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = archive_batch(cutoff, batch_size, config['COMPRESS_LEVEL'])
+        if not moved:
+            break
+        total += moved
+        batches += 1
+        logger.info(f"Transações arquivadas: {moved} (total {total}, corte {cutoff:%Y-%m-%d})")
+        if moved < batch_size:
+            break
+        if config['BATCH_PAUSE']:
+            time.sleep(config['BATCH_PAUSE'])
+    skipped = blocked_transactions(cutoff).count()
+    if skipped:
+        logger.warning(f"Transações não arquivadas por terem jobs por processar: {skipped} (corte {cutoff:%Y-%m-%d})")
+    return total
+
+
+def row_key(row):
+    """Chave (created_at, id) de uma linha, a ordem comum aos dois níveis."""
+    return row['created_at'], row['id']
+
+
+def tiered_page(hot, cold, limit):
+    """
+    Até `limit` linhas de dois querysets .values() com a ordem (-created_at, -id) (quente e arquivo).
+
+    Com a página quente cheia, o arquivo só é lido depois da última linha
+    dela (normalmente nenhuma linha: só as transações que esperaram por um
+    job ficam na tabela quente depois do corte).
+    """
+    page = list(hot[:limit])
+    if len(page) == limit:
+        created_at, pk = row_key(page[-1])
+        cold = cold.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+    return list(heapq.merge(page, cold[:limit], key=row_key, reverse=True))[:limit]
+
+
+def find_transaction(transaction_reference, fields):
+    """Transação mais recente com a referência, na tabela quente ou no arquivo (None se não existir)."""
+    for model in (Transaction, TransactionArchive):
+        txn = (
+            model.objects
+            .filter(transaction_reference=transaction_reference)
+            .only(*fields)
+            .order_by('-created_at')
+            .first()
+        )
+        if txn is not None:
+            return txn
+    return None
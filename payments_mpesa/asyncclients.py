@@ -0,0 +1,68 @@
+"""
+httpx.AsyncClient partilhados pelo event loop do servidor ASGI.
+
+Um AsyncClient só pode ser usado no event loop onde foi criado. Sob ASGI o loop
+do servidor vive tanto quanto o processo: gateway/asgi.py regista-o e fecha os
+clientes no shutdown do lifespan. Sob WSGI (ou async_to_sync) cada pedido corre
+num loop novo; um cliente por loop não reutilizaria ligações e ficaria aberto
+até ao GC, por isso os clientes M-Pesa e eMola usam nesse caso a sessão
+síncrona pooled numa thread (is_serving_loop() falso).
+"""
+
+import asyncio
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+_serving_loops = weakref.WeakSet()
+_clients = weakref.WeakKeyDictionary()  # loop -> AsyncClient abertos nesse loop
+_closing = set()  # Tasks de fecho em curso (referência forte até terminarem)
+
+
+def register_serving_loop(loop=None):
+    """Marca o event loop (por omissão o atual) como o loop de longa duração do servidor ASGI."""
+    _serving_loops.add(loop or asyncio.get_running_loop())
+
+
+def is_serving_loop(loop=None):
+    """Indica se o loop (por omissão o atual) é o do servidor ASGI."""
+    if loop is None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+    return loop in _serving_loops
+
+
+def track(client, loop):
+    """Regista um AsyncClient criado no loop para ser fechado no shutdown."""
+    _clients.setdefault(loop, set()).add(client)
+
+
+def close_later(client, loop):
+    """Fecha um AsyncClient no seu loop (a partir de qualquer thread); ignora loops já fechados."""
+    _clients.get(loop, set()).discard(client)
+
+    def close():
+        task = loop.create_task(client.aclose())
+        _closing.add(task)
+        task.add_done_callback(_closing.discard)
+
+    try:
+        loop.call_soon_threadsafe(close)
+    except RuntimeError:
+        pass  # Loop fechado: as ligações já foram libertadas
+
+
+async def aclose_all(loop=None):
+    """Fecha todos os AsyncClient do loop (shutdown do lifespan ASGI)."""
+    loop = loop or asyncio.get_running_loop()
+    _serving_loops.discard(loop)
+    clients = _clients.pop(loop, set())
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Erro ao fechar cliente HTTP assíncrono: {str(e)}")
+    return len(clients)
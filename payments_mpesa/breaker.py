@@ -0,0 +1,235 @@
+"""
+Circuit breakers e timeouts adaptativos por upstream/operação.
+
+Cada operação (M-Pesa C2B na porta 18352, B2C na 18345, cada wscode da eMola)
+tem o seu breaker:
+  - fechado: as chamadas passam; falhas consecutivas (erro de conexão,
+    timeout, HTTP 5xx ou chamada lenta) acima de FAILURE_THRESHOLD abrem-no;
+  - aberto: as chamadas falham de imediato durante RESET_TIMEOUT segundos;
+  - meio-aberto: passam até HALF_OPEN_MAX_CALLS sondas; uma sonda bem-sucedida
+    fecha o circuito, uma falha reabre-o.
+
+Respostas de negócio (ex.: INS-6, INS-2006) não são falhas do upstream.
+
+O timeout de leitura deixa de ser fixo: com amostras suficientes passa a ser o
+percentil TIMEOUT_PERCENTILE das latências observadas (todas as respostas,
+lentas incluídas) x TIMEOUT_MULTIPLIER, limitado entre MIN_TIMEOUT e o
+timeout configurado da operação.
+
+As operações em USSD_OPERATIONS (push USSD do C2B M-Pesa e eMola) esperam
+que o cliente introduza o PIN: a latência mede o cliente, não o upstream.
+Nelas uma chamada lenta não é falha e o timeout é sempre o configurado; só
+erros de transporte e HTTP 5xx contam para o breaker.
+"""
+
+import threading
+import time
+import logging
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BREAKER_CONFIG = {
+    'ENABLED': True,
+    'FAILURE_THRESHOLD': 5,
+    'SLOW_CALL_RATIO': 0.8,
+    'RESET_TIMEOUT': 30,
+    'HALF_OPEN_MAX_CALLS': 1,
+    'WINDOW_SIZE': 200,
+    'MIN_SAMPLES': 50,
+    'TIMEOUT_PERCENTILE': 99,
+    'TIMEOUT_MULTIPLIER': 2.0,
+    'MIN_TIMEOUT': 5,
+    'USSD_OPERATIONS': ('mpesa.c2b', 'emola.pushUsedMessage'),
+    'OVERRIDES': {},
+}
+
+# Configuração aplicada às USSD_OPERATIONS (antes de OVERRIDES)
+USSD_CONFIG = {
+    'SLOW_CALL_AS_FAILURE': False,
+    'ADAPTIVE_TIMEOUT': False,
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def get_breaker_config():
+    """Retorna CIRCUIT_BREAKER_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_BREAKER_CONFIG, **getattr(settings, 'CIRCUIT_BREAKER_CONFIG', {})}
+
+
+def _percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """Breaker thread-safe de uma operação, com janela de latências recentes."""
+
+    def __init__(self, name, max_timeout, config):
+        self.name = name
+        self.max_timeout = float(max_timeout)
+        self.enabled = config['ENABLED']
+        self.failure_threshold = config['FAILURE_THRESHOLD']
+        self.slow_call_as_failure = config.get('SLOW_CALL_AS_FAILURE', True)
+        self.adaptive_timeout = config.get('ADAPTIVE_TIMEOUT', True)
+        self.slow_call_seconds = config.get('SLOW_CALL_SECONDS') or self.max_timeout * config['SLOW_CALL_RATIO']
+        self.reset_timeout = config['RESET_TIMEOUT']
+        self.half_open_max_calls = config['HALF_OPEN_MAX_CALLS']
+        self.min_samples = config['MIN_SAMPLES']
+        self.timeout_percentile = config['TIMEOUT_PERCENTILE']
+        self.timeout_multiplier = config['TIMEOUT_MULTIPLIER']
+        self.min_timeout = min(float(config['MIN_TIMEOUT']), self.max_timeout)
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probes = 0
+        self._latencies = deque(maxlen=config['WINDOW_SIZE'])  # Chamadas respondidas (segundos)
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def allow(self):
+        """Indica se uma chamada pode ser feita agora (reserva uma sonda se meio-aberto)."""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self._probes = 0
+                logger.info(f"Circuit breaker {self.name}: meio-aberto, a enviar sonda")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_max_calls:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record_success(self, latency):
+        """Regista uma chamada respondida pelo upstream (lenta conta como falha, exceto em USSD)."""
+        if self.slow_call_as_failure and latency >= self.slow_call_seconds:
+            logger.warning(f"Circuit breaker {self.name}: chamada lenta ({latency:.1f} s)")
+            with self._lock:
+                # Entra na janela: o timeout adaptativo não pode ignorar as respostas lentas
+                self._latencies.append(latency)
+            self.record_failure()
+            return
+        with self._lock:
+            self.successes += 1
+            self._latencies.append(latency)
+            self.consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.opened_at = None
+                logger.info(f"Circuit breaker {self.name}: fechado (upstream recuperado)")
+
+    def record_failure(self):
+        """Regista uma falha (conexão, timeout, 5xx ou chamada lenta)."""
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.error(
+                    f"Circuit breaker {self.name}: aberto após {self.consecutive_failures} falhas consecutivas"
+                )
+
+    def timeout(self):
+        """Timeout de leitura derivado das latências observadas (o configurado, sem ADAPTIVE_TIMEOUT)."""
+        if not self.adaptive_timeout:
+            return self.max_timeout
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.max_timeout
+            latencies = sorted(self._latencies)
+        adaptive = _percentile(latencies, self.timeout_percentile) * self.timeout_multiplier
+        return max(self.min_timeout, min(self.max_timeout, adaptive))
+
+    def reset(self):
+        """Fecha o circuito e descarta as estatísticas."""
+        with self._lock:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._probes = 0
+            self._latencies.clear()
+            self.successes = self.failures = self.rejected = self.times_opened = 0
+
+    def snapshot(self):
+        """Estado atual e estatísticas (para o endpoint interno)."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            state = self.state
+            retry_in = None
+            if state == OPEN:
+                retry_in = round(max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            data = {
+                'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'retry_in': retry_in,
+                'successes': self.successes,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'times_opened': self.times_opened,
+                'samples': len(latencies),
+            }
+        data['latency'] = {
+            f'p{pct}': round(_percentile(latencies, pct), 3) if latencies else None for pct in (50, 90, 99)
+        }
+        data['timeout'] = round(self.timeout(), 2)
+        data['max_timeout'] = self.max_timeout
+        data['slow_call_seconds'] = round(self.slow_call_seconds, 2) if self.slow_call_as_failure else None
+        data['adaptive_timeout'] = self.adaptive_timeout
+        return data
+
+
+class BreakerRegistry:
+    """Breakers do processo, criados na primeira utilização de cada operação."""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, max_timeout):
+        """
+        Retorna o breaker `name` (ex.: 'mpesa.c2b', 'emola.pushUsedMessage').
+
+        Um timeout máximo diferente (configuração do cliente alterada) cria um breaker novo.
+        """
+        max_timeout = float(max_timeout)
+        breaker = self._breakers.get(name)
+        if breaker is None or breaker.max_timeout != max_timeout:
+            with self._lock:
+                breaker = self._breakers.get(name)
+                if breaker is None or breaker.max_timeout != max_timeout:
+                    config = get_breaker_config()
+                    ussd = USSD_CONFIG if name in config['USSD_OPERATIONS'] else {}
+                    config = {**config, **ussd, **config['OVERRIDES'].get(name, {})}
+                    breaker = self._breakers[name] = CircuitBreaker(name, max_timeout, config)
+        return breaker
+
+    def snapshot(self):
+        """Estado de todos os breakers, por nome."""
+        return {name: breaker.snapshot() for name, breaker in sorted(self._breakers.items())}
+
+    def reset(self):
+        """Remove todos os breakers (ex.: após alterar CIRCUIT_BREAKER_CONFIG)."""
+        with self._lock:
+            self._breakers.clear()
+
+
+breakers = BreakerRegistry()
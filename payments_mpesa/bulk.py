@@ -0,0 +1,218 @@
+"""
+Desembolsos B2C em massa (pagamentos mensais a milhares de beneficiários).
+
+Um lote é gravado de uma só vez: a DisbursementBatch, uma Transaction 'pending'
+por item (bulk_create) e o respetivo PaymentJob. As chamadas ao M-Pesa/eMola
+são feitas pelos workers da fila (manage.py run_payment_worker), com limite de
+concorrência por fornecedor. Um item nunca é pago duas vezes: só é reenviado
+se o pedido anterior não chegou ao fornecedor e, no M-Pesa, depois de uma
+consulta de estado; itens com resultado desconhecido (timeout, worker morto a
+meio) ficam 'pending' até à reconciliação (ver payments_mpesa.jobs).
+"""
+
+import csv
+import io
+import logging
+import uuid
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import Transaction, PaymentJob, DisbursementBatch
+from . import stats
+from .routing import normalize_msisdn, InvalidMsisdn
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BULK_CONFIG = {
+    'MAX_ITEMS': 50000,
+    'INSERT_BATCH_SIZE': 1000,
+}
+
+
+def _max_value(field):
+    """Menor valor que já não cabe no DecimalField (max_digits, decimal_places)."""
+    return Decimal(10) ** (field.max_digits - field.decimal_places)
+
+
+# Limites das colunas Transaction.amount e DisbursementBatch.total_amount
+MAX_AMOUNT = _max_value(Transaction._meta.get_field('amount'))
+MAX_BATCH_TOTAL = _max_value(DisbursementBatch._meta.get_field('total_amount'))
+
+
+class InvalidBatch(ValueError):
+    """Lote rejeitado; `errors` lista os problemas por linha."""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+def get_bulk_config():
+    """Retorna BULK_DISBURSEMENT_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_BULK_CONFIG, **getattr(settings, 'BULK_DISBURSEMENT_CONFIG', {})}
+
+
+def parse_csv(text):
+    """Lê um CSV com cabeçalho msisdn,amount[,reference] e retorna a lista de itens."""
+    reader = csv.DictReader(io.StringIO(text.lstrip('\ufeff'), newline=''))
+    header = {(name or '').strip().lower() for name in reader.fieldnames or []}
+    if not {'msisdn', 'amount'} <= header:
+        raise InvalidBatch("O CSV deve ter as colunas msisdn e amount")
+    return [
+        {(key or '').strip().lower(): (value or '').strip() for key, value in row.items() if key}
+        for row in reader
+    ]
+
+
+def validate_items(items, max_items=None):
+    """
+    Valida e normaliza os itens (msisdn com prefixo 258, valor Decimal finito,
+    positivo, com no máximo 2 casas decimais e dentro de Transaction.amount).
+
+    Todos os erros são recolhidos e o lote é rejeitado por inteiro: um
+    desembolso parcial é mais difícil de reconciliar do que um reenvio.
+    """
+    max_items = max_items or get_bulk_config()['MAX_ITEMS']
+    if not isinstance(items, list) or not items:
+        raise InvalidBatch("O lote não tem itens")
+    if len(items) > max_items:
+        raise InvalidBatch(f"O lote excede {max_items} itens")
+
+    errors = []
+    normalized = []
+    references = set()
+    for row, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            errors.append({'row': row, 'error': 'Item inválido'})
+            continue
+        raw_msisdn = item.get('msisdn') or item.get('phone')
+        reference = str(item.get('reference') or '').strip()
+        try:
+            amount = Decimal(str(item.get('amount') or '').strip())
+        except InvalidOperation:
+            amount = None
+
+        try:
+            msisdn = normalize_msisdn(raw_msisdn)
+        except InvalidMsisdn:
+            errors.append({'row': row, 'error': 'msisdn inválido'})
+            continue
+        # NaN/Infinity: as comparações seguintes levantariam InvalidOperation/TypeError
+        if amount is None or not amount.is_finite() or amount <= 0 or amount.as_tuple().exponent < -2:
+            errors.append({'row': row, 'error': 'amount inválido'})
+            continue
+        if amount >= MAX_AMOUNT:
+            errors.append({'row': row, 'error': f'amount excede o máximo ({MAX_AMOUNT - Decimal("0.01")})'})
+            continue
+        if len(reference) > 20:
+            errors.append({'row': row, 'error': 'Referência excede 20 caracteres'})
+            continue
+        if reference and reference in references:
+            errors.append({'row': row, 'error': 'Referência duplicada no lote'})
+            continue
+        references.add(reference)
+
+        normalized.append({
+            'msisdn': msisdn,
+            'amount': amount,
+            'reference': reference,
+        })
+
+    if errors:
+        raise InvalidBatch(f"{len(errors)} itens inválidos", errors)
+    if sum(item['amount'] for item in normalized) >= MAX_BATCH_TOTAL:
+        raise InvalidBatch("O valor total do lote excede o máximo suportado")
+    return normalized
+
+
+def create_batch(items, provider='mpesa', from_app=None, client_id='', content=''):
+    """Grava o lote, as transações (bulk_create) e os jobs numa única transação de BD."""
+    config = get_bulk_config()
+    with db_transaction.atomic():
+        batch = DisbursementBatch.objects.create(
+            provider=provider,
+            client_id=client_id or '',
+            from_app=from_app,
+            total_items=len(items),
+            total_amount=sum(item['amount'] for item in items).quantize(Decimal('0.01'))
+        )
+        transactions = [
+            Transaction(
+                transaction_type='B2C',
+                provider=provider,
+                transaction_reference=item['reference'] or f"BLK{batch.pk:06d}{index:06d}",
+                # Identificador enviado ao fornecedor (também o transId na eMola), sempre gerado
+                third_party_reference=uuid.uuid4().hex[:20].upper(),
+                customer_msisdn=item['msisdn'],
+                amount=item['amount'],
+                status='pending',
+                message='Desembolso na fila para processamento',
+                from_app=from_app,
+                batch=batch
+            )
+            for index, item in enumerate(items)
+        ]
+        Transaction.objects.bulk_create(transactions, batch_size=config['INSERT_BATCH_SIZE'])
+
+        # Os ids são relidos: o MySQL não os devolve no bulk_create
+        rows = Transaction.objects.filter(batch=batch).values_list(
+            'id', 'transaction_reference', 'third_party_reference', 'customer_msisdn', 'amount'
+        )
+        PaymentJob.objects.bulk_create([
+            PaymentJob(
+                transaction_id=pk,
+                operation='B2C',
+                provider=provider,
+                payload={
+                    'transaction_reference': transaction_reference,
+                    'third_party_reference': third_party_reference,
+                    'customer_msisdn': customer_msisdn,
+                    'amount': str(amount),
+                    'content': content,
+                }
+            )
+            for pk, transaction_reference, third_party_reference, customer_msisdn, amount in rows.iterator()
+        ], batch_size=config['INSERT_BATCH_SIZE'])
+
+        # bulk_create não dispara post_save
+        stats.record_created(transactions)
+
+    logger.info(f"Lote de desembolso #{batch.pk} criado: {batch.total_items} itens, {batch.total_amount} MT ({provider})")
+    return batch
+
+
+def refresh_batch_status(batch_id):
+    """Atualiza o status do lote após a finalização de um dos seus itens."""
+    if Transaction.objects.filter(batch_id=batch_id, status='pending').exists():
+        DisbursementBatch.objects.filter(pk=batch_id, status='queued').update(status='running')
+        return
+    completed = DisbursementBatch.objects.filter(pk=batch_id).exclude(status='completed').update(
+        status='completed', completed_at=timezone.now()
+    )
+    if completed:
+        logger.info(f"Lote de desembolso #{batch_id} concluído")
+
+
+def batch_progress(batch):
+    """Contagens e valores por status dos itens de um lote."""
+    by_status = {}
+    rows = (
+        Transaction.objects.filter(batch=batch)
+        .values('status')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+        .order_by()
+    )
+    for row in rows:
+        by_status[row['status']] = {'count': row['count'], 'amount': row['amount'] or Decimal('0')}
+
+    processed = sum(v['count'] for status, v in by_status.items() if status != 'pending')
+    return {
+        'total_items': batch.total_items,
+        'processed': processed,
+        'percent': round(processed * 100 / batch.total_items, 2) if batch.total_items else 100.0,
+        'by_status': by_status,
+    }
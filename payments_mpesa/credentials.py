@@ -0,0 +1,92 @@
+"""
+Cache de credenciais do M-Pesa partilhado por todo o processo.
+
+A chave pública é carregada uma única vez e o token Bearer (API key cifrada
+com RSA PKCS1v15) é reutilizado até expirar o intervalo de rotação definido em
+MPESA_CONFIG['TOKEN_TTL']. Se a API key ou a chave pública mudarem, o cache é
+reconstruído automaticamente.
+
+Acertos e falhas do cache são exportados em GET /internal/metrics
+(gateway_mpesa_token_cache_total{result}).
+"""
+
+import base64
+import threading
+import time
+import logging
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.backends import default_backend
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Intervalo padrão de rotação do token (segundos)
+DEFAULT_TOKEN_TTL = 3600
+
+
+class CredentialCache:
+    """Cache thread-safe da chave pública carregada e do token cifrado."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._public_key_obj = None
+        self._token = None
+        self._expires_at = 0.0
+
+    def get_token(self, public_key, api_key, ttl=DEFAULT_TOKEN_TTL):
+        """Retorna o token Bearer em cache ou gera um novo se necessário."""
+        fingerprint = (public_key, api_key)
+        now = time.monotonic()
+
+        # Caminho rápido sem lock: token válido para a mesma configuração
+        token = self._token
+        if token is not None and self._fingerprint == fingerprint and now < self._expires_at:
+            metrics.token_cache('hit')
+            return token
+
+        with self._lock:
+            if self._token is not None and self._fingerprint == fingerprint and now < self._expires_at:
+                metrics.token_cache('hit')
+                return self._token
+
+            metrics.token_cache('miss')
+            if self._fingerprint is None or self._fingerprint[0] != public_key:
+                self._public_key_obj = self._load_public_key(public_key)
+
+            encrypted = self._public_key_obj.encrypt(
+                api_key.encode('utf-8'),
+                padding.PKCS1v15()
+            )
+            self._token = base64.b64encode(encrypted).decode('utf-8')
+            self._fingerprint = fingerprint
+            self._expires_at = now + ttl
+            logger.info("Token M-Pesa regenerado (rotação ou configuração alterada)")
+            return self._token
+
+    def invalidate(self):
+        """Descarta o token em cache, forçando nova cifragem no próximo pedido."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def reset(self):
+        """Limpa todo o estado do cache."""
+        with self._lock:
+            self._fingerprint = None
+            self._public_key_obj = None
+            self._token = None
+            self._expires_at = 0.0
+
+    @staticmethod
+    def _load_public_key(public_key):
+        """Formata e carrega a chave pública PEM."""
+        pem = f"-----BEGIN PUBLIC KEY-----\n{public_key}\n-----END PUBLIC KEY-----"
+        return serialization.load_pem_public_key(pem.encode('utf-8'), backend=default_backend())
+
+
+# Instância única partilhada por todo o processo
+credential_cache = CredentialCache()
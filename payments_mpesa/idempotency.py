@@ -0,0 +1,174 @@
+"""
+Idempotência dos pedidos de pagamento (C2B/B2C).
+
+Um cliente que repete um pedido após um timeout não deve provocar um segundo
+push USSD. A chave (header Idempotency-Key ou, na sua falta, a referência da
+transação enviada pelo cliente) é registada numa tabela com índice único antes
+da chamada ao M-Pesa, e a resposta final é guardada para ser devolvida tal e
+qual aos pedidos repetidos. Duplicados concorrentes aguardam pelo pedido
+original em vez de iniciarem outra chamada. As chaves expiram após TTL segundos.
+
+Uma chave cujo dono deixou de responder (lock expirado) nunca é retomada: o
+pedido original pode já ter chegado ao fornecedor e o cliente pode ter pago.
+A chave fica 'ambiguous' (resposta 409) até a reconciliação a resolver pela
+referência do pedido ao fornecedor guardada na chave.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDEMPOTENCY_CONFIG = {
+    'TTL': 86400,
+    'LOCK_SECONDS': 150,
+    'WAIT_TIMEOUT': 120,
+    'POLL_INTERVAL': 0.25,
+    'PURGE_BATCH_SIZE': 1000,
+}
+
+# Resultados de claim_key
+CLAIMED = 'claimed'          # Este pedido é o original: deve executar e chamar complete_key
+REPLAY = 'replay'            # Já existe resposta final guardada
+IN_PROGRESS = 'in_progress'  # O original ainda está em curso
+AMBIGUOUS = 'ambiguous'      # O original deixou de responder: resultado desconhecido
+MISMATCH = 'mismatch'        # Chave reutilizada com um corpo diferente
+
+
+def get_idempotency_config():
+    """Retorna IDEMPOTENCY_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_IDEMPOTENCY_CONFIG, **getattr(settings, 'IDEMPOTENCY_CONFIG', {})}
+
+
+def make_key(operation, client_id, key):
+    """Chave armazenada: isolada por operação e por cliente OAuth."""
+    return hashlib.sha256(f"{operation}:{client_id}:{key}".encode('utf-8')).hexdigest()
+
+
+def hash_request(data):
+    """Impressão digital do corpo do pedido (independente da ordem dos campos)."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def claim_key(key, operation, request_hash, config=None, provider='', upstream_reference=''):
+    """
+    Tenta tornar este pedido o dono da chave.
+
+    Retorna (resultado, IdempotencyKey) com resultado CLAIMED, REPLAY,
+    IN_PROGRESS, AMBIGUOUS ou MISMATCH. A inserção depende do índice único,
+    portanto dois pedidos concorrentes (mesmo em workers diferentes) nunca
+    obtêm ambos CLAIMED. `upstream_reference` é a referência que o dono vai
+    enviar ao fornecedor (consultada pela reconciliação).
+    """
+    config = config or get_idempotency_config()
+    for _ in range(3):
+        now = timezone.now()
+        try:
+            with db_transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    key=key,
+                    operation=operation,
+                    request_hash=request_hash,
+                    provider=provider,
+                    upstream_reference=upstream_reference,
+                    locked_until=now + timedelta(seconds=config['LOCK_SECONDS']),
+                    expires_at=now + timedelta(seconds=config['TTL'])
+                )
+            return CLAIMED, record
+        except IntegrityError:
+            pass
+
+        record = IdempotencyKey.objects.filter(key=key).first()
+        if record is None:
+            continue  # Apagada entretanto: tenta inserir de novo
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at__lte=now).delete()
+            continue
+        if record.request_hash != request_hash:
+            return MISMATCH, record
+        if record.status == 'completed':
+            return REPLAY, record
+        if record.status == 'ambiguous':
+            return AMBIGUOUS, record
+
+        # Dono inativo (processo terminou a meio): o lock excede o READ_TIMEOUT do M-Pesa
+        if record.locked_until is not None and record.locked_until < now:
+            if mark_key_ambiguous(record):
+                logger.warning(f"Chave de idempotência {operation} com lock expirado marcada como ambígua: {key[:12]}")
+            continue
+        return IN_PROGRESS, record
+
+    return IN_PROGRESS, record
+
+
+def complete_key(record, status_code, body):
+    """Guarda a resposta final do pedido original para replay."""
+    IdempotencyKey.objects.filter(pk=record.pk).update(
+        status='completed',
+        response_status=status_code,
+        response_body=body,
+        locked_until=None
+    )
+
+
+def release_key(record):
+    """Liberta uma chave sem resposta final cujo pedido não chegou ao fornecedor, permitindo nova tentativa."""
+    IdempotencyKey.objects.filter(pk=record.pk).exclude(status='completed').delete()
+
+
+def mark_key_ambiguous(record):
+    """Chave sem resposta final cujo pedido pode ter chegado ao fornecedor: fica para a reconciliação."""
+    return IdempotencyKey.objects.filter(pk=record.pk, status='in_progress').update(
+        status='ambiguous',
+        locked_until=None
+    )
+
+
+async def aclaim_key(key, operation, request_hash, provider='', upstream_reference=''):
+    """
+    Versão assíncrona de claim_key que aguarda (até WAIT_TIMEOUT) enquanto
+    o pedido original estiver em curso.
+    """
+    config = get_idempotency_config()
+    deadline = time.monotonic() + config['WAIT_TIMEOUT']
+    while True:
+        outcome, record = await sync_to_async(claim_key)(
+            key, operation, request_hash, config, provider, upstream_reference
+        )
+        if outcome != IN_PROGRESS or time.monotonic() >= deadline:
+            return outcome, record
+        await asyncio.sleep(config['POLL_INTERVAL'])
+
+
+def purge_expired_keys(batch_size=None, now=None):
+    """
+    Apaga as chaves de idempotência expiradas em lotes.
+
+    Retorna o número total de linhas apagadas.
+    """
+    batch_size = batch_size or get_idempotency_config()['PURGE_BATCH_SIZE']
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            IdempotencyKey.objects.filter(expires_at__lte=now)
+            .order_by('expires_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        deleted, _ = IdempotencyKey.objects.filter(id__in=ids).delete()
+        total += deleted
+        logger.info(f"Chaves de idempotência expiradas apagadas: {deleted} (total {total})")
+    return total
@@ -0,0 +1,300 @@
+"""
+Fila de pagamentos baseada na base de dados (modo aceitar-e-processar).
+
+O endpoint C2B grava uma Transaction 'pending' e um PaymentJob e responde 202
+de imediato. Workers (manage.py run_payment_worker) reclamam jobs com leases.
+
+Um pedido que pode ter chegado ao fornecedor nunca é reenviado (um segundo
+USSD pode cobrar o cliente duas vezes; um B2C repetido paga duas vezes):
+  - só falhas sem envio (conexão recusada, timeout de conexão, circuito
+    aberto) voltam à fila, com backoff;
+  - timeouts de leitura, conexões cortadas e jobs 'running' cujo lease expirou
+    (worker morto a meio da chamada) ficam 'ambiguous', com a Transaction
+    'pending'; a reconciliação (payments_mpesa.reconciliation) consulta o
+    estado no M-Pesa e finaliza-os. Os desembolsos eMola ambíguos ficam
+    'pending' para verificação manual.
+
+Os jobs têm um fornecedor (M-Pesa ou eMola); o worker limita as chamadas em
+paralelo de cada um (PROVIDER_CONCURRENCY). Os desembolsos em massa
+(payments_mpesa.bulk) usam a mesma fila. Antes de reenviar um desembolso B2C
+do M-Pesa já tentado, o estado é consultado pela third_party_reference: o
+item só é reenviado se o M-Pesa não o conhecer (INS-10).
+"""
+
+import logging
+import socket
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from payments_emola.emola import EmolaClient
+
+from .models import Transaction, PaymentJob
+from .mpesa import Mpesa
+from .bulk import refresh_batch_status
+from . import reconciliation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_CONFIG = {
+    'ENABLED': False,
+    'LEASE_SECONDS': 150,
+    'MAX_ATTEMPTS': 3,
+    'RETRY_BACKOFF': 30,
+    'BATCH_SIZE': 10,
+    'POLL_INTERVAL': 1.0,
+    'PROVIDER_CONCURRENCY': {'mpesa': 10, 'emola': 5},
+}
+
+AMBIGUOUS_MESSAGE = 'Resultado desconhecido: a aguardar consulta de estado no fornecedor'
+
+
+def get_queue_config():
+    """Retorna PAYMENT_QUEUE_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_QUEUE_CONFIG, **getattr(settings, 'PAYMENT_QUEUE_CONFIG', {})}
+
+
+def default_worker_id():
+    """Identificador do worker: host + PID."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_payment(operation, transaction_reference, third_party_reference, customer_msisdn, amount, from_app=None,
+                    provider='mpesa'):
+    """Cria a Transaction 'pending' e o respetivo job numa única transação de BD."""
+    with db_transaction.atomic():
+        txn = Transaction.objects.create(
+            transaction_type=operation,
+            provider=provider,
+            transaction_reference=transaction_reference,
+            third_party_reference=third_party_reference,
+            customer_msisdn=customer_msisdn,
+            amount=amount,
+            status='pending',
+            message='Pagamento na fila para processamento',
+            from_app=from_app
+        )
+        job = PaymentJob.objects.create(
+            transaction=txn,
+            operation=operation,
+            provider=provider,
+            payload={
+                'transaction_reference': transaction_reference,
+                'third_party_reference': third_party_reference,
+                'customer_msisdn': customer_msisdn,
+                'amount': str(amount),
+            }
+        )
+    logger.info("Pagamento %s enfileirado: job #%s, ref %s", operation, job.pk, transaction_reference,
+                extra={'reference': transaction_reference})
+    return txn, job
+
+
+def claim_jobs(worker_id, limit, lease_seconds, provider=None):
+    """
+    Reclama até `limit` jobs disponíveis para este worker (de um só fornecedor, se indicado).
+
+    Cada job é reclamado com um UPDATE condicional, portanto dois workers nunca
+    obtêm o mesmo job, mesmo em bases sem SELECT ... SKIP LOCKED (ex.: SQLite).
+    """
+    now = timezone.now()
+    claimable = Q(status='queued', available_at__lte=now)
+    if provider:
+        claimable &= Q(provider=provider)
+    candidate_ids = list(
+        PaymentJob.objects.filter(claimable)
+        .order_by('available_at', 'id')
+        .values_list('id', flat=True)[:limit]
+    )
+
+    claimed = []
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+    for job_id in candidate_ids:
+        updated = PaymentJob.objects.filter(claimable, id=job_id).update(
+            status='running',
+            locked_by=worker_id,
+            lease_expires_at=lease_expires_at,
+            updated_at=now
+        )
+        if updated:
+            claimed.append(job_id)
+
+    return list(PaymentJob.objects.filter(id__in=claimed, locked_by=worker_id).select_related('transaction'))
+
+
+def expire_leases(now=None):
+    """
+    Marca como 'ambiguous' os jobs 'running' cujo lease expirou.
+
+    O worker pode ter morrido depois de enviar o pedido: o job não é
+    reclamado de novo e fica para a reconciliação. Retorna o número de jobs.
+    """
+    now = now or timezone.now()
+    expired = Q(status='running', lease_expires_at__lt=now)
+    job_ids = list(PaymentJob.objects.filter(expired).values_list('id', flat=True))
+    if not job_ids:
+        return 0
+    with db_transaction.atomic():
+        updated = PaymentJob.objects.filter(expired, id__in=job_ids).update(
+            status='ambiguous',
+            locked_by='',
+            lease_expires_at=None,
+            last_error='Lease expirado durante a chamada ao fornecedor',
+            updated_at=now
+        )
+        Transaction.objects.filter(jobs__id__in=job_ids, status='pending').update(
+            message=AMBIGUOUS_MESSAGE, updated_at=now
+        )
+    if updated:
+        logger.warning(f"{updated} jobs com lease expirado marcados como ambíguos")
+    return updated
+
+
+def apply_mpesa_result(txn, response):
+    """Atualiza a Transaction com o resultado devolvido pelo cliente M-Pesa."""
+    payload = response.get('response') or {}
+    txn.status = 'success' if response.get('success', False) else 'error'
+    txn.message = response.get('error_message')
+    txn.raw_response = response.get('response')
+    if txn.status == 'success' and txn.provider == 'emola':
+        txn.transaction_id = payload.get('requestId')
+    elif txn.status == 'success':
+        txn.transaction_id = payload.get('output_TransactionID')
+        txn.conversation_id = payload.get('output_ConversationID')
+    # raw_response é gravado em TransactionPayload pelo sinal post_save
+    txn.save(update_fields=['status', 'message', 'response_code', 'transaction_id', 'conversation_id', 'updated_at'])
+
+
+def _emola_response(result):
+    """Converte o SoapResult da eMola no formato de resposta do cliente M-Pesa."""
+    answered = result.error_code is not None or result.gateway_error or result.status_code != 200
+    if result.error == 'Circuit open':
+        answered = False
+    return {
+        'status': result.status_code,
+        'response': result.to_dict() if answered else None,  # None: sem resposta
+        'success': result.ok,
+        'error_message': result.message if result.error_code is not None else (result.description or result.error),
+        # Pedido não enviado: pode ser repetido após o backoff
+        'retryable': result.error in ('Circuit open', 'Connection failed'),
+    }
+
+
+def _call_provider(job, mpesa=None):
+    """Executa a chamada do job no fornecedor respetivo."""
+    payload = job.payload
+    if job.provider == 'emola':
+        if job.operation != 'B2C':
+            raise ValueError(f"Operação {job.operation} não suportada na fila eMola")
+        # transId gerado (third_party_reference): a referência do cliente não é única na eMola
+        result = EmolaClient.get_instance().push_used_disbursement_b2c(
+            payload['customer_msisdn'],
+            payload['amount'],
+            payload['third_party_reference'],
+            payload.get('content', '')
+        )
+        return _emola_response(result)
+
+    mpesa = mpesa or Mpesa.get_instance()
+    call = mpesa.c2b if job.operation == 'C2B' else mpesa.b2c
+    return call(
+        payload['transaction_reference'],
+        payload['customer_msisdn'],
+        payload['amount'],
+        payload['third_party_reference']
+    )
+
+
+def mark_ambiguous(job, error):
+    """Job sem resultado conhecido: a Transaction fica 'pending' até à reconciliação."""
+    txn = job.transaction
+    with db_transaction.atomic():
+        txn.message = AMBIGUOUS_MESSAGE
+        txn.save(update_fields=['message', 'updated_at'])
+        job.status = 'ambiguous'
+        job.locked_by = ''
+        job.lease_expires_at = None
+        job.last_error = error or ''
+        job.save(update_fields=['status', 'attempts', 'locked_by', 'lease_expires_at', 'last_error', 'updated_at'])
+    logger.warning("Job #%s ambíguo (%s): %s", job.pk, txn.transaction_reference, job.last_error,
+                   extra={'reference': txn.transaction_reference})
+
+
+def _resolve_before_resend(job, mpesa=None):
+    """
+    Consulta um B2C M-Pesa já tentado; retorna True se já ficou resolvido (não reenviar).
+
+    Resultado definitivo: aplicado à Transaction e o job termina. Estado
+    desconhecido: o job fica ambíguo para a reconciliação.
+    """
+    txn = job.transaction
+    state, response = reconciliation.query_before_resend(txn, mpesa)
+    if state == 'not_found':
+        return False
+    if state is None:
+        mark_ambiguous(job, f"Estado desconhecido antes do reenvio: {response.get('error_message') or ''}".strip())
+        return True
+    with db_transaction.atomic():
+        reconciliation.apply_query_result(txn, response, reconciliation.get_reconciliation_config(), timezone.now())
+        txn.save(update_fields=reconciliation.UPDATE_FIELDS)
+        job.status = 'done' if txn.status == 'success' else 'failed'
+        job.locked_by = ''
+        job.lease_expires_at = None
+        job.last_error = '' if txn.status == 'success' else 'Resolvido pela consulta de estado antes do reenvio'
+        job.save(update_fields=['status', 'locked_by', 'lease_expires_at', 'last_error', 'updated_at'])
+    logger.info("Job #%s resolvido pela consulta de estado: %s (%s)", job.pk, txn.status, txn.transaction_reference,
+                extra={'reference': txn.transaction_reference})
+    if txn.batch_id:
+        refresh_batch_status(txn.batch_id)
+    return True
+
+
+def process_job(job, mpesa=None, config=None):
+    """Executa a chamada ao fornecedor de um job reclamado e finaliza a Transaction."""
+    config = config or get_queue_config()
+
+    # Um desembolso já tentado só é reenviado se o M-Pesa não o conhecer
+    if job.operation == 'B2C' and job.provider == 'mpesa' and job.attempts > 0:
+        if _resolve_before_resend(job, mpesa):
+            return None
+
+    job.attempts += 1
+    try:
+        response = _call_provider(job, mpesa)
+    except Exception as e:
+        logger.error(f"Erro ao processar job #{job.pk}: {str(e)}")
+        response = {'status': 500, 'response': None, 'success': False, 'error_message': str(e)}
+
+    answered = response.get('response') is not None or response.get('success', False)
+    # Só pedidos que não chegaram ao fornecedor podem ser repetidos
+    retryable = not answered and response.get('retryable', False)
+    if not answered and not retryable:
+        mark_ambiguous(job, response.get('error_message'))
+        return response
+    if retryable and job.attempts < config['MAX_ATTEMPTS']:
+        job.status = 'queued'
+        job.available_at = timezone.now() + timedelta(seconds=config['RETRY_BACKOFF'] * job.attempts)
+        job.locked_by = ''
+        job.lease_expires_at = None
+        job.last_error = response.get('error_message') or ''
+        job.save(update_fields=['status', 'attempts', 'available_at', 'locked_by', 'lease_expires_at', 'last_error', 'updated_at'])
+        logger.warning(f"Job #{job.pk} reagendado (tentativa {job.attempts}): {job.last_error}")
+        return response
+
+    with db_transaction.atomic():
+        apply_mpesa_result(job.transaction, response)
+        job.status = 'done' if response.get('success', False) else 'failed'
+        job.locked_by = ''
+        job.lease_expires_at = None
+        job.last_error = '' if response.get('success', False) else (response.get('error_message') or '')
+        job.save(update_fields=['status', 'attempts', 'locked_by', 'lease_expires_at', 'last_error', 'updated_at'])
+
+    reference = job.transaction.transaction_reference
+    logger.info("Job #%s finalizado: %s (%s)", job.pk, job.status, reference, extra={'reference': reference})
+    if job.transaction.batch_id:
+        refresh_batch_status(job.transaction.batch_id)
+    return response
@@ -0,0 +1,36 @@
+"""
+Move as transações antigas para o arquivo comprimido (TransactionArchive), em lotes.
+
+Uso (ex.: via cron uma vez por dia):
+    python manage.py archive_transactions                 # ARCHIVE_CONFIG['HOT_MONTHS']
+    python manage.py archive_transactions --months 12 --batch-size 500 --max-batches 100
+    python manage.py archive_transactions --dry-run
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments_mpesa.archive import archive_transactions, archive_cutoff, archivable, blocked_transactions
+
+
+class Command(BaseCommand):
+    help = "Arquiva as transações anteriores ao início do mês de há N meses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=None, help="Meses completos mantidos na tabela quente")
+        parser.add_argument('--batch-size', type=int, default=None, help="Linhas movidas por lote")
+        parser.add_argument('--max-batches', type=int, default=None, help="Limite de lotes nesta execução")
+        parser.add_argument('--dry-run', action='store_true', help="Só conta as linhas a arquivar")
+
+    def handle(self, *args, **options):
+        if options['months'] is not None and options['months'] < 0:
+            raise CommandError("--months não pode ser negativo")
+        cutoff = archive_cutoff(options['months'])
+        if options['dry_run']:
+            count = archivable(cutoff).count()
+            self.stdout.write(f"{count} transações anteriores a {cutoff:%Y-%m-%d} seriam arquivadas")
+            skipped = blocked_transactions(cutoff).count()
+            if skipped:
+                self.stdout.write(f"{skipped} transações ficam na tabela quente por terem jobs por processar")
+            return
+        total = archive_transactions(options['months'], options['batch_size'], options['max_batches'])
+        self.stdout.write(self.style.SUCCESS(f"{total} transações anteriores a {cutoff:%Y-%m-%d} arquivadas"))
@@ -0,0 +1,54 @@
+"""
+Exporta as transações (M-Pesa e eMola) em CSV ou NDJSON, em streaming.
+
+Uso:
+    python manage.py export_transactions --date-from 2025-01-01 --date-to 2025-03-31 -o t1.csv.gz --gzip
+    python manage.py export_transactions --format ndjson --status success > sucesso.ndjson
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from payments_mpesa.export import parse_filters, export_stream, InvalidExport, FORMATS, SOURCES
+
+
+class Command(BaseCommand):
+    help = "Exporta as transações em CSV/NDJSON com memória constante."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--gzip', action='store_true', help="Comprime a saída (gzip)")
+        parser.add_argument('-o', '--output', help="Ficheiro de saída (padrão: stdout)")
+        parser.add_argument('--date-from', help="Data inicial (inclusiva) ou data/hora ISO")
+        parser.add_argument('--date-to', help="Data final (inclusiva) ou data/hora ISO")
+        parser.add_argument('--type', help="C2B ou B2C")
+        parser.add_argument('--status', help="success, error ou pending")
+        parser.add_argument('--from-app', help="App de origem")
+        parser.add_argument('--source', choices=SOURCES, default='all')
+        parser.add_argument('--include-raw', action='store_true', help="Inclui raw_response")
+
+    def handle(self, *args, **options):
+        try:
+            filters = parse_filters({
+                'date_from': options['date_from'],
+                'date_to': options['date_to'],
+                'type': options['type'],
+                'status': options['status'],
+                'from_app': options['from_app'],
+                'source': options['source'],
+                'include_raw': options['include_raw'],
+            })
+            stream = export_stream(filters, options['format'], options['gzip'])
+        except InvalidExport as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in stream:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
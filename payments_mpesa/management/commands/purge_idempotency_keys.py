@@ -0,0 +1,21 @@
+"""
+Apaga as chaves de idempotência expiradas em lotes.
+
+Uso (ex.: via cron a cada hora):
+    python manage.py purge_idempotency_keys --batch-size 1000
+"""
+
+from django.core.management.base import BaseCommand
+
+from payments_mpesa.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = "Apaga os registos IdempotencyKey expirados em lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Linhas apagadas por lote")
+
+    def handle(self, *args, **options):
+        total = purge_expired_keys(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"{total} chaves de idempotência expiradas apagadas"))
@@ -0,0 +1,21 @@
+"""
+Apaga os tokens OAuth expirados em lotes.
+
+Uso (ex.: via cron a cada hora):
+    python manage.py purge_oauth_tokens --batch-size 1000
+"""
+
+from django.core.management.base import BaseCommand
+
+from payments_mpesa.tokens import purge_expired_tokens
+
+
+class Command(BaseCommand):
+    help = "Apaga os registos OAuthToken expirados em lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Linhas apagadas por lote")
+
+    def handle(self, *args, **options):
+        total = purge_expired_tokens(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"{total} tokens expirados apagados"))
@@ -0,0 +1,21 @@
+"""
+Apaga os token buckets inativos (já recarregados por completo) em lotes.
+
+Uso (ex.: via cron a cada hora):
+    python manage.py purge_rate_limit_buckets --batch-size 1000
+"""
+
+from django.core.management.base import BaseCommand
+
+from payments_mpesa.ratelimit import purge_idle_buckets
+
+
+class Command(BaseCommand):
+    help = "Apaga os registos RateLimitBucket inativos em lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Linhas apagadas por lote")
+
+    def handle(self, *args, **options):
+        total = purge_idle_buckets(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"{total} token buckets inativos apagados"))
@@ -0,0 +1,53 @@
+"""
+Reconstrói o rollup diário TransactionDailyStats a partir das transações.
+
+Correr com os processos web e os workers de pagamentos parados: os deltas ainda
+nos buffers deles (DAILY_STATS_CONFIG['FLUSH_INTERVAL']) já estão refletidos
+nas linhas recontadas e seriam somados outra vez.
+
+Uso:
+    python manage.py rebuild_transaction_stats                  # todo o histórico
+    python manage.py rebuild_transaction_stats --from 2025-10-01 --to 2025-10-31
+"""
+
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from payments_mpesa.models import Transaction, TransactionArchive
+from payments_mpesa.stats import rebuild_day
+
+
+class Command(BaseCommand):
+    help = "Backfill/reconstrução do rollup diário de transações, um dia de cada vez (com os workers parados)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', default=None, help="Data inicial (AAAA-MM-DD)")
+        parser.add_argument('--to', dest='date_to', default=None, help="Data final inclusiva (AAAA-MM-DD)")
+
+    def handle(self, *args, **options):
+        try:
+            date_from = date.fromisoformat(options['date_from']) if options['date_from'] else None
+            date_to = date.fromisoformat(options['date_to']) if options['date_to'] else timezone.localdate()
+        except ValueError as e:
+            raise CommandError(f"Data inválida: {e}")
+
+        if date_from is None:
+            # O arquivo tem as transações mais antigas
+            first = (TransactionArchive.objects.aggregate(first=Min('created_at'))['first']
+                     or Transaction.objects.aggregate(first=Min('created_at'))['first'])
+            if first is None:
+                self.stdout.write("Nenhuma transação encontrada")
+                return
+            date_from = timezone.localdate(first)
+
+        day = date_from
+        days = 0
+        while day <= date_to:
+            rebuild_day(day)
+            days += 1
+            day += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f"Rollup reconstruído para {days} dia(s): {date_from} a {date_to}"))
@@ -0,0 +1,64 @@
+"""
+Reconcilia as transações M-Pesa com resultado ambíguo (INS-9 ou sem resposta) e
+resolve as chaves de idempotência C2B sem resposta final. Cada ciclo aplica
+também os callbacks eMola gravados e ainda não aplicados.
+
+Uso:
+    python manage.py reconcile_transactions              # contínuo
+    python manage.py reconcile_transactions --once       # um ciclo (ex.: via cron)
+"""
+
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+
+from payments_emola.callbacks import apply_pending
+from payments_mpesa.reconciliation import (
+    find_candidates, reconcile_batch, resolve_ambiguous_keys, get_reconciliation_config,
+)
+
+logger = logging.getLogger('payments_mpesa')
+
+
+class Command(BaseCommand):
+    help = "Consulta o estado no M-Pesa das transações com resultado ambíguo e atualiza-as."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Processa os candidatos atuais e termina")
+        parser.add_argument('--batch-size', type=int, default=None, help="Transações por lote")
+        parser.add_argument('--concurrency', type=int, default=None, help="Consultas ao M-Pesa em paralelo")
+
+    def handle(self, *args, **options):
+        config = get_reconciliation_config()
+        if options['batch_size']:
+            config['BATCH_SIZE'] = options['batch_size']
+        if options['concurrency']:
+            config['CONCURRENCY'] = options['concurrency']
+
+        totals = {'resolved': 0, 'success': 0, 'retry': 0, 'skipped': 0}
+        try:
+            while True:
+                candidates = find_candidates(config['BATCH_SIZE'], config)
+                summary = reconcile_batch(candidates, config=config) if candidates else None
+                # Depois do lote: as chaves das linhas acabadas de resolver já têm resposta
+                resolve_ambiguous_keys(config=config)
+                # Callbacks eMola gravados que nenhum processo web chegou a aplicar
+                apply_pending()
+                if summary:
+                    for key in totals:
+                        totals[key] += summary[key]
+
+                # Lote incompleto ou circuito aberto: espera antes do próximo ciclo
+                idle = not candidates or len(candidates) < config['BATCH_SIZE'] or summary['skipped']
+                if options['once'] and idle:
+                    break
+                if idle:
+                    time.sleep(config['INTERVAL'])
+        except KeyboardInterrupt:
+            self.stdout.write("A terminar...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciliação: {totals['resolved']} resolvidas ({totals['success']} pagas), "
+            f"{totals['retry']} a repetir, {totals['skipped']} ignoradas"
+        ))
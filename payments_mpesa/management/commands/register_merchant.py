@@ -0,0 +1,59 @@
+"""
+Regista uma app comerciante e as suas carteiras; o segredo é mostrado uma única vez.
+
+Uso:
+    python manage.py register_merchant CartaFacil --wallet mpesa:132722 --wallet emola:989473
+    python manage.py register_merchant CartaFacil --client-id <id existente> --rotate-secret
+"""
+
+import secrets
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from payments_mpesa.models import Merchant, Wallet, Transaction
+
+
+def parse_wallet(value):
+    provider, _, wallet_id = value.partition(':')
+    if provider not in dict(Transaction.PROVIDERS) or not wallet_id.isdigit():
+        raise CommandError(f"Carteira inválida: {value} (formato provider:wallet_id, ex.: mpesa:132722)")
+    return provider, int(wallet_id)
+
+
+class Command(BaseCommand):
+    help = "Cria (ou atualiza) um Merchant com segredo gerado e associa carteiras."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="Nome da app comerciante")
+        parser.add_argument('--client-id', help="client_id (padrão: UUID gerado)")
+        parser.add_argument('--wallet', action='append', default=[], help="provider:wallet_id (repetível)")
+        parser.add_argument('--rotate-secret', action='store_true', help="Gera um novo segredo para um client_id existente")
+
+    def handle(self, *args, **options):
+        wallets = [parse_wallet(value) for value in options['wallet']]
+        client_id = options['client_id'] or str(uuid.uuid4())
+        secret = None
+        with transaction.atomic():
+            merchant = Merchant.objects.filter(client_id=client_id).first()
+            if merchant is None:
+                merchant = Merchant(name=options['name'], client_id=client_id)
+            elif not options['rotate_secret'] and not wallets:
+                raise CommandError(f"client_id {client_id} já existe (use --rotate-secret ou --wallet)")
+            else:
+                merchant.name = options['name']
+            if merchant.pk is None or options['rotate_secret']:
+                secret = secrets.token_urlsafe(30)
+                merchant.set_secret(secret)
+            merchant.save()
+            for provider, wallet_id in wallets:
+                wallet = Wallet.objects.filter(wallet_id=wallet_id).first()
+                if wallet is not None and wallet.merchant_id != merchant.pk:
+                    raise CommandError(f"Carteira {wallet_id} já pertence a {wallet.merchant}")
+                Wallet.objects.update_or_create(wallet_id=wallet_id,
+                                                defaults={'merchant': merchant, 'provider': provider})
+
+        self.stdout.write(self.style.SUCCESS(f"Comerciante {merchant.name}: client_id={client_id}"))
+        if secret:
+            self.stdout.write(f"client_secret={secret} (guardado apenas o hash; não é possível recuperá-lo)")
@@ -0,0 +1,76 @@
+"""
+Worker da fila de pagamentos (M-Pesa e desembolsos eMola).
+
+A concorrência total é limitada por --concurrency e, dentro dela, cada
+fornecedor por PAYMENT_QUEUE_CONFIG['PROVIDER_CONCURRENCY'].
+
+Uso:
+    python manage.py run_payment_worker --concurrency 20
+"""
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from payments_mpesa.jobs import claim_jobs, expire_leases, process_job, get_queue_config, default_worker_id
+
+logger = logging.getLogger('payments_mpesa')
+
+
+def _run(job, config):
+    """Processa um job numa thread do pool, libertando a conexão à BD no fim."""
+    try:
+        return process_job(job, config=config)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "Processa os jobs de pagamento enfileirados (modo aceitar-e-processar)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--worker-id', default=None, help="Identificador do worker (padrão: host:pid)")
+        parser.add_argument('--concurrency', type=int, default=10, help="Chamadas aos fornecedores em paralelo")
+        parser.add_argument('--once', action='store_true', help="Processa os jobs disponíveis e termina")
+
+    def handle(self, *args, **options):
+        config = get_queue_config()
+        worker_id = options['worker_id'] or default_worker_id()
+        concurrency = options['concurrency']
+        provider_limits = config['PROVIDER_CONCURRENCY']
+        in_flight = {}  # future -> fornecedor
+
+        self.stdout.write(f"Worker {worker_id} iniciado (concorrência {concurrency}, por fornecedor {provider_limits})")
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            try:
+                while True:
+                    expire_leases()
+                    claimed = 0
+                    for provider, limit in provider_limits.items():
+                        busy = sum(1 for p in in_flight.values() if p == provider)
+                        free = min(limit - busy, concurrency - len(in_flight))
+                        if free <= 0:
+                            continue
+                        jobs = claim_jobs(worker_id, min(free, config['BATCH_SIZE']), config['LEASE_SECONDS'], provider)
+                        for job in jobs:
+                            in_flight[pool.submit(_run, job, config)] = provider
+                        claimed += len(jobs)
+
+                    if options['once'] and not claimed and not in_flight:
+                        break
+
+                    if in_flight:
+                        done, _ = wait(in_flight, timeout=config['POLL_INTERVAL'], return_when=FIRST_COMPLETED)
+                        for future in done:
+                            in_flight.pop(future)
+                            if future.exception():
+                                logger.error(f"Erro inesperado no worker: {future.exception()}")
+                    else:
+                        time.sleep(config['POLL_INTERVAL'])
+            except KeyboardInterrupt:
+                self.stdout.write("A terminar: aguardando jobs em curso...")
+
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker_id} terminado"))
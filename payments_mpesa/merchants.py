@@ -0,0 +1,187 @@
+"""
+Registo em memória dos comerciantes (Merchant) e das suas carteiras (Wallet).
+
+Cada processo mantém um snapshot imutável com dicionários indexados por
+client_id e por wallet_id, pelo que validar o cliente e a carteira no caminho
+de pagamento não consulta a base de dados. O snapshot tem uma versão (número
+de linhas e updated_at mais recente das duas tabelas), verificada no máximo a
+cada CHECK_INTERVAL segundos; quando muda, o snapshot é recarregado sem
+reiniciar o processo. Alterações feitas no próprio processo (admin, shell)
+invalidam-no de imediato pelos sinais post_save/post_delete.
+
+O hash do segredo (PBKDF2) é lento de propósito: um segredo verificado há
+menos de VERIFY_TTL segundos para o mesmo secret_hash é aceite sem repetir o
+hash (cache LRU indexada pelo SHA-256 do segredo, nunca em claro).
+
+O snapshot guarda também as tabelas de prefixos já compiladas (base e por
+comerciante com routing_rules) usadas pelo roteamento M-Pesa/eMola.
+"""
+
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.db.models import Count, Max
+
+from .models import Merchant, Wallet
+from .routing import compile_routes, UnroutableMsisdn
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MERCHANT_REGISTRY_CONFIG = {
+    'CHECK_INTERVAL': 5,
+    'VERIFY_CACHE_SIZE': 10000,
+    'VERIFY_TTL': 300,
+}
+
+MerchantEntry = namedtuple('MerchantEntry', ['id', 'client_id', 'name', 'secret_hash', 'routing_rules'])
+WalletEntry = namedtuple('WalletEntry', ['wallet_id', 'provider', 'client_id'])
+
+
+def get_merchant_registry_config():
+    """Retorna MERCHANT_REGISTRY_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_MERCHANT_REGISTRY_CONFIG, **getattr(settings, 'MERCHANT_REGISTRY_CONFIG', {})}
+
+
+class RegistrySnapshot:
+    """Comerciantes e carteiras ativos numa versão do registo (só leitura)."""
+
+    def __init__(self, version, merchants, wallets, routes):
+        self.version = version
+        self.merchants = merchants  # client_id -> MerchantEntry
+        self.wallets = wallets  # wallet_id -> WalletEntry
+        self.routes = routes  # Tabela de prefixos base
+        self.merchant_routes = {
+            merchant.client_id: routes.with_overrides(merchant.routing_rules)
+            for merchant in merchants.values() if merchant.routing_rules
+        }
+        # (client_id, provider) -> carteira de menor wallet_id
+        self.provider_wallets = {}
+        for wallet in sorted(wallets.values(), key=lambda w: w.wallet_id):
+            self.provider_wallets.setdefault((wallet.client_id, wallet.provider), wallet)
+
+    def merchant(self, client_id):
+        return self.merchants.get(client_id)
+
+    def check_wallet(self, wallet_id, client_id, provider=None):
+        """Retorna None se a carteira é válida para o cliente, ou o motivo da recusa."""
+        wallet = self.wallets.get(int(wallet_id))
+        if wallet is None:
+            return "carteira inexistente ou inativa"
+        if wallet.client_id != client_id:
+            return f"carteira não pertence ao cliente {client_id}"
+        if provider is not None and wallet.provider != provider:
+            return f"carteira {wallet.provider}, pedido {provider}"
+        return None
+
+    def route(self, client_id, msisdn):
+        """Provider do MSISDN normalizado para o cliente; levanta UnroutableMsisdn."""
+        provider = self.merchant_routes.get(client_id, self.routes).lookup(msisdn)
+        if provider is None:
+            raise UnroutableMsisdn(f"Sem provider para o número {msisdn}")
+        return provider
+
+    def wallet_for(self, client_id, provider):
+        """Carteira ativa do cliente no provider (None se não tiver)."""
+        return self.provider_wallets.get((client_id, provider))
+
+
+def _db_version():
+    merchants = Merchant.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+    wallets = Wallet.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+    return (merchants['count'], merchants['updated'], wallets['count'], wallets['updated'])
+
+
+def _load(version):
+    merchants = {
+        row['client_id']: MerchantEntry(row['id'], row['client_id'], row['name'], row['secret_hash'],
+                                        row['routing_rules'] or {})
+        for row in Merchant.objects.filter(is_active=True)
+        .values('id', 'client_id', 'name', 'secret_hash', 'routing_rules')
+    }
+    wallets = {
+        row['wallet_id']: WalletEntry(row['wallet_id'], row['provider'], row['merchant__client_id'])
+        for row in Wallet.objects.filter(is_active=True, merchant__is_active=True)
+        .values('wallet_id', 'provider', 'merchant__client_id')
+    }
+    return RegistrySnapshot(version, merchants, wallets, compile_routes())
+
+
+class MerchantRegistry:
+    """Snapshot do registo por processo, recarregado quando a versão na BD muda."""
+
+    def __init__(self):
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._verified = OrderedDict()  # (client_id, sha256 do segredo) -> (deadline, secret_hash)
+        self._verified_lock = threading.Lock()
+        self.reloads = 0
+
+    def _fresh(self, config):
+        return self._snapshot is not None and time.monotonic() - self._checked_at < config['CHECK_INTERVAL']
+
+    def snapshot(self):
+        """Snapshot atual; verifica a versão na BD se passou CHECK_INTERVAL."""
+        config = get_merchant_registry_config()
+        if self._fresh(config):
+            return self._snapshot
+        with self._lock:
+            if not self._fresh(config):
+                version = _db_version()
+                if self._snapshot is None or self._snapshot.version != version:
+                    self._snapshot = _load(version)
+                    self.reloads += 1
+                    logger.info(f"Registo de comerciantes carregado: {len(self._snapshot.merchants)} "
+                                f"comerciantes, {len(self._snapshot.wallets)} carteiras")
+                self._checked_at = time.monotonic()
+        return self._snapshot
+
+    async def asnapshot(self):
+        """Versão assíncrona de snapshot() (a BD só é consultada quando a verificação expirou)."""
+        if self._fresh(get_merchant_registry_config()):
+            return self._snapshot
+        return await sync_to_async(self.snapshot)()
+
+    def invalidate(self):
+        """Força a verificação da versão no próximo acesso."""
+        self._checked_at = 0.0
+
+    def authenticate(self, client_id, client_secret):
+        """Retorna o MerchantEntry se o client_id está ativo e o segredo confere, senão None."""
+        merchant = self.snapshot().merchant(client_id)
+        if merchant is None or not client_secret:
+            return None
+        config = get_merchant_registry_config()
+        key = (client_id, hashlib.sha256(client_secret.encode('utf-8')).hexdigest())
+        now = time.monotonic()
+        with self._verified_lock:
+            entry = self._verified.get(key)
+            # Um segredo rodado (secret_hash diferente) obriga a nova verificação
+            if entry is not None and now < entry[0] and entry[1] == merchant.secret_hash:
+                self._verified.move_to_end(key)
+                return merchant
+        if not check_password(client_secret, merchant.secret_hash):
+            return None
+        with self._verified_lock:
+            self._verified[key] = (now + config['VERIFY_TTL'], merchant.secret_hash)
+            self._verified.move_to_end(key)
+            while len(self._verified) > config['VERIFY_CACHE_SIZE']:
+                self._verified.popitem(last=False)
+        return merchant
+
+    def clear(self):
+        """Descarta o snapshot e os segredos verificados."""
+        with self._lock:
+            self._snapshot = None
+            self._checked_at = 0.0
+        with self._verified_lock:
+            self._verified.clear()
+
+
+registry = MerchantRegistry()
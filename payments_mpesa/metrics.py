@@ -0,0 +1,347 @@
+"""
+Métricas do gateway em formato de texto Prometheus (GET /internal/metrics).
+
+Cada processo acumula contadores, histogramas e gauges em memória (um lock e
+uma pesquisa num dicionário por observação). Com vários workers (gunicorn,
+uvicorn --workers) cada processo só vê os seus próprios números; se
+METRICS_CONFIG['MULTIPROCESS_DIR'] estiver definido, cada processo grava o seu
+snapshot em <dir>/metrics_<pid>.json a cada WRITE_INTERVAL segundos e o
+endpoint soma os ficheiros de todos os processos. Contadores e histogramas de
+workers terminados continuam a contar; gauges só contam para processos vivos.
+O diretório deve ser esvaziado ao (re)iniciar o servidor.
+
+Métricas:
+  - gateway_upstream_request_duration_seconds{upstream,operation,code}:
+    latência de cada chamada ao M-Pesa/eMola; `code` é o output_ResponseCode
+    (tabela ERROR_CODES), o errorCode da eMola ou o tipo de falha de
+    transporte. O _count por código é o contador de resultados.
+  - gateway_upstream_rejected_total{operation}: chamadas recusadas pelo
+    circuit breaker.
+  - gateway_upstream_in_flight{operation}: chamadas em curso.
+  - gateway_mpesa_token_cache_total{result}: acertos (hit) e falhas (miss)
+    do cache do token Bearer do M-Pesa (payments_mpesa.credentials).
+  - gateway_http_requests_total{view,method,status} e
+    gateway_http_request_duration_seconds{view,method}: por view Django.
+  - gateway_db_queries_per_request{view}: queries SQL por pedido.
+"""
+
+import atexit
+import bisect
+import contextvars
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_CONFIG = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': None,
+    'WRITE_INTERVAL': 5,
+    'TOKEN': None,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# nome -> (tipo, descrição, nomes das labels, buckets)
+METRICS = {
+    'gateway_upstream_request_duration_seconds': (
+        HISTOGRAM, 'Latência das chamadas aos upstreams por operação e código de resultado',
+        ('upstream', 'operation', 'code'), LATENCY_BUCKETS),
+    'gateway_upstream_rejected_total': (
+        COUNTER, 'Chamadas recusadas pelo circuit breaker', ('operation',), None),
+    'gateway_upstream_in_flight': (
+        GAUGE, 'Chamadas aos upstreams em curso', ('operation',), None),
+    'gateway_mpesa_token_cache_total': (
+        COUNTER, 'Acessos ao cache do token Bearer do M-Pesa por resultado (hit/miss)', ('result',), None),
+    'gateway_http_requests_total': (
+        COUNTER, 'Pedidos HTTP por view, método e status', ('view', 'method', 'status'), None),
+    'gateway_http_request_duration_seconds': (
+        HISTOGRAM, 'Duração dos pedidos HTTP por view', ('view', 'method'), LATENCY_BUCKETS),
+    'gateway_db_queries_per_request': (
+        HISTOGRAM, 'Queries SQL executadas por pedido HTTP', ('view',), QUERY_BUCKETS),
+}
+
+# Códigos de resultado fora de tabela ficam agregados (cardinalidade limitada)
+_CODE_RE = re.compile(r'^[\w-]{1,16}$')
+
+
+def get_metrics_config():
+    """Retorna METRICS_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_METRICS_CONFIG, **getattr(settings, 'METRICS_CONFIG', {})}
+
+
+class MetricsRegistry:
+    """Registo thread-safe das métricas do processo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {name: {} for name in METRICS}
+        self._writer = None
+        self.config = None
+
+    def _configure(self):
+        self.config = get_metrics_config()
+        if self.config['ENABLED'] and self.config['MULTIPROCESS_DIR']:
+            os.makedirs(self.config['MULTIPROCESS_DIR'], exist_ok=True)
+            self._writer = threading.Thread(target=self._write_loop, name='metrics-writer', daemon=True)
+            self._writer.start()
+            atexit.register(self.write_snapshot)
+
+    def _enabled(self):
+        if self.config is None:
+            with self._lock:
+                if self.config is None:
+                    self._configure()
+        return self.config['ENABLED']
+
+    def inc(self, name, labels, value=1):
+        """Incrementa um contador (ou soma `value` a um gauge)."""
+        if not self._enabled():
+            return
+        with self._lock:
+            values = self._values[name]
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        """Regista uma observação num histograma."""
+        if not self._enabled():
+            return
+        buckets = METRICS[name][3]
+        with self._lock:
+            values = self._values[name]
+            entry = values.get(labels)
+            if entry is None:
+                entry = values[labels] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        """Cópia serializável dos valores: {nome: [[labels, valor], ...]}."""
+        with self._lock:
+            return {
+                name: [[list(labels), _copy(value)] for labels, value in values.items()]
+                for name, values in self._values.items()
+            }
+
+    def reset(self):
+        """Descarta todos os valores (ex.: entre testes de carga)."""
+        with self._lock:
+            self._values = {name: {} for name in METRICS}
+
+    # ==================== MULTI-PROCESSO ====================
+
+    def _path(self, pid):
+        return os.path.join(self.config['MULTIPROCESS_DIR'], f'metrics_{pid}.json')
+
+    def write_snapshot(self):
+        """Grava o snapshot do processo (escrita atómica)."""
+        path = self._path(os.getpid())
+        tmp = f'{path}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"Erro ao gravar métricas em {path}: {str(e)}")
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.config['WRITE_INTERVAL'])
+            self.write_snapshot()
+
+    def collect(self):
+        """Valores de todos os processos somados (ou só deste, sem MULTIPROCESS_DIR)."""
+        self._enabled()
+        own = self.snapshot()
+        if not self.config['MULTIPROCESS_DIR']:
+            return own
+        snapshots = [own]
+        for path in glob.glob(os.path.join(self.config['MULTIPROCESS_DIR'], 'metrics_*.json')):
+            pid = int(re.search(r'metrics_(\d+)\.json$', path).group(1))
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not _alive(pid):
+                data = {name: values for name, values in data.items() if METRICS.get(name, (None,))[0] != GAUGE}
+            snapshots.append(data)
+        return _merge(snapshots)
+
+
+def _copy(value):
+    return [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(snapshots):
+    merged = {name: {} for name in METRICS}
+    for data in snapshots:
+        for name, values in data.items():
+            if name not in METRICS:
+                continue
+            target = merged[name]
+            for labels, value in values:
+                key = tuple(labels)
+                current = target.get(key)
+                if current is None:
+                    target[key] = _copy(value)
+                elif METRICS[name][0] == HISTOGRAM:
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                else:
+                    target[key] = current + value
+    return {name: [[list(labels), value] for labels, value in values.items()] for name, values in merged.items()}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _le(bound):
+    return 'le="%s"' % bound
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(data):
+    """Formata os valores de collect() no formato de texto Prometheus 0.0.4."""
+    lines = []
+    for name, (kind, help_text, label_names, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(data.get(name, []), key=lambda item: item[0]):
+            if kind != HISTOGRAM:
+                lines.append(f'{name}{_labels(label_names, labels)} {_number(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{_labels(label_names, labels, _le(bound))} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(label_names, labels, _le("+Inf"))} {count}')
+            lines.append(f'{name}_sum{_labels(label_names, labels)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(label_names, labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+# ==================== UPSTREAMS ====================
+
+def mpesa_code(result, error_codes):
+    """Código de resultado de uma resposta M-Pesa (output_ResponseCode da tabela ERROR_CODES)."""
+    code = (result.get('response') or {}).get('output_ResponseCode')
+    if code is None:
+        return f"http_{result.get('status')}"
+    return code if code in error_codes else 'unknown'
+
+
+def emola_code(result):
+    """Código de resultado de um SoapResult (errorCode da eMola ou tipo de falha)."""
+    if result.error_code is not None:
+        return result.error_code if _CODE_RE.match(result.error_code) else 'unknown'
+    if result.gateway_error:
+        return 'gateway_error'
+    return (result.error or f'http_{result.status_code}').lower().replace(' ', '_')
+
+
+def transport_code(exc):
+    """Código de resultado para uma exceção de transporte (requests ou httpx)."""
+    name = type(exc).__name__.lower()
+    if 'timeout' in name:
+        return 'timeout'
+    if 'connect' in name:
+        return 'connection_failed'
+    return 'unexpected_error'
+
+
+def observe_upstream(upstream, operation, code, latency):
+    metrics.observe('gateway_upstream_request_duration_seconds', (upstream, operation, code), latency)
+
+
+def upstream_started(operation):
+    metrics.inc('gateway_upstream_in_flight', (operation,))
+
+
+def upstream_finished(operation):
+    metrics.inc('gateway_upstream_in_flight', (operation,), -1)
+
+
+def upstream_rejected(operation):
+    metrics.inc('gateway_upstream_rejected_total', (operation,))
+
+
+def token_cache(result):
+    metrics.inc('gateway_mpesa_token_cache_total', (result,))
+
+
+# ==================== PEDIDOS HTTP ====================
+
+_query_count = contextvars.ContextVar('gateway_query_count', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """Handler de connection_created: conta as queries de cada conexão no pedido atual."""
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def start_request():
+    """Inicia a contagem de queries do pedido (propaga-se para sync_to_async)."""
+    return _query_count.set([0])
+
+
+def finish_request(token, request, response, duration):
+    """Regista duração, status e queries do pedido."""
+    queries = _query_count.get()[0]
+    _query_count.reset(token)
+    match = getattr(request, 'resolver_match', None)
+    view = match.view_name if match else 'unmatched'
+    metrics.inc('gateway_http_requests_total', (view, request.method, str(response.status_code)))
+    metrics.observe('gateway_http_request_duration_seconds', (view, request.method), duration)
+    metrics.observe('gateway_db_queries_per_request', (view,), queries)
@@ -0,0 +1,73 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from . import replicas
+from .metrics import start_request, finish_request
+
+
+class MetricsMiddleware:
+    """Regista contagem, duração e queries SQL de cada pedido (ver payments_mpesa.metrics)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = start_request()
+        start = time.monotonic()
+        response = self.get_response(request)
+        finish_request(token, request, response, time.monotonic() - start)
+        return response
+
+    async def __acall__(self, request):
+        token = start_request()
+        start = time.monotonic()
+        response = await self.get_response(request)
+        finish_request(token, request, response, time.monotonic() - start)
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """Após um pedido com escritas, fixa as leituras do cliente no primário durante PIN_SECONDS (cookie)."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = replicas.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = replicas.finish_request(token)
+        return self._pin(response, wrote)
+
+    async def __acall__(self, request):
+        token = replicas.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = replicas.finish_request(token)
+        return self._pin(response, wrote)
+
+    @staticmethod
+    def _pin(response, wrote):
+        if wrote and replicas.replica_configured():
+            config = replicas.get_read_replica_config()
+            response.set_cookie(config['PIN_COOKIE'], '1', max_age=config['PIN_SECONDS'], httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('C2B', 'Customer to Business'), ('B2C', 'Business to Customer')], max_length=10)),
+                ('payload', models.JSONField(help_text='Argumentos da chamada ao M-Pesa')),
+                ('status', models.CharField(choices=[('queued', 'Na fila'), ('running', 'Em execução'), ('done', 'Concluído'), ('failed', 'Falhou')], default='queued', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Não processar antes desta data (backoff)')),
+                ('locked_by', models.CharField(blank=True, default='', help_text='Worker que detém o lease', max_length=100)),
+                ('lease_expires_at', models.DateTimeField(blank=True, help_text='Após esta data outro worker pode reclamar o job', null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='payments_mpesa.transaction')),
+            ],
+            options={
+                'verbose_name': 'Job de pagamento',
+                'verbose_name_plural': 'Jobs de pagamento',
+                'ordering': ['available_at', 'id'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='payments_mp_status_be3acb_idx'), models.Index(fields=['status', 'lease_expires_at'], name='payments_mp_status_f7a1f7_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0002_paymentjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='oauthtoken',
+            index=models.Index(fields=['expires_at'], name='payments_mp_expires_893d49_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0003_oauthtoken_expires_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('C2B', 'Customer to Business'), ('B2C', 'Business to Customer')], max_length=10)),
+                ('status', models.CharField(choices=[('success', 'Sucesso'), ('error', 'Erro'), ('pending', 'Pendente')], max_length=20)),
+                ('from_app', models.CharField(blank=True, default='', max_length=100)),
+                ('count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+            ],
+            options={
+                'verbose_name': 'Estatística diária',
+                'verbose_name_plural': 'Estatísticas diárias',
+                'ordering': ['-date'],
+                'constraints': [models.UniqueConstraint(fields=('date', 'transaction_type', 'status', 'from_app'), name='unique_daily_stats_bucket')],
+            },
+        ),
+    ]
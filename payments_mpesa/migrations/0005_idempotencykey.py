@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0004_transactiondailystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='SHA-256 de operação + client_id + chave enviada', max_length=64, unique=True)),
+                ('operation', models.CharField(max_length=10)),
+                ('request_hash', models.CharField(help_text='SHA-256 do corpo do pedido original', max_length=64)),
+                ('status', models.CharField(choices=[('in_progress', 'Em curso'), ('completed', 'Concluído')], default='in_progress', max_length=20)),
+                ('locked_until', models.DateTimeField(blank=True, help_text='Após esta data um pedido em curso pode ser retomado', null=True)),
+                ('response_status', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('response_body', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(help_text='Após esta data a chave deixa de ser considerada')),
+            ],
+            options={
+                'verbose_name': 'Chave de idempotência',
+                'verbose_name_plural': 'Chaves de idempotência',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['expires_at'], name='payments_mp_expires_c6867c_idx')],
+            },
+        ),
+    ]
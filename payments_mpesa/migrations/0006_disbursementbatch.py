@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0005_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DisbursementBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('mpesa', 'M-Pesa'), ('emola', 'eMola')], default='mpesa', max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Na fila'), ('running', 'Em execução'), ('completed', 'Concluído')], db_index=True, default='queued', max_length=20)),
+                ('client_id', models.CharField(blank=True, default='', max_length=255)),
+                ('from_app', models.CharField(blank=True, max_length=100, null=True)),
+                ('total_items', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Lote de desembolso',
+                'verbose_name_plural': 'Lotes de desembolso',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='paymentjob',
+            name='provider',
+            field=models.CharField(choices=[('mpesa', 'M-Pesa'), ('emola', 'eMola')], default='mpesa', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='provider',
+            field=models.CharField(choices=[('mpesa', 'M-Pesa'), ('emola', 'eMola')], default='mpesa', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='paymentjob',
+            index=models.Index(fields=['provider', 'status', 'available_at'], name='payments_mp_provide_1ef1a6_idx'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='batch',
+            field=models.ForeignKey(blank=True, help_text='Lote de desembolso (B2C em massa)', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='payments_mpesa.disbursementbatch'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['batch', 'status'], name='payments_mp_batch_i_524e94_idx'),
+        ),
+    ]
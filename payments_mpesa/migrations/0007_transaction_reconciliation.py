@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0006_disbursementbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='next_reconcile_at',
+            field=models.DateTimeField(blank=True, help_text='Próxima consulta de estado ao M-Pesa (backoff)', null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='reconcile_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='reconciled_at',
+            field=models.DateTimeField(blank=True, help_text='Data em que o resultado foi confirmado pela consulta', null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0007_transaction_reconciliation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Ex.: client:<id>, app:<fromApp>, msisdn:<número>', max_length=150, unique=True)),
+                ('tokens', models.FloatField()),
+                ('refilled_at', models.FloatField(help_text='Epoch (segundos) do último cálculo de tokens')),
+            ],
+            options={
+                'verbose_name': 'Token bucket',
+                'verbose_name_plural': 'Token buckets',
+                'indexes': [models.Index(fields=['refilled_at'], name='payments_mp_refille_90bf10_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0008_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Merchant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('client_id', models.CharField(max_length=255, unique=True)),
+                ('secret_hash', models.CharField(help_text='Hash do client_secret (django.contrib.auth.hashers)', max_length=255)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Comerciante',
+                'verbose_name_plural': 'Comerciantes',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Wallet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wallet_id', models.PositiveIntegerField(unique=True)),
+                ('provider', models.CharField(choices=[('mpesa', 'M-Pesa'), ('emola', 'eMola')], default='mpesa', max_length=10)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('merchant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wallets', to='payments_mpesa.merchant')),
+            ],
+            options={
+                'verbose_name': 'Carteira',
+                'verbose_name_plural': 'Carteiras',
+                'ordering': ['wallet_id'],
+            },
+        ),
+    ]
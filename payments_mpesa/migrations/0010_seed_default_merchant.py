@@ -0,0 +1,38 @@
+import os
+
+from django.contrib.auth.hashers import make_password
+from django.db import migrations
+
+# Comerciante que estava fixo em views.py (carteira Mawonelo). O segredo não
+# fica no código: vem de DEFAULT_MERCHANT_CLIENT_SECRET ou, sem ela, o
+# comerciante é criado com um hash inutilizável e o segredo tem de ser gerado
+# com python manage.py register_merchant Mawonelo --client-id <id> --rotate-secret
+DEFAULT_CLIENT_ID = 'a0140c9f-4c66-426e-beea-73bef5ac5023'
+DEFAULT_WALLETS = [(132722, 'mpesa'), (989473, 'emola')]
+
+
+def seed_default_merchant(apps, schema_editor):
+    Merchant = apps.get_model('payments_mpesa', 'Merchant')
+    Wallet = apps.get_model('payments_mpesa', 'Wallet')
+    merchant, _ = Merchant.objects.get_or_create(
+        client_id=DEFAULT_CLIENT_ID,
+        defaults={'name': 'Mawonelo', 'secret_hash': make_password(os.getenv('DEFAULT_MERCHANT_CLIENT_SECRET') or None)},
+    )
+    for wallet_id, provider in DEFAULT_WALLETS:
+        Wallet.objects.get_or_create(wallet_id=wallet_id, defaults={'merchant': merchant, 'provider': provider})
+
+
+def remove_default_merchant(apps, schema_editor):
+    Merchant = apps.get_model('payments_mpesa', 'Merchant')
+    Merchant.objects.filter(client_id=DEFAULT_CLIENT_ID).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0009_merchant_wallet'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_default_merchant, remove_default_merchant),
+    ]
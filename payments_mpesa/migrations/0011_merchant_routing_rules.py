@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0010_seed_default_merchant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='merchant',
+            name='routing_rules',
+            field=models.JSONField(blank=True, default=dict, help_text='Prefixos que sobrepõem PAYMENT_ROUTING_CONFIG, ex.: {"8610": "mpesa", "87": null}'),
+        ),
+    ]
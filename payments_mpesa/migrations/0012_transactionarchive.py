@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0011_merchant_routing_rules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionArchive',
+            fields=[
+                ('id', models.BigIntegerField(help_text='Id original em Transaction', primary_key=True, serialize=False)),
+                ('transaction_type', models.CharField(choices=[('C2B', 'Customer to Business'), ('B2C', 'Business to Customer')], max_length=10)),
+                ('provider', models.CharField(choices=[('mpesa', 'M-Pesa'), ('emola', 'eMola')], default='mpesa', max_length=10)),
+                ('transaction_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('transaction_reference', models.CharField(max_length=20)),
+                ('third_party_reference', models.CharField(max_length=20)),
+                ('customer_msisdn', models.CharField(max_length=15)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('status', models.CharField(choices=[('success', 'Sucesso'), ('error', 'Erro'), ('pending', 'Pendente')], max_length=20)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('from_app', models.CharField(blank=True, max_length=100, null=True)),
+                ('batch_id', models.BigIntegerField(blank=True, help_text='Lote de desembolso (sem chave estrangeira)', null=True)),
+                ('payload', models.BinaryField(help_text='Campos frios em JSON comprimido (zlib)')),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Transação arquivada',
+                'verbose_name_plural': 'Transações arquivadas',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['created_at', 'id'], name='payments_mp_created_6656a5_idx'), models.Index(fields=['transaction_reference'], name='payments_mp_transac_5ef489_idx')],
+            },
+        ),
+    ]
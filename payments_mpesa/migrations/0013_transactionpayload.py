@@ -0,0 +1,98 @@
+import json
+import zlib
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+COMPRESS_LEVEL = 6
+
+
+def _compress(value):
+    return zlib.compress(json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':')).encode('utf-8'), COMPRESS_LEVEL)
+
+
+def _response_code(value):
+    if not isinstance(value, dict):
+        return None
+    code = value.get('output_ResponseCode') or value.get('errorCode')
+    return str(code)[:20] if code is not None else None
+
+
+def move_raw_responses(apps, schema_editor):
+    """Copia raw_response para TransactionPayload (comprimido) em lotes por id."""
+    Transaction = apps.get_model('payments_mpesa', 'Transaction')
+    TransactionPayload = apps.get_model('payments_mpesa', 'TransactionPayload')
+    last_id = 0
+    while True:
+        rows = list(
+            Transaction.objects.filter(id__gt=last_id, raw_response__isnull=False)
+            .order_by('id')
+            .values_list('id', 'raw_response')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        by_code = defaultdict(list)
+        for pk, value in rows:
+            code = _response_code(value)
+            if code is not None:
+                by_code[code].append(pk)
+        with transaction.atomic():
+            TransactionPayload.objects.bulk_create([
+                TransactionPayload(transaction_id=pk, data=_compress(value)) for pk, value in rows
+            ], ignore_conflicts=True)
+            for code, ids in by_code.items():
+                Transaction.objects.filter(id__in=ids).update(response_code=code)
+        last_id = rows[-1][0]
+
+
+def restore_raw_responses(apps, schema_editor):
+    """Inverso: devolve os payloads a Transaction.raw_response."""
+    Transaction = apps.get_model('payments_mpesa', 'Transaction')
+    TransactionPayload = apps.get_model('payments_mpesa', 'TransactionPayload')
+    last_id = 0
+    while True:
+        rows = list(
+            TransactionPayload.objects.filter(transaction_id__gt=last_id)
+            .order_by('transaction_id')
+            .values_list('transaction_id', 'data')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        with transaction.atomic():
+            Transaction.objects.bulk_update([
+                Transaction(id=pk, raw_response=json.loads(zlib.decompress(bytes(data)).decode('utf-8')))
+                for pk, data in rows
+            ], ['raw_response'])
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+    # Cada lote é confirmado à parte: tabelas grandes não ficam numa só transação
+    atomic = False
+
+    dependencies = [
+        ('payments_mpesa', '0012_transactionarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionPayload',
+            fields=[
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='raw_payload', serialize=False, to='payments_mpesa.transaction')),
+                ('data', models.BinaryField(help_text='JSON comprimido com zlib (ver payments_mpesa/payloads.py)')),
+            ],
+            options={
+                'verbose_name': 'Resposta do upstream',
+                'verbose_name_plural': 'Respostas do upstream',
+            },
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='response_code',
+            field=models.CharField(blank=True, help_text='output_ResponseCode (M-Pesa) ou errorCode (eMola)', max_length=20, null=True),
+        ),
+        migrations.RunPython(move_raw_responses, restore_raw_responses),
+    ]
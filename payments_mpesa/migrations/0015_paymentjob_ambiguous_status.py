@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0014_remove_transaction_raw_response'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymentjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Na fila'), ('running', 'Em execução'), ('done', 'Concluído'), ('failed', 'Falhou'), ('ambiguous', 'Resultado desconhecido')], default='queued', max_length=20),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0015_paymentjob_ambiguous_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='provider',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='upstream_reference',
+            field=models.CharField(blank=True, help_text='third_party_reference (M-Pesa) ou transId (eMola) do pedido', max_length=30),
+        ),
+        migrations.AlterField(
+            model_name='idempotencykey',
+            name='status',
+            field=models.CharField(choices=[('in_progress', 'Em curso'), ('completed', 'Concluído'), ('ambiguous', 'Resultado desconhecido')], default='in_progress', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='idempotencykey',
+            index=models.Index(fields=['status', 'created_at'], name='payments_mp_status_631aa2_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments_mpesa', '0016_idempotencykey_ambiguous'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpstreamSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holder', models.CharField(blank=True, help_text='host:PID:n do pedido que ocupa a vaga', max_length=64)),
+                ('lease_until', models.FloatField(default=0, help_text='Epoch (segundos) a partir do qual a vaga está livre')),
+            ],
+            options={
+                'verbose_name': 'Vaga de upstream',
+                'verbose_name_plural': 'Vagas de upstream',
+            },
+        ),
+    ]
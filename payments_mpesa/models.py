@@ -5,6 +5,9 @@ Modelos de banco de dados para transações M-Pesa e tokens OAuth.
 from django.db import models
 from django.utils import timezone
 
+# raw_response ainda não lido de TransactionPayload
+_NOT_LOADED = object()
+
 
 class OAuthToken(models.Model):
     """Modelo para armazenar tokens OAuth2 gerados."""
@@ -19,6 +22,9 @@ class OAuthToken(models.Model):
         verbose_name = "Token OAuth"
         verbose_name_plural = "Tokens OAuth"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['expires_at']),  # Limpeza de tokens expirados
+        ]
     
     def __str__(self):
         return f"Token para {self.client_id} - Expira em {self.expires_at}"
@@ -42,8 +48,14 @@ class Transaction(models.Model):
         ('pending', 'Pendente'),
     ]
     
+    PROVIDERS = [
+        ('mpesa', 'M-Pesa'),
+        ('emola', 'eMola'),
+    ]
+    
     # Campos principais
     transaction_type = models.CharField(max_length=10, choices=TRANSACTION_TYPES)
+    provider = models.CharField(max_length=10, choices=PROVIDERS, default='mpesa')
     transaction_id = models.CharField(max_length=100, null=True, blank=True, 
                                      help_text="ID da transação retornado pelo M-Pesa")
     conversation_id = models.CharField(max_length=100, null=True, blank=True,
@@ -66,13 +78,22 @@ class Transaction(models.Model):
     message = models.TextField(null=True, blank=True,
                               help_text="Mensagem de sucesso ou erro")
     
-    # Resposta completa da API
-    raw_response = models.JSONField(null=True, blank=True,
-                                   help_text="Resposta completa da API M-Pesa")
+    # Código de resposta do upstream; a resposta completa fica em TransactionPayload (raw_response)
+    response_code = models.CharField(max_length=20, null=True, blank=True,
+                                     help_text="output_ResponseCode (M-Pesa) ou errorCode (eMola)")
     
     # Metadados
     from_app = models.CharField(max_length=100, null=True, blank=True,
                                help_text="Aplicação de origem (ex: CartaFacil)")
+    batch = models.ForeignKey('DisbursementBatch', on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name='transactions', help_text="Lote de desembolso (B2C em massa)")
+    
+    # Reconciliação de resultados ambíguos (INS-9 ou timeout sem resposta)
+    reconcile_attempts = models.PositiveSmallIntegerField(default=0)
+    next_reconcile_at = models.DateTimeField(null=True, blank=True,
+                                             help_text="Próxima consulta de estado ao M-Pesa (backoff)")
+    reconciled_at = models.DateTimeField(null=True, blank=True,
+                                         help_text="Data em que o resultado foi confirmado pela consulta")
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -85,11 +106,38 @@ class Transaction(models.Model):
             models.Index(fields=['customer_msisdn', '-created_at']),
             models.Index(fields=['status', '-created_at']),
             models.Index(fields=['transaction_reference']),
+            models.Index(fields=['batch', 'status']),  # Progresso dos lotes de desembolso
         ]
     
     def __str__(self):
         return f"{self.transaction_type} - {self.customer_msisdn} - {self.amount} MT ({self.status})"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Guarda o status carregado para detetar mudanças (rollup diário)."""
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+    
+    _raw_response = _NOT_LOADED
+    _raw_response_changed = False
+    
+    @property
+    def raw_response(self):
+        """Resposta completa do upstream, lida de TransactionPayload só quando é usada."""
+        if self._raw_response is _NOT_LOADED:
+            from .payloads import load_payloads
+            self._raw_response = load_payloads([self.pk]).get(self.pk) if self.pk else None
+        return self._raw_response
+    
+    @raw_response.setter
+    def raw_response(self, value):
+        # Gravado pelo sinal post_save (ver payments_mpesa/payloads.py)
+        from .payloads import response_code
+        self._raw_response = value
+        self._raw_response_changed = True
+        self.response_code = response_code(value)
+    
     @property
     def is_successful(self):
         """Verifica se a transação foi bem-sucedida."""
@@ -98,4 +146,282 @@ class Transaction(models.Model):
     @property
     def formatted_amount(self):
         """Retorna o valor formatado."""
-        return f"{self.amount:,.2f} MT"
\ No newline at end of file
+        return f"{self.amount:,.2f} MT"
+
+class TransactionDailyStats(models.Model):
+    """Rollup diário das transações (data x tipo x status x app), mantido incrementalmente."""
+    
+    date = models.DateField()
+    transaction_type = models.CharField(max_length=10, choices=Transaction.TRANSACTION_TYPES)
+    status = models.CharField(max_length=20, choices=Transaction.STATUS_CHOICES)
+    from_app = models.CharField(max_length=100, blank=True, default='')
+    count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    
+    class Meta:
+        verbose_name = "Estatística diária"
+        verbose_name_plural = "Estatísticas diárias"
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'transaction_type', 'status', 'from_app'],
+                                    name='unique_daily_stats_bucket'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} {self.transaction_type} {self.status} {self.from_app}: {self.count}"
+
+
+class DisbursementBatch(models.Model):
+    """Lote de desembolsos B2C; cada item é uma Transaction com um PaymentJob."""
+    
+    STATUS_CHOICES = [
+        ('queued', 'Na fila'),
+        ('running', 'Em execução'),
+        ('completed', 'Concluído'),
+    ]
+    
+    provider = models.CharField(max_length=10, choices=Transaction.PROVIDERS, default='mpesa')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', db_index=True)
+    client_id = models.CharField(max_length=255, blank=True, default='')
+    from_app = models.CharField(max_length=100, null=True, blank=True)
+    total_items = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        verbose_name = "Lote de desembolso"
+        verbose_name_plural = "Lotes de desembolso"
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Lote #{self.pk} {self.provider} - {self.total_items} itens ({self.status})"
+
+
+class PaymentJob(models.Model):
+    """Fila local de chamadas ao M-Pesa processadas por workers (sem broker externo)."""
+    
+    OPERATIONS = [
+        ('C2B', 'Customer to Business'),
+        ('B2C', 'Business to Customer'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('queued', 'Na fila'),
+        ('running', 'Em execução'),
+        ('done', 'Concluído'),
+        ('failed', 'Falhou'),
+        ('ambiguous', 'Resultado desconhecido'),
+    ]
+    
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='jobs')
+    operation = models.CharField(max_length=10, choices=OPERATIONS)
+    provider = models.CharField(max_length=10, choices=Transaction.PROVIDERS, default='mpesa')
+    payload = models.JSONField(help_text="Argumentos da chamada ao M-Pesa")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now,
+                                        help_text="Não processar antes desta data (backoff)")
+    locked_by = models.CharField(max_length=100, blank=True, default='',
+                                 help_text="Worker que detém o lease")
+    lease_expires_at = models.DateTimeField(null=True, blank=True,
+                                            help_text="Após esta data outro worker pode reclamar o job")
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Job de pagamento"
+        verbose_name_plural = "Jobs de pagamento"
+        ordering = ['available_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+            models.Index(fields=['status', 'lease_expires_at']),
+            models.Index(fields=['provider', 'status', 'available_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.operation} job #{self.pk} ({self.status})"
+
+
+class IdempotencyKey(models.Model):
+    """Chave de idempotência de um pedido de pagamento e a resposta final guardada para replay."""
+    
+    STATUS_CHOICES = [
+        ('in_progress', 'Em curso'),
+        ('completed', 'Concluído'),
+        ('ambiguous', 'Resultado desconhecido'),
+    ]
+    
+    key = models.CharField(max_length=64, unique=True,
+                           help_text="SHA-256 de operação + client_id + chave enviada")
+    operation = models.CharField(max_length=10)
+    provider = models.CharField(max_length=10, blank=True)
+    upstream_reference = models.CharField(max_length=30, blank=True,
+                                          help_text="third_party_reference (M-Pesa) ou transId (eMola) do pedido")
+    request_hash = models.CharField(max_length=64, help_text="SHA-256 do corpo do pedido original")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='in_progress')
+    locked_until = models.DateTimeField(null=True, blank=True,
+                                        help_text="Após esta data um pedido em curso pode ser retomado")
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(help_text="Após esta data a chave deixa de ser considerada")
+    
+    class Meta:
+        verbose_name = "Chave de idempotência"
+        verbose_name_plural = "Chaves de idempotência"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['expires_at']),  # Limpeza de chaves expiradas
+            models.Index(fields=['status', 'created_at']),  # Chaves sem resposta (reconciliação)
+        ]
+    
+    def __str__(self):
+        return f"{self.operation} {self.key[:12]}… ({self.status})"
+
+
+class RateLimitBucket(models.Model):
+    """Token bucket partilhado pelos workers (RATE_LIMIT_CONFIG['BACKEND'] = 'database')."""
+    
+    key = models.CharField(max_length=150, unique=True, help_text="Ex.: client:<id>, app:<fromApp>, msisdn:<número>")
+    tokens = models.FloatField()
+    refilled_at = models.FloatField(help_text="Epoch (segundos) do último cálculo de tokens")
+    
+    class Meta:
+        verbose_name = "Token bucket"
+        verbose_name_plural = "Token buckets"
+        indexes = [
+            models.Index(fields=['refilled_at']),  # Limpeza de buckets inativos
+        ]
+    
+    def __str__(self):
+        return f"{self.key} ({self.tokens:.1f})"
+
+
+class UpstreamSlot(models.Model):
+    """Vaga de chamada ao upstream em curso, partilhada pelos workers (RATE_LIMIT_CONFIG['MAX_IN_FLIGHT'])."""
+    
+    holder = models.CharField(max_length=64, blank=True, help_text="host:PID:n do pedido que ocupa a vaga")
+    lease_until = models.FloatField(default=0, help_text="Epoch (segundos) a partir do qual a vaga está livre")
+    
+    class Meta:
+        verbose_name = "Vaga de upstream"
+        verbose_name_plural = "Vagas de upstream"
+    
+    def __str__(self):
+        return f"#{self.pk} {self.holder or 'livre'}"
+
+
+class Merchant(models.Model):
+    """App comerciante com credenciais OAuth (client_id + segredo com hash)."""
+    
+    name = models.CharField(max_length=100)
+    client_id = models.CharField(max_length=255, unique=True)
+    secret_hash = models.CharField(max_length=255, help_text="Hash do client_secret (django.contrib.auth.hashers)")
+    routing_rules = models.JSONField(default=dict, blank=True,
+                                     help_text='Prefixos que sobrepõem PAYMENT_ROUTING_CONFIG, ex.: {"8610": "mpesa", "87": null}')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Comerciante"
+        verbose_name_plural = "Comerciantes"
+        ordering = ['name']
+    
+    def __str__(self):
+        return f"{self.name} ({self.client_id})"
+    
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        from .routing import validate_routing_rules
+        try:
+            validate_routing_rules(self.routing_rules)
+        except ValidationError as e:
+            raise ValidationError({'routing_rules': e.messages})
+    
+    def set_secret(self, raw_secret):
+        """Guarda o hash do segredo (o segredo em claro nunca é gravado)."""
+        from django.contrib.auth.hashers import make_password
+        self.secret_hash = make_password(raw_secret)
+
+
+class Wallet(models.Model):
+    """Carteira (wallet_id do URL de pagamento) de um comerciante num provider."""
+    
+    merchant = models.ForeignKey(Merchant, on_delete=models.CASCADE, related_name='wallets')
+    wallet_id = models.PositiveIntegerField(unique=True)
+    provider = models.CharField(max_length=10, choices=Transaction.PROVIDERS, default='mpesa')
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Carteira"
+        verbose_name_plural = "Carteiras"
+        ordering = ['wallet_id']
+    
+    def __str__(self):
+        return f"{self.wallet_id} {self.provider} - {self.merchant.name}"
+
+
+class TransactionArchive(models.Model):
+    """
+    Transação arquivada (nível frio, ver payments_mpesa/archive.py).
+    
+    Mantém o id original e as colunas usadas na listagem/exportação; os campos
+    frios (raw_response, conversation_id, reconciliação) ficam em `payload`,
+    JSON comprimido com zlib. Só tem os índices (created_at, id) e referência.
+    """
+    
+    id = models.BigIntegerField(primary_key=True, help_text="Id original em Transaction")
+    transaction_type = models.CharField(max_length=10, choices=Transaction.TRANSACTION_TYPES)
+    provider = models.CharField(max_length=10, choices=Transaction.PROVIDERS, default='mpesa')
+    transaction_id = models.CharField(max_length=100, null=True, blank=True)
+    transaction_reference = models.CharField(max_length=20)
+    third_party_reference = models.CharField(max_length=20)
+    customer_msisdn = models.CharField(max_length=15)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    status = models.CharField(max_length=20, choices=Transaction.STATUS_CHOICES)
+    message = models.TextField(null=True, blank=True)
+    from_app = models.CharField(max_length=100, null=True, blank=True)
+    batch_id = models.BigIntegerField(null=True, blank=True, help_text="Lote de desembolso (sem chave estrangeira)")
+    payload = models.BinaryField(help_text="Campos frios em JSON comprimido (zlib)")
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name = "Transação arquivada"
+        verbose_name_plural = "Transações arquivadas"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['transaction_reference']),
+        ]
+    
+    def __str__(self):
+        return f"{self.transaction_type} - {self.customer_msisdn} - {self.amount} MT ({self.status}, arquivada)"
+    
+    @property
+    def cold_fields(self):
+        """Campos frios descomprimidos (raw_response, conversation_id, ...)."""
+        from .payloads import decompress_json
+        return decompress_json(self.payload) or {}
+
+
+class TransactionPayload(models.Model):
+    """Resposta completa do upstream de uma Transaction (JSON comprimido com zlib)."""
+    
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, primary_key=True,
+                                       related_name='raw_payload')
+    data = models.BinaryField(help_text="JSON comprimido com zlib (ver payments_mpesa/payloads.py)")
+    
+    class Meta:
+        verbose_name = "Resposta do upstream"
+        verbose_name_plural = "Respostas do upstream"
+    
+    def __str__(self):
+        return f"Payload da transação #{self.transaction_id} ({len(self.data)} bytes)"
@@ -2,14 +2,23 @@
 Implementação do serviço M-Pesa para transações C2B e B2C com third_party_reference estático.
 """
 
-import base64
+import asyncio
+import threading
+import time
+import weakref
+import httpx
 import requests
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.backends import default_backend
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
 from django.conf import settings
 import logging
 
+from .credentials import credential_cache, DEFAULT_TOKEN_TTL
+from .breaker import breakers
+from . import asyncclients, metrics
+
 logger = logging.getLogger(__name__)
 
 # Mapeamento de códigos de erro do M-Pesa
@@ -23,30 +32,145 @@ ERROR_CODES = {
     "INS-2006": "Saldo insuficiente"
 }
 
+# Valores padrão do pool HTTP (sobrescritos por MPESA_CONFIG)
+DEFAULT_POOL_SIZE = 20
+DEFAULT_RETRIES = 2
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 90
+DEFAULT_ASYNC_MAX_CONNECTIONS = 1000
+
+# Circuit breaker por operação (porta do serviço)
+BREAKER_NAMES = {
+    18352: 'mpesa.c2b',
+    18345: 'mpesa.b2c',
+    18353: 'mpesa.query',
+}
+
+
+def request_not_sent(exc):
+    """
+    True se a exceção de transporte garante que o pedido não chegou ao upstream.
+
+    Só falhas ao abrir a conexão (recusada, DNS, timeout de conexão) ou à
+    espera de uma conexão do pool. Timeouts de leitura e conexões cortadas
+    depois do envio são ambíguos: o upstream pode ter processado o pedido.
+    """
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        # MaxRetryError da urllib3: NewConnectionError é subclasse de ConnectTimeoutError
+        return isinstance(getattr(exc.args[0], 'reason', None), ConnectTimeoutError)
+    return False
+
+
+def config_fingerprint(config):
+    """Conteúdo de um dict de configuração comparável (deteta também alterações no próprio dict e nos aninhados)."""
+    return tuple(sorted(
+        (key, config_fingerprint(value) if isinstance(value, dict) else value) for key, value in config.items()
+    ))
+
+
 class Mpesa:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Retorna o cliente M-Pesa partilhado pelo processo (singleton thread-safe).
+
+        Se MPESA_CONFIG mudou desde a criação, o cliente é reconstruído (novas
+        chaves, timeouts e pools) e as sessões do anterior são fechadas.
+        """
+        fingerprint = config_fingerprint(settings.MPESA_CONFIG)
+        instance = cls._instance
+        if instance is None or instance.fingerprint != fingerprint:
+            with cls._instance_lock:
+                instance = cls._instance
+                if instance is None or instance.fingerprint != fingerprint:
+                    previous = instance
+                    instance = cls._instance = cls()
+                    if previous is not None:
+                        previous.close()
+                        logger.info("MPESA_CONFIG alterado: cliente M-Pesa reconstruído")
+        return instance
+
+    @classmethod
+    def reset_instance(cls):
+        """Fecha as sessões do singleton atual (ex.: após alterar MPESA_CONFIG)."""
+        with cls._instance_lock:
+            if cls._instance is not None:
+                cls._instance.close()
+            cls._instance = None
+
     def __init__(self):
         """Inicializa o serviço M-Pesa com as configurações do Django."""
-        self.config = settings.MPESA_CONFIG
-        self.base_uri = 'https://api.sandbox.vm.co.mz' if self.config['ENV'] == 'sandbox' else 'https://api.vm.co.mz'
+        self.config = dict(settings.MPESA_CONFIG)
+        self.fingerprint = config_fingerprint(self.config)
+        self.base_uri = self.config.get('BASE_URI') or (
+            'https://api.sandbox.vm.co.mz' if self.config['ENV'] == 'sandbox' else 'https://api.vm.co.mz'
+        )  # BASE_URI permite apontar para um M-Pesa simulado (testes de carga)
         self.public_key = self.config['PUBLIC_KEY']
         self.api_key = self.config['API_KEY']
         self.service_provider_code = self.config['SERVICE_PROVIDER_CODE']
         self.default_third_party_reference = self.config['THIRD_PARTY_REFERENCE']  # Valor estático padrão
+        self.token_ttl = int(self.config.get('TOKEN_TTL', DEFAULT_TOKEN_TTL))  # Rotação do token em segundos
+        self.pool_size = int(self.config.get('POOL_SIZE', DEFAULT_POOL_SIZE))
+        self.retries = int(self.config.get('RETRIES', DEFAULT_RETRIES))
+        self.timeout = (
+            float(self.config.get('CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+            float(self.config.get('READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        )
+        self._sessions = {}  # Uma sessão keep-alive por porta (C2B: 18352, B2C: 18345)
+        self._sessions_lock = threading.Lock()
+        self.async_max_connections = int(self.config.get('ASYNC_MAX_CONNECTIONS', DEFAULT_ASYNC_MAX_CONNECTIONS))
+        self._async_clients = weakref.WeakKeyDictionary()  # httpx.AsyncClient por event loop do servidor ASGI
+
+    def _build_session(self):
+        """Cria uma sessão HTTP com pool de conexões e política de retry."""
+        # Apenas falhas de conexão são repetidas: um POST que chegou ao M-Pesa
+        # nunca é reenviado, para não disparar um segundo USSD ao cliente.
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=0,
+            backoff_factor=0.3,
+            allowed_methods=None,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.verify = False
+        return session
+
+    def _get_session(self, port):
+        """Retorna a sessão pooled associada à porta do serviço."""
+        session = self._sessions.get(port)
+        if session is None:
+            with self._sessions_lock:
+                session = self._sessions.get(port)
+                if session is None:
+                    session = self._sessions[port] = self._build_session()
+        return session
+
+    def close(self):
+        """Fecha todas as sessões HTTP abertas (os clientes assíncronos no respetivo loop)."""
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+        for loop, client in list(self._async_clients.items()):
+            asyncclients.close_later(client, loop)
+        self._async_clients.clear()
 
     def _get_token(self):
-        """Gera um token de autorização Bearer codificado em Base64."""
+        """Retorna o token de autorização Bearer (cacheado por processo)."""
         try:
-            # Formata a chave pública
-            public_key = f"-----BEGIN PUBLIC KEY-----\n{self.public_key}\n-----END PUBLIC KEY-----"
-            public_key_bytes = public_key.encode('utf-8')
-            public_key_obj = serialization.load_pem_public_key(public_key_bytes, backend=default_backend())
-
-            # Criptografa a API key
-            encrypted = public_key_obj.encrypt(
-                self.api_key.encode('utf-8'),
-                padding.PKCS1v15()
-            )
-            return base64.b64encode(encrypted).decode('utf-8')
+            return credential_cache.get_token(self.public_key, self.api_key, self.token_ttl)
         except Exception as e:
             logger.error(f"Erro ao gerar token: {str(e)}")
             return None
@@ -60,66 +184,206 @@ class Mpesa:
             'Connection': 'keep-alive'
         }
 
+    def _build_result(self, status_code, payload):
+        """Converte a resposta HTTP do M-Pesa no dicionário de resultado padrão."""
+        result = {
+            'status': status_code,
+            'response': payload
+        }
+        # Tratar códigos de erro do M-Pesa
+        if result['response'] and 'output_ResponseCode' in result['response']:
+            response_code = result['response']['output_ResponseCode']
+            result['error_message'] = ERROR_CODES.get(response_code, "Erro desconhecido")
+            logger.info("Resposta M-Pesa: %s - %s", response_code, result['error_message'],
+                        extra={'reference': payload.get('output_ThirdPartyReference')})
+            if response_code != "INS-0":
+                result['success'] = False
+            else:
+                result['success'] = True
+        else:
+            result['success'] = False
+            result['error_message'] = "Resposta inválida da API M-Pesa"
+            logger.error(f"Resposta inválida: {result['response']}")
+        return result
+
+    def _breaker(self, port):
+        """Circuit breaker da operação servida pela porta."""
+        return breakers.get(BREAKER_NAMES.get(port, f'mpesa.{port}'), self.timeout[1])
+
+    @staticmethod
+    def _circuit_open_result(breaker):
+        """Resultado imediato enquanto o circuito está aberto (sem resposta do upstream)."""
+        logger.warning(f"Chamada M-Pesa rejeitada: circuit breaker {breaker.name} aberto")
+        return {
+            'status': 503,
+            'response': None,
+            'success': False,
+            'error_message': "Serviço M-Pesa temporariamente indisponível (circuito aberto)",
+            'circuit_open': True,
+            'retryable': True
+        }
+
     def _make_request(self, url, port, method, data=None):
         """Faz uma requisição HTTP para a API M-Pesa e trata erros."""
+        breaker = self._breaker(port)
+        if not breaker.allow():
+            metrics.upstream_rejected(breaker.name)
+            return self._circuit_open_result(breaker)
         full_url = f"{self.base_uri}:{port}{url}"
         headers = self._get_headers()
+        metrics.upstream_started(breaker.name)
+        start = time.monotonic()
         try:
-            response = requests.request(
+            response = self._get_session(port).request(
                 method=method,
                 url=full_url,
                 headers=headers,
                 json=data if method in ['POST', 'PUT'] else None,
                 params=data if method == 'GET' else None,
-                timeout=90,
-                verify=False
+                timeout=(self.timeout[0], breaker.timeout())
             )
-            result = {
-                'status': response.status_code,
-                'response': response.json() if response.text else None
-            }
-            # Tratar códigos de erro do M-Pesa
-            if result['response'] and 'output_ResponseCode' in result['response']:
-                response_code = result['response']['output_ResponseCode']
-                result['error_message'] = ERROR_CODES.get(response_code, "Erro desconhecido")
-                logger.info(f"Resposta M-Pesa: {response_code} - {result['error_message']}")
-                if response_code != "INS-0":
-                    result['success'] = False
-                else:
-                    result['success'] = True
-            else:
-                result['success'] = False
-                result['error_message'] = "Resposta inválida da API M-Pesa"
-                logger.error(f"Resposta inválida: {result['response']}")
-            return result
+            return self._finish_request(breaker, response.status_code, response.text, response.json, start)
         except Exception as e:
-            logger.error(f"Erro na requisição para {url}: {str(e)}")
-            return {'status': 500, 'response': None, 'success': False, 'error_message': str(e)}
+            return self._request_failed(breaker, url, e, start)
+        finally:
+            metrics.upstream_finished(breaker.name)
 
-    def c2b(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
-        """Inicia uma transação Customer to Business (C2B)."""
+    def _finish_request(self, breaker, status_code, text, json_loader, start):
+        """Regista latência e código de resultado e monta o resultado padrão."""
+        latency = time.monotonic() - start
+        # Corpo ilegível: a exceção segue para _request_failed, que regista a única falha
+        payload = json_loader() if text else None
+        self._record_outcome(breaker, status_code, latency)
+        result = self._build_result(status_code, payload)
+        metrics.observe_upstream('mpesa', breaker.name, metrics.mpesa_code(result, ERROR_CODES), latency)
+        return result
+
+    @staticmethod
+    def _request_failed(breaker, url, exc, start):
+        """
+        Resultado de uma chamada sem resposta (conexão, timeout ou resposta ilegível).
+
+        'retryable' só é True quando o pedido não chegou ao M-Pesa (request_not_sent).
+        """
+        breaker.record_failure()
+        metrics.observe_upstream('mpesa', breaker.name, metrics.transport_code(exc), time.monotonic() - start)
+        logger.error(f"Erro na requisição para {url}: {str(exc)}")
+        return {'status': 500, 'response': None, 'success': False, 'error_message': str(exc),
+                'retryable': request_not_sent(exc)}
+
+    @staticmethod
+    def _record_outcome(breaker, status_code, latency):
+        """Erros 5xx contam como falha do upstream; os restantes códigos são respostas válidas."""
+        if status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success(latency)
+
+    def _get_async_client(self):
+        """
+        Retorna o httpx.AsyncClient do event loop do servidor ASGI (um por loop),
+        ou None num loop de curta duração (ver payments_mpesa.asyncclients).
+        """
+        loop = asyncio.get_running_loop()
+        if not asyncclients.is_serving_loop(loop):
+            return None
+        client = self._async_clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=self.async_max_connections,
+                max_keepalive_connections=self.pool_size,
+            )
+            # O transport só repete falhas de conexão, tal como a sessão síncrona
+            transport = httpx.AsyncHTTPTransport(retries=self.retries, verify=False, limits=limits)
+            client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            )
+            self._async_clients[loop] = client
+            asyncclients.track(client, loop)
+        return client
+
+    async def _async_make_request(self, url, port, method, data=None):
+        """Versão assíncrona de _make_request, sem bloquear o event loop."""
+        client = self._get_async_client()
+        if client is None:
+            # Loop de curta duração (WSGI, async_to_sync): sessão síncrona pooled numa thread
+            return await sync_to_async(self._make_request, thread_sensitive=False)(url, port, method, data)
+        breaker = self._breaker(port)
+        if not breaker.allow():
+            metrics.upstream_rejected(breaker.name)
+            return self._circuit_open_result(breaker)
+        full_url = f"{self.base_uri}:{port}{url}"
+        headers = self._get_headers()
+        metrics.upstream_started(breaker.name)
+        start = time.monotonic()
+        try:
+            response = await client.request(
+                method,
+                full_url,
+                headers=headers,
+                json=data if method in ['POST', 'PUT'] else None,
+                params=data if method == 'GET' else None,
+                timeout=httpx.Timeout(breaker.timeout(), connect=self.timeout[0]),
+            )
+            return self._finish_request(breaker, response.status_code, response.text, response.json, start)
+        except Exception as e:
+            return self._request_failed(breaker, url, e, start)
+        finally:
+            metrics.upstream_finished(breaker.name)
+
+    def _build_payload(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
+        """Monta o corpo JSON comum às transações C2B e B2C."""
         service_provider_code = service_provider_code or self.service_provider_code
         third_party_reference = third_party_reference or self.default_third_party_reference  # Usa valor estático se não fornecido
-        data = {
+        return {
             "input_TransactionReference": transaction_reference,
             "input_CustomerMSISDN": customer_msisdn,
             "input_Amount": amount,
             "input_ThirdPartyReference": third_party_reference,
             "input_ServiceProviderCode": service_provider_code
         }
-        logger.info(f"Iniciando transação C2B: {data}")
+
+    def c2b(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
+        """Inicia uma transação Customer to Business (C2B)."""
+        data = self._build_payload(transaction_reference, customer_msisdn, amount, third_party_reference, service_provider_code)
+        logger.info("Iniciando transação C2B: %s", data, extra={'reference': transaction_reference})
         return self._make_request('/ipg/v1x/c2bPayment/singleStage/', 18352, 'POST', data)
 
     def b2c(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
         """Inicia uma transação Business to Customer (B2C)."""
-        service_provider_code = service_provider_code or self.service_provider_code
-        third_party_reference = third_party_reference or self.default_third_party_reference  # Usa valor estático se não fornecido
-        data = {
-            "input_TransactionReference": transaction_reference,
-            "input_CustomerMSISDN": customer_msisdn,
-            "input_Amount": amount,
-            "input_ThirdPartyReference": third_party_reference,
-            "input_ServiceProviderCode": service_provider_code
+        data = self._build_payload(transaction_reference, customer_msisdn, amount, third_party_reference, service_provider_code)
+        logger.info("Iniciando transação B2C: %s", data, extra={'reference': transaction_reference})
+        return self._make_request('/ipg/v1x/b2cPayment/', 18345, 'POST', data)
+
+    def _build_query_params(self, query_reference, third_party_reference=None, service_provider_code=None):
+        """Parâmetros da consulta de estado; query_reference aceita o ID da transação, da conversa ou a referência de terceiros."""
+        return {
+            "input_QueryReference": query_reference,
+            "input_ServiceProviderCode": service_provider_code or self.service_provider_code,
+            "input_ThirdPartyReference": third_party_reference or self.default_third_party_reference
         }
-        logger.info(f"Iniciando transação B2C: {data}")
-        return self._make_request('/ipg/v1x/b2cPayment/', 18345, 'POST', data)
\ No newline at end of file
+
+    def query_transaction_status(self, query_reference, third_party_reference=None, service_provider_code=None):
+        """Consulta o estado de uma transação (output_ResponseTransactionStatus)."""
+        params = self._build_query_params(query_reference, third_party_reference, service_provider_code)
+        logger.info("Consultando estado da transação: %s", query_reference, extra={'reference': query_reference})
+        return self._make_request('/ipg/v1x/queryTransactionStatus/', 18353, 'GET', params)
+
+    async def ac2b(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
+        """Versão assíncrona de c2b()."""
+        data = self._build_payload(transaction_reference, customer_msisdn, amount, third_party_reference, service_provider_code)
+        logger.info("Iniciando transação C2B: %s", data, extra={'reference': transaction_reference})
+        return await self._async_make_request('/ipg/v1x/c2bPayment/singleStage/', 18352, 'POST', data)
+
+    async def ab2c(self, transaction_reference, customer_msisdn, amount, third_party_reference=None, service_provider_code=None):
+        """Versão assíncrona de b2c()."""
+        data = self._build_payload(transaction_reference, customer_msisdn, amount, third_party_reference, service_provider_code)
+        logger.info("Iniciando transação B2C: %s", data, extra={'reference': transaction_reference})
+        return await self._async_make_request('/ipg/v1x/b2cPayment/', 18345, 'POST', data)
+
+    async def aquery_transaction_status(self, query_reference, third_party_reference=None, service_provider_code=None):
+        """Versão assíncrona de query_transaction_status()."""
+        params = self._build_query_params(query_reference, third_party_reference, service_provider_code)
+        logger.info("Consultando estado da transação: %s", query_reference, extra={'reference': query_reference})
+        return await self._async_make_request('/ipg/v1x/queryTransactionStatus/', 18353, 'GET', params)
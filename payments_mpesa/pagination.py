@@ -0,0 +1,93 @@
+"""
+Paginação por cursor (keyset) e serialização em streaming de transações.
+
+A ordem é sempre (-created_at, -id): o cursor guarda o par da última linha
+devolvida e a página seguinte começa estritamente depois dele, usando os
+índices em -created_at em vez de OFFSET.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+# Ordem estável usada pela paginação
+KEYSET_ORDERING = ('-created_at', '-id')
+
+
+class InvalidCursor(ValueError):
+    """Cursor malformado enviado pelo cliente."""
+
+
+def encode_cursor(created_at, pk):
+    """Codifica (created_at, id) num cursor opaco, seguro para URLs."""
+    raw = f"{created_at.isoformat()}|{pk}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Descodifica um cursor gerado por encode_cursor()."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeError) as e:
+        raise InvalidCursor(str(e)) from e
+
+
+def apply_keyset(qs, cursor):
+    """Ordena por (-created_at, -id) e, se houver cursor, filtra as linhas seguintes."""
+    qs = qs.order_by(*KEYSET_ORDERING)
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return qs
+
+
+def stream_json_rows(rows, key, serialize, batch_size=500):
+    """
+    Gera um documento JSON {key: [...]} linha a linha.
+
+    As linhas são agrupadas em blocos de `batch_size` para reduzir o número de
+    escritas no socket sem acumular o resultado inteiro em memória.
+    """
+    yield f'{{"{key}": ['
+    buffer = []
+    first = True
+    for row in rows:
+        item = json.dumps(serialize(row), cls=DjangoJSONEncoder)
+        buffer.append(item if first else ',' + item)
+        first = False
+        if len(buffer) >= batch_size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+    yield ']}'
+
+
+def iterate_keyset(rows, chunk_size=2000, descending=False):
+    """
+    Percorre um queryset .values() (com created_at e id) por (created_at, id),
+    ascendente ou, com descending=True, na ordem da listagem (-created_at, -id).
+
+    Cada bloco é uma query separada que começa depois da última linha lida:
+    memória constante em qualquer base de dados (o MySQL não tem cursores do
+    lado do servidor no Django; .iterator() carregaria o resultado inteiro).
+    """
+    ordering = KEYSET_ORDERING if descending else ('created_at', 'id')
+    last = None
+    while True:
+        qs = rows
+        if last is not None:
+            if descending:
+                qs = qs.filter(Q(created_at__lt=last[0]) | Q(created_at=last[0], id__lt=last[1]))
+            else:
+                qs = qs.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], id__gt=last[1]))
+        chunk = list(qs.order_by(*ordering)[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last = (chunk[-1]['created_at'], chunk[-1]['id'])
@@ -0,0 +1,101 @@
+"""
+Respostas completas dos upstreams (Transaction.raw_response) fora da tabela Transaction.
+
+O JSON do M-Pesa e o resultado eMola (incluindo a string SOAP `original`)
+ficam em TransactionPayload, comprimidos com zlib, numa linha por transação.
+Transaction.raw_response é uma propriedade: só lê TransactionPayload quando é
+usada (admin, exportação com include_raw, reconciliação) e, quando é
+atribuída, a gravação é feita pelo sinal post_save. Operações em massa
+(bulk_update) devem chamar store_payloads() diretamente, e quem lê muitas
+transações deve usar attach_payloads()/with_raw_response() (uma query por bloco).
+
+Transaction.response_code guarda o código de resposta (output_ResponseCode ou
+errorCode) para os filtros que antes liam o JSON.
+"""
+
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction as db_transaction
+
+from .models import TransactionPayload
+
+DEFAULT_PAYLOAD_CONFIG = {
+    'COMPRESS_LEVEL': 6,
+}
+
+
+def get_payload_config():
+    """Retorna PAYLOAD_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_PAYLOAD_CONFIG, **getattr(settings, 'PAYLOAD_CONFIG', {})}
+
+
+def compress_json(value, level=None):
+    """JSON compacto comprimido com zlib."""
+    level = get_payload_config()['COMPRESS_LEVEL'] if level is None else level
+    return zlib.compress(json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':')).encode('utf-8'), level)
+
+
+def decompress_json(data):
+    """Inverso de compress_json (None para dados vazios)."""
+    if not data:
+        return None
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def response_code(raw_response):
+    """Código de resposta do upstream (M-Pesa output_ResponseCode, eMola errorCode) ou None."""
+    if not isinstance(raw_response, dict):
+        return None
+    code = raw_response.get('output_ResponseCode') or raw_response.get('errorCode')
+    return str(code)[:20] if code is not None else None
+
+
+def load_payloads(transaction_ids):
+    """{transaction_id: raw_response} para as transações com payload guardado."""
+    rows = TransactionPayload.objects.filter(transaction_id__in=list(transaction_ids)).values_list('transaction_id', 'data')
+    return {transaction_id: decompress_json(data) for transaction_id, data in rows}
+
+
+def store_payloads(items):
+    """Grava [(transaction_id, raw_response)]; raw_response None apaga o payload."""
+    items = list(items)
+    if not items:
+        return
+    with db_transaction.atomic():
+        TransactionPayload.objects.filter(transaction_id__in=[transaction_id for transaction_id, _ in items]).delete()
+        TransactionPayload.objects.bulk_create([
+            TransactionPayload(transaction_id=transaction_id, data=compress_json(value))
+            for transaction_id, value in items
+            if value is not None
+        ])
+
+
+def attach_payloads(transactions):
+    """Carrega raw_response de várias Transaction numa única query (evita uma query por linha)."""
+    transactions = list(transactions)
+    payloads = load_payloads(txn.pk for txn in transactions)
+    for txn in transactions:
+        txn._raw_response = payloads.get(txn.pk)
+    return transactions
+
+
+def with_raw_response(rows, chunk_size=500):
+    """Acrescenta 'raw_response' a linhas .values() (com 'id'), uma query por bloco."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from _attach_rows(chunk)
+            chunk = []
+    if chunk:
+        yield from _attach_rows(chunk)
+
+
+def _attach_rows(rows):
+    payloads = load_payloads(row['id'] for row in rows)
+    for row in rows:
+        row['raw_response'] = payloads.get(row['id'])
+        yield row
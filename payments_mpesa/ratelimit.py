@@ -0,0 +1,373 @@
+"""
+Controlo de admissão dos endpoints de pagamento.
+
+Cada pedido consome um token de cada bucket aplicável (client_id do token
+OAuth, fromApp e MSISDN do cliente); um bucket vazio rejeita o pedido com 429
+e Retry-After, pelo que uma app abusiva esgota só os seus próprios buckets.
+Os buckets recarregam RATE tokens/segundo até BURST.
+
+Backends:
+  - 'database' (padrão): buckets em RateLimitBucket, partilhados por todos os
+    workers; cada consumo é um único UPDATE condicional (sem Redis);
+  - 'local': buckets em memória do processo (limites efetivos x workers).
+
+Além dos buckets, MAX_IN_FLIGHT limita as chamadas síncronas ao upstream em
+curso (o modo de fila já é limitado pelo worker de pagamentos). Com o backend
+'database' o limite é global: cada chamada ocupa uma de MAX_IN_FLIGHT linhas de
+UpstreamSlot com um UPDATE condicional e um lease (IN_FLIGHT_LEASE segundos,
+acima do maior timeout de leitura), pelo que a vaga de um worker morto volta a
+ficar livre. Com 'local' o limite é por processo.
+Limpeza dos buckets inativos: python manage.py purge_rate_limit_buckets
+"""
+
+import itertools
+import math
+import os
+import random
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Q, Value
+from django.db.models.functions import Least
+from django.db.models.lookups import GreaterThanOrEqual
+from django.http import JsonResponse
+
+from .models import RateLimitBucket, UpstreamSlot
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT_CONFIG = {
+    'ENABLED': True,
+    'BACKEND': 'database',
+    'BUCKETS': {
+        'client': {'RATE': 20, 'BURST': 60},
+        'app': {'RATE': 10, 'BURST': 30},
+        'msisdn': {'RATE': 0.05, 'BURST': 3},
+    },
+    'OVERRIDES': {},
+    'MAX_IN_FLIGHT': 500,
+    'IN_FLIGHT_LEASE': 300,
+    'PURGE_BATCH_SIZE': 1000,
+}
+
+
+class AdmissionRejected(Exception):
+    """Pedido recusado pelo controlo de admissão."""
+
+    def __init__(self, limit, retry_after):
+        super().__init__(f"Limite {limit} excedido")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+def get_rate_limit_config():
+    """Retorna RATE_LIMIT_CONFIG completado com os valores padrão."""
+    config = {**DEFAULT_RATE_LIMIT_CONFIG, **getattr(settings, 'RATE_LIMIT_CONFIG', {})}
+    config['BUCKETS'] = {**DEFAULT_RATE_LIMIT_CONFIG['BUCKETS'], **config['BUCKETS']}
+    return config
+
+
+def rejection_response(exc):
+    """Resposta 429 com Retry-After (segundos inteiros)."""
+    response = JsonResponse({
+        'error': 'Limite de pedidos excedido',
+        'limit': exc.limit,
+        'retry_after': exc.retry_after,
+    }, status=429)
+    response['Retry-After'] = str(exc.retry_after)
+    return response
+
+
+def _retry_after(available, cost, rate):
+    if rate <= 0:
+        return 3600
+    return max(1, math.ceil((cost - available) / rate))
+
+
+class LocalBuckets:
+    """Token buckets em memória do processo."""
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, burst, cost=1, now=None):
+        """Consome `cost` tokens; retorna 0 ou os segundos até haver tokens suficientes."""
+        now = now or time.time()
+        with self._lock:
+            tokens, refilled_at = self._buckets.get(key, (burst, now))
+            available = min(burst, tokens + (now - refilled_at) * rate)
+            if available < cost:
+                self._buckets[key] = (available, now)
+                return _retry_after(available, cost, rate)
+            if len(self._buckets) >= self.MAX_KEYS and key not in self._buckets:
+                self._prune(now)
+            self._buckets[key] = (available - cost, now)
+            return 0
+
+    def refund(self, key, rate, burst, cost=1):
+        with self._lock:
+            if key in self._buckets:
+                tokens, refilled_at = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + cost), refilled_at)
+
+    def _prune(self, now):
+        # Buckets que já estariam cheios equivalem a não existirem
+        full = [key for key, (tokens, refilled_at) in self._buckets.items() if now - refilled_at > 3600]
+        for key in full:
+            del self._buckets[key]
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBuckets:
+    """Token buckets em RateLimitBucket (UPDATE condicional, atómico na BD)."""
+
+    def consume(self, key, rate, burst, cost=1, now=None):
+        """Consome `cost` tokens; retorna 0 ou os segundos até haver tokens suficientes."""
+        now = now or time.time()
+        available = Least(Value(float(burst)), F('tokens') + (Value(now) - F('refilled_at')) * Value(float(rate)))
+        updated = RateLimitBucket.objects.filter(
+            GreaterThanOrEqual(available, Value(float(cost))), key=key
+        ).update(tokens=available - Value(float(cost)), refilled_at=now)
+        if updated:
+            return 0
+
+        bucket = RateLimitBucket.objects.filter(key=key).only('tokens', 'refilled_at').first()
+        if bucket is None:
+            try:
+                RateLimitBucket.objects.create(key=key, tokens=burst - cost, refilled_at=now)
+                return 0
+            except IntegrityError:
+                # Outro worker criou o bucket entretanto
+                return self.consume(key, rate, burst, cost, now)
+        current = min(burst, bucket.tokens + (now - bucket.refilled_at) * rate)
+        return _retry_after(current, cost, rate)
+
+    def refund(self, key, rate, burst, cost=1):
+        RateLimitBucket.objects.filter(key=key).update(
+            tokens=Least(Value(float(burst)), F('tokens') + Value(float(cost)))
+        )
+
+
+class InFlightLimiter:
+    """Limite de chamadas ao upstream em curso no processo."""
+
+    def __init__(self):
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, limit):
+        """Ocupa uma vaga; sem vagas levanta AdmissionRejected."""
+        with self._lock:
+            if limit and self._count >= limit:
+                raise AdmissionRejected('in_flight', 1)
+            self._count += 1
+
+    def release(self):
+        with self._lock:
+            self._count -= 1
+
+    @contextmanager
+    def slot(self, limit):
+        """Reserva uma vaga durante o bloco; sem vagas levanta AdmissionRejected."""
+        self.acquire(limit)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @property
+    def count(self):
+        return self._count
+
+
+class DatabaseInFlight:
+    """Vagas em UpstreamSlot (linhas 1..limite), partilhadas por todos os workers."""
+
+    def __init__(self):
+        self._sequence = itertools.count(1)
+        self._created = 0
+
+    def _ensure_slots(self, limit):
+        if self._created < limit:
+            UpstreamSlot.objects.bulk_create([UpstreamSlot(id=i) for i in range(1, limit + 1)], ignore_conflicts=True)
+            self._created = limit
+
+    def acquire(self, limit, lease, now=None):
+        """
+        Ocupa uma vaga livre (lease expirado) com um UPDATE condicional.
+
+        Retorna (id, holder) ou None se todas as vagas estiverem ocupadas. A
+        procura começa numa vaga aleatória para os workers não disputarem a mesma.
+        """
+        now = now or time.time()
+        self._ensure_slots(limit)
+        holder = f"{socket.gethostname()}:{os.getpid()}:{next(self._sequence)}"[:64]
+        start = random.randint(1, limit)
+        for region in (Q(id__gte=start), Q(id__lt=start)):
+            while True:
+                free = list(
+                    UpstreamSlot.objects.filter(region, id__lte=limit, lease_until__lt=now)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:8]
+                )
+                if not free:
+                    break
+                for slot_id in free:
+                    if UpstreamSlot.objects.filter(id=slot_id, lease_until__lt=now).update(
+                        holder=holder, lease_until=now + lease
+                    ):
+                        return slot_id, holder
+        return None
+
+    def release(self, slot):
+        slot_id, holder = slot
+        UpstreamSlot.objects.filter(id=slot_id, holder=holder).update(holder='', lease_until=0)
+
+    def count(self, limit, now=None):
+        """Vagas ocupadas (leases em curso)."""
+        return UpstreamSlot.objects.filter(id__lte=limit, lease_until__gte=now or time.time()).count()
+
+
+local_buckets = LocalBuckets()
+database_buckets = DatabaseBuckets()
+in_flight = InFlightLimiter()
+database_in_flight = DatabaseInFlight()
+
+
+def _bucket_limits(config, kind, value):
+    limits = config['BUCKETS'][kind]
+    override = config['OVERRIDES'].get(f'{kind}:{value}', {})
+    return override.get('RATE', limits['RATE']), override.get('BURST', limits['BURST'])
+
+
+def admit(client_id=None, from_app=None, msisdn=None, config=None):
+    """
+    Consome um token de cada bucket aplicável (client, app, msisdn).
+
+    Se algum bucket estiver vazio devolve os tokens já consumidos e levanta
+    AdmissionRejected com o Retry-After do bucket que recusou.
+    """
+    config = config or get_rate_limit_config()
+    if not config['ENABLED']:
+        return
+    backend = database_buckets if config['BACKEND'] == 'database' else local_buckets
+    consumed = []
+    for kind, value in (('client', client_id), ('app', from_app), ('msisdn', msisdn)):
+        if not value:
+            continue
+        rate, burst = _bucket_limits(config, kind, value)
+        key = f'{kind}:{value}'[:150]
+        retry_after = backend.consume(key, rate, burst)
+        if retry_after:
+            for done_key, done_rate, done_burst in consumed:
+                backend.refund(done_key, done_rate, done_burst)
+            logger.warning(f"Pedido recusado pelo rate limit {key} (Retry-After {retry_after} s)")
+            raise AdmissionRejected(kind, retry_after)
+        consumed.append((key, rate, burst))
+
+
+async def aadmit(client_id=None, from_app=None, msisdn=None, config=None):
+    """Versão assíncrona de admit() (a BD corre fora do event loop)."""
+    config = config or get_rate_limit_config()
+    if not config['ENABLED']:
+        return
+    if config['BACKEND'] == 'database':
+        await sync_to_async(admit)(client_id, from_app, msisdn, config)
+    else:
+        admit(client_id, from_app, msisdn, config)
+
+
+class UpstreamSlotGuard:
+    """Vaga de chamada ao upstream, como context manager síncrono (with) ou assíncrono (async with)."""
+
+    def __init__(self, config):
+        self.limit = config['MAX_IN_FLIGHT'] if config['ENABLED'] else 0
+        self.lease = config['IN_FLIGHT_LEASE']
+        self.shared = config['BACKEND'] == 'database'
+        self._slot = None
+
+    def _acquire(self):
+        if not self.limit:
+            return
+        if not self.shared:
+            in_flight.acquire(self.limit)
+            return
+        self._slot = database_in_flight.acquire(self.limit, self.lease)
+        if self._slot is None:
+            logger.warning(f"Chamada ao upstream recusada: {self.limit} vagas ocupadas")
+            raise AdmissionRejected('in_flight', 1)
+
+    def _release(self):
+        if not self.limit:
+            return
+        if not self.shared:
+            in_flight.release()
+        elif self._slot is not None:
+            database_in_flight.release(self._slot)
+            self._slot = None
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+    async def __aenter__(self):
+        if self.shared and self.limit:
+            await sync_to_async(self._acquire)()
+        else:
+            self._acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.shared and self.limit:
+            await sync_to_async(self._release)()
+        else:
+            self._release()
+
+
+def upstream_slot(config=None):
+    """Vaga para uma chamada síncrona ao upstream (MAX_IN_FLIGHT global com o backend 'database')."""
+    return UpstreamSlotGuard(config or get_rate_limit_config())
+
+
+def purge_idle_buckets(batch_size=None, now=None):
+    """
+    Apaga os buckets que já recarregaram por completo (equivalentes a buckets novos).
+
+    Retorna o número total de linhas apagadas.
+    """
+    config = get_rate_limit_config()
+    batch_size = batch_size or config['PURGE_BATCH_SIZE']
+    now = now or time.time()
+    # Tempo máximo de recarga entre todos os buckets configurados
+    limits = list(config['BUCKETS'].values()) + list(config['OVERRIDES'].values())
+    idle = max(
+        limit.get('BURST', 0) / limit['RATE'] for limit in limits if limit.get('RATE')
+    ) if limits else 0
+    total = 0
+    while True:
+        ids = list(
+            RateLimitBucket.objects.filter(refilled_at__lt=now - idle)
+            .order_by('refilled_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        deleted, _ = RateLimitBucket.objects.filter(id__in=ids).delete()
+        total += deleted
+        logger.info(f"Token buckets inativos apagados: {deleted} (total {total})")
+    return total
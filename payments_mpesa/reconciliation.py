@@ -0,0 +1,294 @@
+"""
+Reconciliação automática de pagamentos M-Pesa com resultado ambíguo.
+
+Quando o M-Pesa responde INS-9 (timeout) ou a chamada termina sem resposta
+(timeout ou falha de rede do nosso lado), a Transaction fica 'error' embora o
+cliente possa ter pago. O mesmo vale para os jobs da fila sem resultado
+(PaymentJob 'ambiguous': timeout de leitura ou lease expirado), cuja
+Transaction fica 'pending', e os pagamentos C2B síncronos cujo processo morreu
+entre a gravação da linha 'pending' e o resultado. O reconciliador (manage.py reconcile_transactions)
+procura essas linhas em lotes pelo índice (status, -created_at), consulta o
+estado no M-Pesa com concorrência limitada e grava os resultados com
+bulk_update. Cada linha é consultada no máximo MAX_ATTEMPTS vezes, com backoff
+exponencial; com o circuito aberto nenhuma consulta chega ao M-Pesa.
+
+As chaves de idempotência C2B sem resposta final (dono morto ou cliente
+desligado a meio) são resolvidas pela linha gravada antes da chamada
+(resolve_ambiguous_keys): sem linha, o pedido nunca chegou ao fornecedor e a
+chave é libertada; com a linha finalizada, a resposta passa a ser a guardada.
+"""
+
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from payments_emola.models import Transaction as EmolaTransaction
+
+from .models import Transaction, PaymentJob, IdempotencyKey
+from .idempotency import complete_key, release_key
+from .mpesa import Mpesa
+from .bulk import refresh_batch_status
+from .payloads import attach_payloads, store_payloads
+from . import stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECONCILIATION_CONFIG = {
+    'MIN_AGE': 180,
+    'LOOKBACK_HOURS': 72,
+    'BATCH_SIZE': 100,
+    'CONCURRENCY': 4,
+    'MAX_ATTEMPTS': 6,
+    'BACKOFF': 60,
+    'INTERVAL': 60,
+}
+
+# Códigos de resposta após os quais o resultado real é desconhecido
+AMBIGUOUS_CODES = ('INS-9',)
+
+# output_ResponseTransactionStatus -> status local definitivo
+FINAL_STATUSES = {
+    'Completed': 'success',
+    'Cancelled': 'error',
+    'Expired': 'error',
+    'Failed': 'error',
+}
+
+UPDATE_FIELDS = [
+    'status', 'message', 'conversation_id', 'response_code',
+    'reconcile_attempts', 'next_reconcile_at', 'reconciled_at', 'updated_at',
+]
+
+
+def get_reconciliation_config():
+    """Retorna RECONCILIATION_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_RECONCILIATION_CONFIG, **getattr(settings, 'RECONCILIATION_CONFIG', {})}
+
+
+def find_candidates(limit, config=None, now=None):
+    """Transações M-Pesa com resultado ambíguo cuja próxima consulta já venceu."""
+    config = config or get_reconciliation_config()
+    now = now or timezone.now()
+    ambiguous = (
+        Q(status='error') & (Q(response_code__isnull=True) | Q(response_code__in=AMBIGUOUS_CODES)) |
+        Q(status='pending', jobs__status='ambiguous') |
+        Q(status='pending', jobs__isnull=True)  # C2B síncrono interrompido (linha gravada antes da chamada)
+    )
+    return list(
+        Transaction.objects.filter(
+            ambiguous,
+            created_at__gte=now - timedelta(hours=config['LOOKBACK_HOURS']),
+            created_at__lte=now - timedelta(seconds=config['MIN_AGE']),
+            provider='mpesa',
+            reconciled_at__isnull=True,
+            reconcile_attempts__lt=config['MAX_ATTEMPTS'],
+        )
+        .filter(Q(next_reconcile_at__isnull=True) | Q(next_reconcile_at__lte=now))
+        .order_by('-created_at')[:limit]
+    )
+
+
+def _query(mpesa, txn):
+    """Consulta o estado de uma transação (cada consulta usa a sua própria referência)."""
+    try:
+        return mpesa.query_transaction_status(
+            txn.transaction_id or txn.third_party_reference,
+            third_party_reference=uuid.uuid4().hex[:20].upper()
+        )
+    except Exception as e:
+        logger.error(f"Erro ao consultar {txn.transaction_reference}: {str(e)}")
+        return {'status': 500, 'response': None, 'success': False, 'error_message': str(e)}
+
+
+def query_before_resend(txn, mpesa=None):
+    """
+    Consulta o estado de um pedido já tentado antes de o reenviar.
+
+    Retorna (estado, resposta): 'not_found' (INS-10, o pedido não chegou ao
+    M-Pesa e pode ser reenviado), 'final' (resultado definitivo, a aplicar
+    com apply_query_result) ou None (desconhecido: não reenviar).
+    """
+    response = _query(mpesa or Mpesa.get_instance(), txn)
+    payload = response.get('response') or {}
+    if payload.get('output_ResponseCode') == 'INS-10':
+        return 'not_found', response
+    if response.get('success', False) and payload.get('output_ResponseTransactionStatus') in FINAL_STATUSES:
+        return 'final', response
+    return None, response
+
+
+def apply_query_result(txn, response, config, now):
+    """
+    Aplica a resposta da consulta à transação (em memória).
+
+    Retorna 'resolved', 'retry' ou 'skipped' (circuito aberto: a tentativa não conta).
+    """
+    if response.get('circuit_open'):
+        return 'skipped'
+
+    payload = response.get('response') or {}
+    txn.reconcile_attempts += 1
+    txn.updated_at = now
+
+    final = None
+    if payload.get('output_ResponseCode') == 'INS-10':
+        final = 'error'  # O pedido nunca chegou ao M-Pesa
+    elif response.get('success', False):
+        final = FINAL_STATUSES.get(payload.get('output_ResponseTransactionStatus'))
+
+    if final is None:
+        txn.next_reconcile_at = now + timedelta(seconds=config['BACKOFF'] * 2 ** (txn.reconcile_attempts - 1))
+        return 'retry'
+
+    txn.reconciled_at = now
+    txn.next_reconcile_at = None
+    txn.conversation_id = txn.conversation_id or payload.get('output_ConversationID')
+    txn.raw_response = {**(txn.raw_response or {}), 'reconciliation': payload}
+    if final == 'success':
+        txn.message = 'Pagamento confirmado pela consulta de estado'
+    elif txn.status == 'pending':
+        txn.message = 'Pagamento não concluído (confirmado pela consulta de estado)'
+    else:
+        txn.message = f"{txn.message or ''} (confirmado pela consulta de estado)".strip()
+    txn.status = final
+    return 'resolved'
+
+
+def reconcile_batch(transactions, mpesa=None, config=None):
+    """Consulta o M-Pesa para o lote (concorrência limitada) e grava tudo com bulk_update."""
+    config = config or get_reconciliation_config()
+    mpesa = mpesa or Mpesa.get_instance()
+    now = timezone.now()
+
+    with ThreadPoolExecutor(max_workers=config['CONCURRENCY']) as pool:
+        responses = list(pool.map(lambda txn: _query(mpesa, txn), transactions))
+
+    # raw_response das transações resolvidas é estendido: uma query para o lote
+    attach_payloads(transactions)
+    summary = {'resolved': 0, 'success': 0, 'retry': 0, 'skipped': 0}
+    changed = []
+    resolved = {}  # status anterior -> transações resolvidas
+    for txn, response in zip(transactions, responses):
+        old_status = txn.status
+        outcome = apply_query_result(txn, response, config, now)
+        summary[outcome] += 1
+        if outcome == 'skipped':
+            continue
+        changed.append(txn)
+        if outcome == 'resolved':
+            resolved.setdefault(old_status, []).append(txn)
+        if txn.status == 'success':
+            summary['success'] += 1
+
+    if changed:
+        with db_transaction.atomic():
+            Transaction.objects.bulk_update(changed, UPDATE_FIELDS, batch_size=500)
+            # bulk_update não dispara post_save
+            store_payloads((txn.pk, txn.raw_response) for txn in changed if txn._raw_response_changed)
+            for old_status, txns in resolved.items():
+                stats.record_status_change(txns, old_status)
+            # Jobs ambíguos da fila ficam com o resultado confirmado
+            for final in ('success', 'error'):
+                ids = [txn.pk for txns in resolved.values() for txn in txns if txn.status == final]
+                if ids:
+                    PaymentJob.objects.filter(transaction_id__in=ids, status='ambiguous').update(
+                        status='done' if final == 'success' else 'failed', updated_at=now
+                    )
+        for batch_id in {txn.batch_id for txns in resolved.values() for txn in txns if txn.batch_id}:
+            refresh_batch_status(batch_id)
+
+    logger.info(
+        f"Reconciliação: {len(transactions)} consultadas, {summary['resolved']} resolvidas "
+        f"({summary['success']} pagas), {summary['retry']} a repetir, {summary['skipped']} ignoradas"
+    )
+    return summary
+
+
+def _mpesa_key_response(txn):
+    """Resposta final (body, status) de um C2B M-Pesa, como a de payments_mpesa.views._execute_c2b."""
+    if txn.status == 'success':
+        return {
+            'success': True,
+            'status': 'success',
+            'transaction_id': txn.transaction_id,
+            'conversation_id': txn.conversation_id,
+            'third_party_reference': txn.third_party_reference,
+            'customer_msisdn': txn.customer_msisdn,
+            'amount': str(txn.amount),
+            'transaction_reference': txn.transaction_reference,
+            'message': txn.message
+        }, 200
+    return {'success': False, 'status': 'error', 'message': txn.message, 'response': None}, 400
+
+
+def _emola_key_response(txn):
+    """Resposta final (body, status) de um push eMola, como a de payments_mpesa.views._execute_emola_c2b."""
+    if txn.status == 'failed':
+        return {'success': False, 'status': 'error', 'provider': 'emola', 'message': 'Falha no push eMola',
+                'response': None}, 400
+    # O resultado do cliente chega pelo callback: a resposta do push é sempre 'pending'
+    return {
+        'success': True,
+        'status': 'pending',
+        'provider': 'emola',
+        'trans_id': txn.trans_id,
+        'request_id': txn.request_id,
+        'transaction_reference': txn.ref_no,
+        'customer_msisdn': txn.msisdn,
+        'amount': str(txn.amount),
+        'message': 'Aguarda confirmação do cliente'
+    }, 202
+
+
+def resolve_ambiguous_keys(limit=None, config=None, now=None):
+    """
+    Resolve as chaves de idempotência C2B sem resposta final.
+
+    Considera as chaves 'ambiguous' e as 'in_progress' com o lock expirado,
+    com pelo menos MIN_AGE segundos. A linha da transação é procurada pela
+    referência enviada ao fornecedor: sem linha a chave é libertada (o pedido
+    não saiu); com a linha M-Pesa ainda 'pending' a chave espera pela
+    reconciliação da linha. Retorna (concluídas, libertadas).
+    """
+    config = config or get_reconciliation_config()
+    now = now or timezone.now()
+    records = list(
+        IdempotencyKey.objects.filter(
+            Q(status='ambiguous') | Q(status='in_progress', locked_until__lt=now),
+            operation='C2B',
+            created_at__lte=now - timedelta(seconds=config['MIN_AGE']),
+            expires_at__gt=now,
+        ).exclude(upstream_reference='').order_by('created_at')[:limit or config['BATCH_SIZE']]
+    )
+    completed = released = 0
+    for record in records:
+        if record.provider == 'emola':
+            txn = EmolaTransaction.objects.filter(trans_id=record.upstream_reference).first()
+            response = _emola_key_response(txn) if txn is not None else None
+        else:
+            txn = (
+                Transaction.objects
+                .filter(transaction_type='C2B', third_party_reference=record.upstream_reference)
+                .first()
+            )
+            if txn is not None and txn.status == 'pending':
+                continue
+            response = _mpesa_key_response(txn) if txn is not None else None
+
+        if response is None:
+            release_key(record)
+            released += 1
+        else:
+            body, status = response
+            complete_key(record, status, body)
+            completed += 1
+
+    if records:
+        logger.info(f"Chaves de idempotência sem resposta: {completed} concluídas, {released} libertadas")
+    return completed, released
@@ -0,0 +1,201 @@
+"""
+Leituras de relatórios numa réplica da base de dados.
+
+As views decoradas com @use_replica (listagem, relatórios, exportação) e a
+changelist do admin de Transaction leem do alias READ_REPLICA_CONFIG['ALIAS']
+(apenas os modelos em MODELS); tudo o resto, incluindo todas as escritas e a
+validação dos tokens OAuth, continua no 'default'.
+
+A réplica não é usada quando:
+  - o pedido fez uma escrita (read-your-writes dentro do pedido);
+  - o cliente escreveu há menos de PIN_SECONDS: a ReplicaPinningMiddleware
+    envia o cookie PIN_COOKIE após um pedido com escritas;
+  - o atraso da réplica excede MAX_LAG segundos, medido a cada
+    LAG_CHECK_INTERVAL segundos pela diferença entre o created_at mais
+    recente de Transaction no primário e na réplica (funciona com MySQL e com
+    dois ficheiros SQLite); uma réplica inacessível conta como atrasada.
+"""
+
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_READ_REPLICA_CONFIG = {
+    'ALIAS': 'replica',
+    'PIN_SECONDS': 5,
+    'PIN_COOKIE': 'db_pinned',
+    'MAX_LAG': 10,
+    'LAG_CHECK_INTERVAL': 5,
+    # Só estes modelos são lidos da réplica (tokens OAuth, chaves, etc. ficam no primário)
+    'MODELS': (
+        'payments_mpesa.transaction',
+        'payments_mpesa.transactiondailystats',
+        'payments_mpesa.transactionarchive',
+        'payments_mpesa.transactionpayload',
+        'payments_emola.transaction',
+    ),
+}
+
+# Alias de leitura do pedido atual (None = primário)
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+# Estado de escrita do pedido: dict mutável partilhado com as threads de sync_to_async
+_request_state = contextvars.ContextVar('replica_request_state', default=None)
+
+
+def get_read_replica_config():
+    """Retorna READ_REPLICA_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_READ_REPLICA_CONFIG, **getattr(settings, 'READ_REPLICA_CONFIG', {})}
+
+
+def replica_configured(config=None):
+    config = config or get_read_replica_config()
+    return config['ALIAS'] in settings.DATABASES
+
+
+class LagMonitor:
+    """Atraso da réplica, medido no máximo uma vez a cada LAG_CHECK_INTERVAL segundos."""
+
+    def __init__(self):
+        self._checked_at = 0.0
+        self._healthy = False
+        self._lag = None
+        self._lock = threading.Lock()
+
+    def _latest(self, alias):
+        from .models import Transaction
+        return Transaction.objects.using(alias).order_by('-created_at').values_list('created_at', flat=True).first()
+
+    def _measure(self, config):
+        try:
+            replica = self._latest(config['ALIAS'])
+            primary = self._latest('default')
+        except DatabaseError as e:
+            logger.warning(f"Réplica {config['ALIAS']} inacessível: {str(e)}")
+            return None
+        if primary is None:
+            return 0.0
+        if replica is None:
+            return float('inf')
+        return max(0.0, (primary - replica).total_seconds())
+
+    def healthy(self, config):
+        """True se a réplica está dentro de MAX_LAG (mede de novo se a medição expirou)."""
+        now = time.monotonic()
+        if now - self._checked_at < config['LAG_CHECK_INTERVAL']:
+            return self._healthy
+        with self._lock:
+            if now - self._checked_at >= config['LAG_CHECK_INTERVAL']:
+                self._lag = self._measure(config)
+                healthy = self._lag is not None and self._lag <= config['MAX_LAG']
+                if self._healthy and not healthy:
+                    logger.warning(f"Réplica atrasada ({self._lag} s): leituras no primário")
+                self._healthy = healthy
+                self._checked_at = time.monotonic()
+        return self._healthy
+
+    @property
+    def lag(self):
+        return self._lag
+
+    def reset(self):
+        with self._lock:
+            self._checked_at = 0.0
+
+
+lag_monitor = LagMonitor()
+
+
+def start_request():
+    """Inicia o estado de escrita do pedido (chamado pela middleware)."""
+    return _request_state.set({'wrote': False})
+
+
+def finish_request(token):
+    """Termina o estado do pedido; retorna True se houve escritas."""
+    state = _request_state.get()
+    _request_state.reset(token)
+    return bool(state and state['wrote'])
+
+
+def choose_read_alias(request=None, config=None):
+    """Alias para as leituras de relatório deste pedido (None = primário)."""
+    config = config or get_read_replica_config()
+    if not replica_configured(config):
+        return None
+    state = _request_state.get()
+    if state is not None and state['wrote']:
+        return None
+    if request is not None and request.COOKIES.get(config['PIN_COOKIE']):
+        return None
+    if not lag_monitor.healthy(config):
+        return None
+    return config['ALIAS']
+
+
+def _iter_with_alias(content, alias):
+    """Mantém o alias durante a geração de uma resposta em streaming."""
+    iterator = iter(content)
+    while True:
+        token = _read_alias.set(alias)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _read_alias.reset(token)
+        yield chunk
+
+
+def use_replica(view):
+    """Decorator de views só de leitura: as queries vão para a réplica quando possível."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        alias = choose_read_alias(request)
+        if alias is None:
+            return view(request, *args, **kwargs)
+        token = _read_alias.set(alias)
+        try:
+            response = view(request, *args, **kwargs)
+            # TemplateResponse (ex.: changelist do admin) só consulta a BD ao renderizar
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        finally:
+            _read_alias.reset(token)
+        if response.streaming:
+            response.streaming_content = _iter_with_alias(response.streaming_content, alias)
+        return response
+    return wrapper
+
+
+class ReplicaRouter:
+    """DATABASE_ROUTERS: leituras na réplica só dentro de @use_replica; escritas sempre no primário."""
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None or model._meta.label_lower not in get_read_replica_config()['MODELS']:
+            return None
+        state = _request_state.get()
+        if state is not None and state['wrote']:
+            return None  # Read-your-writes dentro do pedido
+        return alias
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state['wrote'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Réplica e primário têm os mesmos dados
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # O esquema chega à réplica pela replicação
+        return db == 'default'
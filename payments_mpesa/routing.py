@@ -0,0 +1,100 @@
+"""
+Normalização de MSISDN e escolha do provider pelo prefixo do número.
+
+A tabela de prefixos (PAYMENT_ROUTING_CONFIG['PREFIXES'], prefixos nacionais
+sem o 258) é compilada uma vez por versão do registo de comerciantes; cada
+Merchant pode sobrepor regras em routing_rules (ex.: {"8610": "mpesa"} ou
+{"87": null} para recusar um prefixo). A decisão é uma pesquisa em dicionário
+por comprimento de prefixo (o mais longo ganha), sem acesso à BD.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+DEFAULT_PAYMENT_ROUTING_CONFIG = {
+    'PREFIXES': {
+        '84': 'mpesa',
+        '85': 'mpesa',
+        '86': 'emola',
+        '87': 'emola',
+    },
+}
+
+PROVIDERS = ('mpesa', 'emola')
+COUNTRY_CODE = '258'
+NATIONAL_LENGTH = 9
+
+# Separadores aceites na entrada (removidos antes de validar)
+_SEPARATORS = str.maketrans('', '', ' -().')
+
+
+class InvalidMsisdn(ValueError):
+    """Número de telefone com formato inválido."""
+
+
+class UnroutableMsisdn(ValueError):
+    """Nenhum provider configurado para o prefixo do número."""
+
+
+def get_payment_routing_config():
+    """Retorna PAYMENT_ROUTING_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_PAYMENT_ROUTING_CONFIG, **getattr(settings, 'PAYMENT_ROUTING_CONFIG', {})}
+
+
+def normalize_msisdn(phone):
+    """
+    Normaliza para 258XXXXXXXXX.
+
+    Aceita o número nacional (9 dígitos), com indicativo (258, +258, 00258) e
+    separadores comuns; qualquer outro formato levanta InvalidMsisdn.
+    """
+    digits = str(phone or '').translate(_SEPARATORS)
+    if digits.startswith('+'):
+        digits = digits[1:]
+    elif digits.startswith('00'):
+        digits = digits[2:]
+    if len(digits) == NATIONAL_LENGTH:
+        digits = COUNTRY_CODE + digits
+    if not digits.isdigit() or len(digits) != len(COUNTRY_CODE) + NATIONAL_LENGTH or not digits.startswith(COUNTRY_CODE):
+        raise InvalidMsisdn(f"Número de telefone inválido: {phone}")
+    return digits
+
+
+def validate_routing_rules(rules):
+    """Valida regras {prefixo nacional: provider ou None}; levanta ValidationError."""
+    if not isinstance(rules, dict):
+        raise ValidationError("As regras de roteamento devem ser um objeto {prefixo: provider}")
+    for prefix, provider in rules.items():
+        if not (isinstance(prefix, str) and prefix.isdigit() and 0 < len(prefix) <= NATIONAL_LENGTH):
+            raise ValidationError(f"Prefixo inválido: {prefix}")
+        if provider is not None and provider not in PROVIDERS:
+            raise ValidationError(f"Provider inválido para {prefix}: {provider}")
+
+
+class PrefixTable:
+    """Tabela de prefixos compilada: pesquisa do prefixo mais longo em O(comprimentos distintos)."""
+
+    def __init__(self, rules):
+        self._rules = dict(rules)
+        self._lengths = sorted({len(prefix) for prefix in self._rules}, reverse=True)
+
+    def lookup(self, msisdn):
+        """Provider do MSISDN normalizado; None se não houver regra (ou a regra recusar)."""
+        national = msisdn[len(COUNTRY_CODE):]
+        rules = self._rules
+        for length in self._lengths:
+            prefix = national[:length]
+            if prefix in rules:
+                return rules[prefix]
+        return None
+
+    def with_overrides(self, overrides):
+        """Nova tabela com as regras de um comerciante por cima destas."""
+        return PrefixTable({**self._rules, **overrides})
+
+
+def compile_routes(config=None):
+    """Tabela base a partir de PAYMENT_ROUTING_CONFIG['PREFIXES']."""
+    config = config or get_payment_routing_config()
+    validate_routing_rules(config['PREFIXES'])
+    return PrefixTable(config['PREFIXES'])
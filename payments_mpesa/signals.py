@@ -0,0 +1,49 @@
+"""
+Sinais que mantêm o rollup diário sincronizado com Transaction.save(), gravam
+Transaction.raw_response em TransactionPayload e mantêm o registo de
+comerciantes em memória atualizado no próprio processo.
+
+Operações em massa (bulk_create, QuerySet.update, bulk_update) não disparam
+sinais e devem chamar as funções de payments_mpesa.stats e
+payments_mpesa.payloads.store_payloads diretamente.
+"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Transaction, Merchant, Wallet
+from .merchants import registry
+from .payloads import store_payloads
+from . import stats
+
+
+@receiver(post_save, sender=Transaction)
+def update_daily_stats(sender, instance, created, raw=False, **kwargs):
+    """Atualiza TransactionDailyStats quando uma transação é criada ou finalizada."""
+    if raw:
+        return
+    if created:
+        stats.record_created([instance])
+    else:
+        old_status = getattr(instance, '_loaded_status', None)
+        if old_status and old_status != instance.status:
+            stats.record_status_change([instance], old_status)
+    instance._loaded_status = instance.status
+
+
+@receiver(post_save, sender=Transaction)
+def save_raw_response(sender, instance, created, raw=False, **kwargs):
+    """Grava raw_response (comprimido) quando foi atribuído desde o último save."""
+    if raw or not instance._raw_response_changed:
+        return
+    instance._raw_response_changed = False
+    if created and instance._raw_response is None:
+        return
+    store_payloads([(instance.pk, instance._raw_response)])
+
+
+@receiver([post_save, post_delete], sender=Merchant)
+@receiver([post_save, post_delete], sender=Wallet)
+def invalidate_merchant_registry(sender, **kwargs):
+    """Os outros processos detetam a mudança pela versão do registo (CHECK_INTERVAL)."""
+    registry.invalidate()
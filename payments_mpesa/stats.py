@@ -0,0 +1,235 @@
+"""
+Manutenção incremental do rollup diário TransactionDailyStats.
+
+Cada transação contribui para um único bucket (data local, tipo, status, app).
+Quando o status muda (ex.: pending -> success) a contribuição passa do bucket
+antigo para o novo. Os relatórios leem apenas esta tabela pequena.
+
+Os deltas não são gravados no pedido: depois do commit da transação que os
+gerou (on_commit, um rollback não conta) vão para um buffer em memória do
+processo, somados por bucket, e uma thread de fundo grava-os a cada
+FLUSH_INTERVAL segundos (uma UPDATE por bucket, numa só transação). Os
+pagamentos deixam de esperar pelo lock da linha do bucket do dia, que todos
+os workers atualizam. Os relatórios ficam até FLUSH_INTERVAL segundos
+atrasados; se o processo morrer de forma abrupta perdem-se no máximo esses
+segundos de deltas, corrigidos por python manage.py rebuild_transaction_stats
+(no encerramento normal o buffer é gravado: atexit).
+
+A reconstrução só grava o buffer do próprio processo: os deltas ainda no buffer
+de outros processos, já refletidos nas linhas recontadas, seriam somados outra
+vez quando gravados. Deve correr com os processos web e os workers parados.
+"""
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction as db_transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import Transaction, TransactionArchive, TransactionDailyStats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DAILY_STATS_CONFIG = {
+    'BUFFER_ENABLED': True,
+    'FLUSH_INTERVAL': 1.0,
+}
+
+
+def get_daily_stats_config():
+    """Retorna DAILY_STATS_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_DAILY_STATS_CONFIG, **getattr(settings, 'DAILY_STATS_CONFIG', {})}
+
+
+def bucket_key(txn, status=None):
+    """Chave do bucket de uma transação (status atual por omissão)."""
+    created_at = txn.created_at or timezone.now()
+    return (
+        timezone.localdate(created_at),
+        txn.transaction_type,
+        status or txn.status,
+        txn.from_app or '',
+    )
+
+
+def apply_deltas(deltas):
+    """Aplica {bucket: (count, amount)} com UPDATEs atómicos (F expressions)."""
+    for (date, transaction_type, status, from_app), (count, amount) in deltas.items():
+        if not count and not amount:
+            continue
+        lookup = dict(date=date, transaction_type=transaction_type, status=status, from_app=from_app)
+        updated = TransactionDailyStats.objects.filter(**lookup).update(
+            count=F('count') + count,
+            total_amount=F('total_amount') + amount
+        )
+        if updated:
+            continue
+        try:
+            with db_transaction.atomic():
+                TransactionDailyStats.objects.create(count=count, total_amount=amount, **lookup)
+        except IntegrityError:
+            # Outro processo criou o bucket entretanto
+            TransactionDailyStats.objects.filter(**lookup).update(
+                count=F('count') + count,
+                total_amount=F('total_amount') + amount
+            )
+
+
+class DeltaBuffer:
+    """Deltas do rollup acumulados por bucket e gravados por uma thread de fundo."""
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: [0, Decimal('0')])
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def add(self, deltas):
+        """Soma {bucket: (count, amount)} ao buffer."""
+        with self._cond:
+            self._merge(deltas)
+            self._ensure_thread()
+
+    def _merge(self, deltas):
+        for key, (count, amount) in deltas.items():
+            delta = self._deltas[key]
+            delta[0] += count
+            delta[1] += amount
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='daily-stats-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        interval = get_daily_stats_config()['FLUSH_INTERVAL']
+        while True:
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(interval)
+                if self._stopped:
+                    return
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception as e:
+                logger.error(f"Erro ao gravar o rollup diário: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Grava os deltas acumulados; em caso de erro voltam ao buffer."""
+        with self._flush_lock:
+            with self._cond:
+                deltas = self._deltas
+                self._deltas = defaultdict(lambda: [0, Decimal('0')])
+            if not deltas:
+                return 0
+            try:
+                with db_transaction.atomic():
+                    apply_deltas(deltas)
+            except Exception:
+                with self._cond:
+                    self._merge(deltas)
+                raise
+        return len(deltas)
+
+    def stop(self):
+        """Para a thread e grava o que ainda estiver no buffer."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            if not self._deltas:
+                return
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Erro ao gravar o rollup diário no encerramento: {str(e)}")
+
+
+delta_buffer = DeltaBuffer()
+atexit.register(delta_buffer.stop)
+
+
+def submit(deltas):
+    """Envia os deltas para o rollup depois do commit da transação atual."""
+    deltas = {key: (count, amount) for key, (count, amount) in deltas.items() if count or amount}
+    if not deltas:
+        return
+    if get_daily_stats_config()['BUFFER_ENABLED']:
+        db_transaction.on_commit(lambda: delta_buffer.add(deltas))
+    else:
+        db_transaction.on_commit(lambda: apply_deltas(deltas))
+
+
+def record_created(transactions):
+    """Contabiliza transações recém-criadas (também para bulk_create)."""
+    deltas = defaultdict(lambda: [0, Decimal('0')])
+    for txn in transactions:
+        delta = deltas[bucket_key(txn)]
+        delta[0] += 1
+        delta[1] += Decimal(str(txn.amount or 0))
+    submit(deltas)
+
+
+def record_status_change(transactions, old_status):
+    """Move transações do bucket old_status para o bucket do status atual."""
+    deltas = defaultdict(lambda: [0, Decimal('0')])
+    for txn in transactions:
+        if txn.status == old_status:
+            continue
+        amount = Decimal(str(txn.amount or 0))
+        old = deltas[bucket_key(txn, old_status)]
+        old[0] -= 1
+        old[1] -= amount
+        new = deltas[bucket_key(txn)]
+        new[0] += 1
+        new[1] += amount
+    submit(deltas)
+
+
+def rebuild_day(date):
+    """
+    Recalcula os buckets de um dia a partir de Transaction e TransactionArchive.
+
+    Requer os outros processos parados: os deltas nos buffers deles (até
+    FLUSH_INTERVAL segundos) não são descartados e contariam duas vezes.
+    """
+    delta_buffer.flush()
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(date, time.min), tz)
+    end = start + timedelta(days=1)
+
+    buckets = defaultdict(lambda: [0, Decimal('0')])
+    for model in (Transaction, TransactionArchive):
+        rows = (
+            model.objects
+            .filter(created_at__gte=start, created_at__lt=end)
+            .values('transaction_type', 'status', 'from_app')
+            .annotate(count=Count('id'), total_amount=Sum('amount'))
+            .order_by()
+        )
+        for row in rows:
+            bucket = buckets[(row['transaction_type'], row['status'], row['from_app'] or '')]
+            bucket[0] += row['count']
+            bucket[1] += row['total_amount'] or 0
+    with db_transaction.atomic():
+        TransactionDailyStats.objects.filter(date=date).delete()
+        TransactionDailyStats.objects.bulk_create([
+            TransactionDailyStats(
+                date=date,
+                transaction_type=transaction_type,
+                status=status,
+                from_app=from_app,
+                count=count,
+                total_amount=total_amount,
+            )
+            for (transaction_type, status, from_app), (count, total_amount) in buckets.items()
+        ])
@@ -1,3 +1,920 @@
-from django.test import TestCase
+import asyncio
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.hashers import check_password
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from payments_emola.models import Transaction as EmolaTransaction
+from payments_emola.soap import SoapResult
+
+from . import asyncclients, replicas, views
+from .archive import archive_cutoff, archive_transactions, find_transaction, tiered_page
+from .breaker import CLOSED, DEFAULT_BREAKER_CONFIG, HALF_OPEN, OPEN, BreakerRegistry, CircuitBreaker
+from .bulk import InvalidBatch, create_batch, validate_items
+from .idempotency import AMBIGUOUS, CLAIMED, REPLAY, claim_key, complete_key, hash_request, make_key
+from .jobs import AMBIGUOUS_MESSAGE, claim_jobs, enqueue_payment, expire_leases, process_job
+from .merchants import MerchantRegistry
+from .middleware import ReplicaPinningMiddleware
+from .models import (
+    IdempotencyKey, Merchant, OAuthToken, PaymentJob, RateLimitBucket, Transaction, TransactionArchive,
+    UpstreamSlot, Wallet,
+)
+from .mpesa import Mpesa
+from .pagination import apply_keyset, encode_cursor, iterate_keyset
+from .payloads import decompress_json
+from .ratelimit import (
+    AdmissionRejected, DEFAULT_RATE_LIMIT_CONFIG, DatabaseBuckets, LocalBuckets, admit, database_in_flight,
+    purge_idle_buckets, upstream_slot,
+)
+from .reconciliation import DEFAULT_RECONCILIATION_CONFIG, find_candidates, reconcile_batch, resolve_ambiguous_keys
+from .routing import InvalidMsisdn, UnroutableMsisdn, compile_routes, normalize_msisdn, validate_routing_rules
+from .tokens import TokenCache, token_cache
+
+QUEUE_CONFIG = {'MAX_ATTEMPTS': 3, 'RETRY_BACKOFF': 30}
+
+
+class FakeMpesa:
+    """Cliente M-Pesa que devolve respostas fixas e conta as chamadas."""
+
+    def __init__(self, response=None, query_response=None):
+        self.response = response
+        self.query_response = query_response
+        self.calls = 0
+        self.queries = 0
+
+    def c2b(self, transaction_reference, customer_msisdn, amount, third_party_reference):
+        self.calls += 1
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+    b2c = c2b
+
+    async def ac2b(self, transaction_reference, customer_msisdn, amount, third_party_reference,
+                   service_provider_code=None):
+        return self.c2b(transaction_reference, customer_msisdn, amount, third_party_reference)
+
+    def query_transaction_status(self, query_reference, third_party_reference=None):
+        self.queries += 1
+        return self.query_response
+
+
+class ProcessJobTests(TestCase):
+
+    def _job(self, operation='C2B'):
+        _, job = enqueue_payment(operation, 'REF001', 'TPR001', '258840000001', Decimal('10.00'), 'tests')
+        job.status = 'running'
+        job.save()
+        return PaymentJob.objects.select_related('transaction').get(pk=job.pk)
+
+    def test_connect_failure_is_requeued(self):
+        job = self._job()
+        mpesa = FakeMpesa({'status': 500, 'response': None, 'success': False,
+                           'error_message': 'Connection refused', 'retryable': True})
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.available_at, timezone.now())
+        self.assertEqual(job.transaction.status, 'pending')
+
+    def test_retryable_failure_fails_after_max_attempts(self):
+        job = self._job()
+        job.attempts = QUEUE_CONFIG['MAX_ATTEMPTS'] - 1
+        mpesa = FakeMpesa({'status': 503, 'response': None, 'success': False,
+                           'error_message': 'Circuit open', 'retryable': True})
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(Transaction.objects.get(pk=job.transaction_id).status, 'error')
+
+    def test_read_timeout_is_ambiguous(self):
+        job = self._job()
+        mpesa = FakeMpesa({'status': 500, 'response': None, 'success': False,
+                           'error_message': 'Read timed out', 'retryable': False})
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        txn = Transaction.objects.get(pk=job.transaction_id)
+        self.assertEqual(job.status, 'ambiguous')
+        self.assertEqual(txn.status, 'pending')
+        self.assertEqual(txn.message, AMBIGUOUS_MESSAGE)
+        # Um job ambíguo nunca é reclamado de novo
+        self.assertEqual(claim_jobs('worker', 10, 60), [])
+
+    def test_exception_is_ambiguous(self):
+        job = self._job()
+        process_job(job, FakeMpesa(RuntimeError('Conexão cortada')), QUEUE_CONFIG)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'ambiguous')
+
+    def test_answered_request_is_final(self):
+        job = self._job()
+        mpesa = FakeMpesa({'status': 422, 'response': {'output_ResponseCode': 'INS-2006'}, 'success': False,
+                           'error_message': 'Saldo insuficiente'})
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        txn = Transaction.objects.get(pk=job.transaction_id)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(txn.status, 'error')
+        self.assertEqual(txn.response_code, 'INS-2006')
+
+    def test_success(self):
+        job = self._job()
+        mpesa = FakeMpesa({'status': 201, 'response': {'output_ResponseCode': 'INS-0', 'output_TransactionID': 'T1'},
+                           'success': True, 'error_message': None})
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        txn = Transaction.objects.get(pk=job.transaction_id)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual((txn.status, txn.transaction_id), ('success', 'T1'))
+
+    def test_b2c_retry_queries_status_first(self):
+        job = self._job('B2C')
+        job.attempts = 1
+        mpesa = FakeMpesa(query_response={
+            'status': 200, 'success': True, 'error_message': None,
+            'response': {'output_ResponseCode': 'INS-0', 'output_ResponseTransactionStatus': 'Completed'},
+        })
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        self.assertEqual((mpesa.queries, mpesa.calls), (1, 0))
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(Transaction.objects.get(pk=job.transaction_id).status, 'success')
+
+    def test_b2c_retry_resends_when_not_found(self):
+        job = self._job('B2C')
+        job.attempts = 1
+        mpesa = FakeMpesa(
+            {'status': 201, 'response': {'output_ResponseCode': 'INS-0'}, 'success': True, 'error_message': None},
+            {'status': 400, 'success': False, 'error_message': 'Não encontrado',
+             'response': {'output_ResponseCode': 'INS-10'}},
+        )
+        process_job(job, mpesa, QUEUE_CONFIG)
+        job.refresh_from_db()
+        self.assertEqual((mpesa.queries, mpesa.calls), (1, 1))
+        self.assertEqual(job.status, 'done')
+
+    def test_expired_lease_is_ambiguous(self):
+        job = self._job()
+        job.lease_expires_at = timezone.now() - timedelta(seconds=1)
+        job.save()
+        self.assertEqual(expire_leases(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'ambiguous')
+        self.assertEqual(Transaction.objects.get(pk=job.transaction_id).message, AMBIGUOUS_MESSAGE)
+        self.assertEqual(claim_jobs('worker', 10, 60), [])
+
+
+class ValidateItemsTests(TestCase):
+
+    def _errors(self, amount):
+        with self.assertRaises(InvalidBatch) as ctx:
+            validate_items([{'msisdn': '840000001', 'amount': amount, 'reference': 'R1'}])
+        return ctx.exception.errors
+
+    def test_valid_item(self):
+        items = validate_items([{'msisdn': '840000001', 'amount': '10.50', 'reference': 'R1'}])
+        self.assertEqual(items, [{'msisdn': '258840000001', 'amount': Decimal('10.50'), 'reference': 'R1'}])
+
+    def test_non_finite_amounts(self):
+        for amount in ('NaN', 'sNaN', 'Infinity', '-Infinity', 'inf'):
+            with self.subTest(amount=amount):
+                self.assertEqual(self._errors(amount), [{'row': 1, 'error': 'amount inválido'}])
+
+    def test_over_precision_amount(self):
+        self.assertEqual(self._errors('1.001'), [{'row': 1, 'error': 'amount inválido'}])
+
+    def test_amount_above_column_limit(self):
+        self.assertEqual(self._errors('10000000000'), [{'row': 1, 'error': 'amount excede o máximo (9999999999.99)'}])
+
+
+class CreateBatchTests(TestCase):
+    """Os itens do lote são enviados ao fornecedor com um identificador gerado, nunca com a referência do cliente."""
+
+    def test_emola_trans_id_is_generated(self):
+        items = [{'msisdn': '258860000001', 'amount': Decimal('5.00'), 'reference': 'SALARIO-01'}]
+        batch = create_batch(items, provider='emola')
+        job = PaymentJob.objects.get(transaction__batch=batch)
+        emola = mock.Mock()
+        emola.push_used_disbursement_b2c.return_value = SoapResult(error_code='0', message='OK', request_id='R1')
+        with mock.patch('payments_mpesa.jobs.EmolaClient.get_instance', return_value=emola):
+            process_job(job)
+        trans_id = emola.push_used_disbursement_b2c.call_args.args[2]
+        self.assertEqual(trans_id, job.transaction.third_party_reference)
+        self.assertNotEqual(trans_id, 'SALARIO-01')
+        self.assertEqual(job.transaction.transaction_reference, 'SALARIO-01')
+
+
+class PayloadMigrationTests(TransactionTestCase):
+    """0013 move raw_response para TransactionPayload e 0014 remove a coluna; ida e volta."""
+
+    before = [('payments_mpesa', '0012_transactionarchive')]
+    after = [('payments_mpesa', '0014_remove_transaction_raw_response')]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def test_round_trip(self):
+        apps = self._migrate(self.before)
+        OldTransaction = apps.get_model('payments_mpesa', 'Transaction')
+        raw = {'output_ResponseCode': 'INS-0', 'output_TransactionID': 'T1'}
+        with_raw = OldTransaction.objects.create(
+            transaction_type='C2B', transaction_reference='REF001', third_party_reference='TPR001',
+            customer_msisdn='258840000001', amount=Decimal('10.00'), status='success', raw_response=raw
+        )
+        without_raw = OldTransaction.objects.create(
+            transaction_type='C2B', transaction_reference='REF002', third_party_reference='TPR002',
+            customer_msisdn='258840000001', amount=Decimal('10.00'), status='pending'
+        )
+
+        apps = self._migrate(self.after)
+        Payload = apps.get_model('payments_mpesa', 'TransactionPayload')
+        self.assertEqual(
+            decompress_json(Payload.objects.get(transaction_id=with_raw.pk).data), raw
+        )
+        self.assertFalse(Payload.objects.filter(transaction_id=without_raw.pk).exists())
+        NewTransaction = apps.get_model('payments_mpesa', 'Transaction')
+        self.assertEqual(NewTransaction.objects.get(pk=with_raw.pk).response_code, 'INS-0')
+
+        apps = self._migrate(self.before)
+        OldTransaction = apps.get_model('payments_mpesa', 'Transaction')
+        self.assertEqual(OldTransaction.objects.get(pk=with_raw.pk).raw_response, raw)
+        self.assertIsNone(OldTransaction.objects.get(pk=without_raw.pk).raw_response)
+
+
+class C2BIdempotencyTests(TestCase):
+    """Um pedido repetido nunca envia o mesmo pagamento duas vezes ao fornecedor."""
+
+    data = {'client_id': 'client', 'phone': '840000001', 'amount': '10', 'reference': 'REF001'}
+
+    def _run(self, execute, upstream_reference='TPR001'):
+        request = RequestFactory().post('/v1/c2b/mpesa-payment/1')
+        return views._run_c2b(request, 'client', self.data, 'REF001', 'tests', '258840000001', execute,
+                              'mpesa', upstream_reference)
+
+    def _record(self):
+        return IdempotencyKey.objects.get(key=make_key('C2B', 'client', 'REF001'))
+
+    def _claim(self):
+        outcome, record = claim_key(make_key('C2B', 'client', 'REF001'), 'C2B', hash_request(self.data),
+                                    provider='mpesa', upstream_reference='TPR001')
+        self.assertEqual(outcome, CLAIMED)
+        return record
+
+    async def test_replay(self):
+        calls = []
+
+        async def execute():
+            calls.append(1)
+            return {'success': True}, 200
+
+        first = await self._run(execute)
+        second = await self._run(execute)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(calls), 1)
+
+    def test_expired_lock_is_ambiguous_not_reclaimed(self):
+        record = self._claim()
+        IdempotencyKey.objects.filter(pk=record.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        outcome, _ = claim_key(record.key, 'C2B', hash_request(self.data))
+        self.assertEqual(outcome, AMBIGUOUS)
+        self.assertEqual(self._record().status, 'ambiguous')
+
+    async def test_ambiguous_key_does_not_resend(self):
+        record = await sync_to_async(self._claim)()
+        await IdempotencyKey.objects.filter(pk=record.pk).aupdate(status='ambiguous', locked_until=None)
+        calls = []
+
+        async def execute():
+            calls.append(1)
+            return {'success': True}, 200
+
+        response = await self._run(execute)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(calls, [])
+
+    async def test_failure_after_send_marks_key_ambiguous(self):
+        async def execute():
+            raise RuntimeError('Erro ao gravar a transação')
+
+        with self.assertRaises(RuntimeError):
+            await self._run(execute)
+        record = await IdempotencyKey.objects.aget(key=make_key('C2B', 'client', 'REF001'))
+        self.assertEqual(record.status, 'ambiguous')
+
+    async def test_request_not_sent_releases_key(self):
+        async def execute():
+            raise httpx.ConnectError('Connection refused')
+
+        with self.assertRaises(httpx.ConnectError):
+            await self._run(execute)
+        self.assertFalse(await IdempotencyKey.objects.filter(key=make_key('C2B', 'client', 'REF001')).aexists())
+
+    async def test_client_disconnect_still_completes_key(self):
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def execute():
+            started.set()
+            await release.wait()
+            return {'success': True}, 200
+
+        view = asyncio.ensure_future(self._run(execute))
+        await started.wait()
+        view.cancel()  # ASGI cancela a view quando o cliente desliga
+        with self.assertRaises(asyncio.CancelledError):
+            await view
+        release.set()
+        await asyncio.gather(*views._settling)
+        record = await IdempotencyKey.objects.aget(key=make_key('C2B', 'client', 'REF001'))
+        self.assertEqual((record.status, record.response_status), ('completed', 200))
+
+    async def test_transaction_written_before_upstream_call(self):
+        seen = []
+        fake = FakeMpesa({'status': 201, 'success': True, 'error_message': None,
+                          'response': {'output_ResponseCode': 'INS-0', 'output_TransactionID': 'T1'}})
+        original = fake.ac2b
+
+        async def ac2b(*args, **kwargs):
+            seen.append((await Transaction.objects.aget(third_party_reference='TPR001')).status)
+            return await original(*args, **kwargs)
+
+        fake.ac2b = ac2b
+        request = RequestFactory().post('/v1/c2b/mpesa-payment/1')
+        with mock.patch.object(Mpesa, 'get_instance', return_value=fake):
+            body, status = await views._execute_c2b(request, 'REF001', 'TPR001', '258840000001', '10', 'tests')
+        self.assertEqual((status, seen), (200, ['pending']))
+        txn = await Transaction.objects.aget(third_party_reference='TPR001')
+        self.assertEqual((txn.status, txn.transaction_id), ('success', 'T1'))
+
+
+class BulkIdempotencyTests(TestCase):
+    """Um lote cuja chave ficou sem resultado conhecido não é criado outra vez."""
+
+    def setUp(self):
+        merchant = Merchant(name='Loja', client_id='loja-lotes')
+        merchant.set_secret('segredo')
+        merchant.save()
+        Wallet.objects.create(merchant=merchant, wallet_id=990101, provider='mpesa')
+        OAuthToken.objects.create(client_id='loja-lotes', access_token='tok-lotes', expires_in=3600,
+                                  expires_at=timezone.now() + timedelta(hours=1))
+
+    def _post(self):
+        body = {'provider': 'mpesa', 'fromApp': 'tests',
+                'items': [{'msisdn': '258840000001', 'amount': '10', 'reference': 'LOTE1'}]}
+        return self.client.post('/v1/b2c/bulk-disbursement/990101', data=body, content_type='application/json',
+                                HTTP_AUTHORIZATION='Bearer tok-lotes', HTTP_IDEMPOTENCY_KEY='lote-1')
+
+    def test_ambiguous_key_does_not_create_second_batch(self):
+        self.assertEqual(self._post().status_code, 202)
+        IdempotencyKey.objects.filter(operation='BULK').update(status='ambiguous', response_body=None,
+                                                               response_status=None)
+        self.assertEqual(self._post().status_code, 409)
+        self.assertEqual(Transaction.objects.filter(transaction_reference='LOTE1').count(), 1)
+
+
+class ResolveAmbiguousKeysTests(TestCase):
+
+    def _key(self, upstream_reference, provider='mpesa'):
+        _, record = claim_key(make_key('C2B', 'client', upstream_reference), 'C2B', 'hash',
+                              provider=provider, upstream_reference=upstream_reference)
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            status='ambiguous', locked_until=None, created_at=timezone.now() - timedelta(hours=1)
+        )
+        return record
+
+    def _txn(self, third_party_reference, status):
+        txn = Transaction.objects.create(
+            transaction_type='C2B', transaction_reference='REF', third_party_reference=third_party_reference,
+            customer_msisdn='258840000001', amount=Decimal('10.00'), status=status
+        )
+        Transaction.objects.filter(pk=txn.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        return txn
+
+    def test_key_without_transaction_is_released(self):
+        record = self._key('TPR001')
+        self.assertEqual(resolve_ambiguous_keys(), (0, 1))
+        self.assertFalse(IdempotencyKey.objects.filter(pk=record.pk).exists())
+
+    def test_key_with_final_transaction_is_completed(self):
+        record = self._key('TPR001')
+        self._txn('TPR001', 'success')
+        self.assertEqual(resolve_ambiguous_keys(), (1, 0))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.response_status), ('completed', 200))
+        outcome, _ = claim_key(record.key, 'C2B', 'hash')
+        self.assertEqual(outcome, REPLAY)
+
+    def test_key_with_pending_transaction_waits_for_reconciliation(self):
+        record = self._key('TPR001')
+        txn = self._txn('TPR001', 'pending')
+        self.assertEqual(resolve_ambiguous_keys(), (0, 0))
+        self.assertEqual(IdempotencyKey.objects.get(pk=record.pk).status, 'ambiguous')
+        self.assertEqual([t.pk for t in find_candidates(10)], [txn.pk])
+
+    def test_emola_key_with_transaction_is_completed_pending(self):
+        record = self._key('TRANS001', provider='emola')
+        EmolaTransaction.objects.create(trans_id='TRANS001', msisdn='258860000001', amount=Decimal('10.00'))
+        self.assertEqual(resolve_ambiguous_keys(), (1, 0))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.response_status), ('completed', 202))
+
+
+class AsyncClientTests(TestCase):
+    """Os clientes httpx assíncronos só existem no loop do servidor ASGI e são fechados no shutdown."""
+
+    async def test_short_lived_loop_uses_sync_session(self):
+        self.assertIsNone(Mpesa()._get_async_client())
+
+    async def test_serving_loop_reuses_and_closes_client(self):
+        mpesa = Mpesa()
+        asyncclients.register_serving_loop()
+        client = mpesa._get_async_client()
+        self.assertIs(mpesa._get_async_client(), client)
+        self.assertEqual(await asyncclients.aclose_all(), 1)
+        self.assertTrue(client.is_closed)
+        self.assertFalse(asyncclients.is_serving_loop())
+
+
+class AdmissionTests(TestCase):
+    """Token buckets por cliente, app e MSISDN, partilhados pela BD."""
+
+    config = dict(DEFAULT_RATE_LIMIT_CONFIG, BUCKETS={
+        'client': {'RATE': 1, 'BURST': 2},
+        'app': {'RATE': 1, 'BURST': 5},
+        'msisdn': {'RATE': 0.05, 'BURST': 1},
+    })
+
+    def test_database_bucket_refills_over_time(self):
+        buckets = DatabaseBuckets()
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 0)
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 0)
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 1)  # Retry-After
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1001), 0)
+
+    def test_local_bucket_matches_database_bucket(self):
+        buckets = LocalBuckets()
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 0)
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 0)
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1000), 1)
+        self.assertEqual(buckets.consume('client:a', 1, 2, now=1001), 0)
+
+    def test_rejection_refunds_buckets_already_consumed(self):
+        admit('c1', 'app1', '258840000001', config=self.config)
+        with self.assertRaises(AdmissionRejected) as ctx:
+            admit('c1', 'app1', '258840000001', config=self.config)
+        self.assertEqual(ctx.exception.limit, 'msisdn')
+        self.assertEqual(ctx.exception.retry_after, 20)
+        # O segundo token do cliente foi devolvido: ainda admite outro MSISDN
+        admit('c1', 'app1', '258840000002', config=self.config)
+
+    def test_override_per_client(self):
+        config = dict(self.config, OVERRIDES={'client:vip': {'RATE': 0.001, 'BURST': 100}})
+        for i in range(5):
+            admit('vip', config=config)
+        self.assertAlmostEqual(RateLimitBucket.objects.get(key='client:vip').tokens, 95, places=1)
+
+    def test_purge_idle_buckets(self):
+        buckets = DatabaseBuckets()
+        buckets.consume('client:old', 1, 2, now=1000)
+        buckets.consume('client:new', 1, 2, now=10000)
+        with self.settings(RATE_LIMIT_CONFIG=self.config):
+            self.assertEqual(purge_idle_buckets(now=10000), 1)
+        self.assertEqual(list(RateLimitBucket.objects.values_list('key', flat=True)), ['client:new'])
+
+
+class UpstreamSlotTests(TestCase):
+    """Com o backend 'database' MAX_IN_FLIGHT é global e as vagas têm lease."""
+
+    config = dict(DEFAULT_RATE_LIMIT_CONFIG, MAX_IN_FLIGHT=2, IN_FLIGHT_LEASE=60)
+
+    def setUp(self):
+        database_in_flight._created = 0
+
+    def test_limit_is_shared_through_database(self):
+        with upstream_slot(self.config), upstream_slot(self.config):
+            self.assertEqual(database_in_flight.count(2), 2)
+            with self.assertRaises(AdmissionRejected):
+                with upstream_slot(self.config):
+                    pass
+        self.assertEqual(database_in_flight.count(2), 0)
+
+    def test_expired_lease_frees_slot(self):
+        first = database_in_flight.acquire(1, lease=60, now=1000)
+        self.assertIsNotNone(first)
+        self.assertIsNone(database_in_flight.acquire(1, lease=60, now=1030))
+        second = database_in_flight.acquire(1, lease=60, now=1061)
+        self.assertIsNotNone(second)
+        # A libertação tardia do primeiro detentor não liberta a vaga do segundo
+        database_in_flight.release(first)
+        self.assertEqual(UpstreamSlot.objects.get(pk=1).holder, second[1])
+
+    async def test_async_slot(self):
+        async with upstream_slot(self.config):
+            self.assertEqual(await sync_to_async(database_in_flight.count)(2), 1)
+        self.assertEqual(await sync_to_async(database_in_flight.count)(2), 0)
+
+    def test_local_backend_does_not_touch_database(self):
+        with upstream_slot(dict(self.config, BACKEND='local')):
+            pass
+        self.assertFalse(UpstreamSlot.objects.exists())
+
+
+class IterateKeysetTests(TestCase):
+    """O streaming percorre as linhas por blocos de keyset, em ambas as ordens."""
+
+    def setUp(self):
+        now = timezone.now()
+        for i in range(5):
+            txn = Transaction.objects.create(transaction_type='C2B', transaction_reference=f'REF{i}',
+                                             customer_msisdn='258840000001', amount=Decimal('1.00'))
+            # Dois pares com o mesmo created_at: o desempate é por id
+            Transaction.objects.filter(pk=txn.pk).update(created_at=now - timedelta(minutes=i // 2))
+        self.rows = Transaction.objects.values('id', 'created_at')
+
+    def test_descending_matches_listing_order(self):
+        expected = list(self.rows.order_by('-created_at', '-id'))
+        self.assertEqual(list(iterate_keyset(self.rows, chunk_size=2, descending=True)), expected)
+
+    def test_ascending(self):
+        expected = list(self.rows.order_by('created_at', 'id'))
+        self.assertEqual(list(iterate_keyset(self.rows, chunk_size=2)), expected)
+
+
+class CircuitBreakerTests(TestCase):
+    """Abertura, sondas em meio-aberto e timeout adaptativo."""
+
+    config = dict(DEFAULT_BREAKER_CONFIG, FAILURE_THRESHOLD=3, RESET_TIMEOUT=30, WINDOW_SIZE=10, MIN_SAMPLES=10,
+                  TIMEOUT_PERCENTILE=90, TIMEOUT_MULTIPLIER=2.0, MIN_TIMEOUT=1)
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('mpesa.b2c', 60, self.config)
+        for _ in range(2):
+            breaker.record_failure()
+        breaker.record_success(0.1)  # Uma resposta repõe a contagem
+        for _ in range(3):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probe_closes_or_reopens(self):
+        breaker = CircuitBreaker('mpesa.b2c', 60, self.config)
+        for _ in range(3):
+            breaker.record_failure()
+        with mock.patch('payments_mpesa.breaker.time.monotonic', return_value=breaker.opened_at + 31):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, HALF_OPEN)
+            self.assertFalse(breaker.allow())  # Só uma sonda
+            breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        with mock.patch('payments_mpesa.breaker.time.monotonic', return_value=breaker.opened_at + 31):
+            self.assertTrue(breaker.allow())
+            breaker.record_success(0.1)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_slow_call_counts_as_failure(self):
+        breaker = CircuitBreaker('mpesa.b2c', 10, self.config)
+        breaker.record_success(9.5)
+        self.assertEqual((breaker.failures, breaker.consecutive_failures), (1, 1))
+
+    def test_adaptive_timeout(self):
+        breaker = CircuitBreaker('mpesa.b2c', 60, self.config)
+        self.assertEqual(breaker.timeout(), 60)  # Amostras insuficientes
+        for _ in range(10):
+            breaker.record_success(2.0)
+        self.assertEqual(breaker.timeout(), 4.0)
+        for _ in range(10):
+            breaker.record_success(0.1)
+        self.assertEqual(breaker.timeout(), 1)  # Janela deslizante, limitado por MIN_TIMEOUT
+
+    def test_ussd_operations_keep_configured_timeout(self):
+        with self.settings(CIRCUIT_BREAKER_CONFIG=self.config):
+            breaker = BreakerRegistry().get('mpesa.c2b', 90)
+        for _ in range(20):
+            breaker.record_success(80)
+        self.assertEqual(breaker.timeout(), 90)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_registry_rebuilds_on_timeout_change(self):
+        registry = BreakerRegistry()
+        first = registry.get('emola.pushUsedQueryTrans', 15)
+        self.assertIs(registry.get('emola.pushUsedQueryTrans', 15), first)
+        self.assertIsNot(registry.get('emola.pushUsedQueryTrans', 20), first)
+
+
+class ReconciliationTests(TestCase):
+    """Transações com resultado ambíguo consultadas no M-Pesa e resolvidas em lote."""
+
+    config = dict(DEFAULT_RECONCILIATION_CONFIG, CONCURRENCY=1, BACKOFF=60)
+
+    def _txn(self, reference, status='error', response_code=None, minutes_ago=10):
+        txn = Transaction.objects.create(
+            transaction_type='C2B', transaction_reference=reference, third_party_reference=f'TP{reference}',
+            customer_msisdn='258840000001', amount=Decimal('10.00'), status=status, response_code=response_code
+        )
+        Transaction.objects.filter(pk=txn.pk).update(created_at=timezone.now() - timedelta(minutes=minutes_ago))
+        return Transaction.objects.get(pk=txn.pk)
+
+    @staticmethod
+    def _query_response(status='Completed', code='INS-0'):
+        return {'status': 200, 'success': code == 'INS-0', 'error_message': '',
+                'response': {'output_ResponseCode': code, 'output_ResponseTransactionStatus': status}}
+
+    def test_find_candidates(self):
+        timeout = self._txn('R1', response_code='INS-9')
+        no_response = self._txn('R2')
+        self._txn('R3', response_code='INS-2006')  # Resposta de negócio: definitiva
+        self._txn('R4', status='success', response_code='INS-0')
+        self._txn('R5', response_code='INS-9', minutes_ago=1)  # Ainda dentro de MIN_AGE
+        self.assertEqual({t.pk for t in find_candidates(10, self.config)}, {timeout.pk, no_response.pk})
+
+    def test_completed_query_resolves_transaction_and_job(self):
+        txn, job = enqueue_payment('C2B', 'R1', 'TPR1', '258840000001', Decimal('10.00'), 'tests')
+        PaymentJob.objects.filter(pk=job.pk).update(status='ambiguous')
+        Transaction.objects.filter(pk=txn.pk).update(created_at=timezone.now() - timedelta(minutes=10))
+        summary = reconcile_batch(find_candidates(10, self.config), FakeMpesa(query_response=self._query_response()),
+                                  self.config)
+        self.assertEqual((summary['resolved'], summary['success']), (1, 1))
+        txn.refresh_from_db()
+        self.assertEqual(txn.status, 'success')
+        self.assertIsNotNone(txn.reconciled_at)
+        self.assertEqual(PaymentJob.objects.get(pk=job.pk).status, 'done')
+
+    def test_not_found_is_final_error(self):
+        txn = self._txn('R1', response_code='INS-9')
+        reconcile_batch([txn], FakeMpesa(query_response=self._query_response(status='', code='INS-10')), self.config)
+        txn.refresh_from_db()
+        self.assertEqual(txn.status, 'error')
+        self.assertIsNotNone(txn.reconciled_at)
+        self.assertEqual(find_candidates(10, self.config), [])
+
+    def test_unknown_result_backs_off(self):
+        txn = self._txn('R1', response_code='INS-9')
+        summary = reconcile_batch([txn], FakeMpesa(query_response=self._query_response(status='Pending')), self.config)
+        self.assertEqual(summary['retry'], 1)
+        txn.refresh_from_db()
+        self.assertEqual(txn.reconcile_attempts, 1)
+        self.assertGreater(txn.next_reconcile_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(find_candidates(10, self.config), [])
+
+    def test_open_circuit_does_not_count_attempt(self):
+        txn = self._txn('R1', response_code='INS-9')
+        response = {'status': 503, 'response': None, 'success': False, 'error_message': 'Circuit open',
+                    'circuit_open': True}
+        self.assertEqual(reconcile_batch([txn], FakeMpesa(query_response=response), self.config)['skipped'], 1)
+        txn.refresh_from_db()
+        self.assertEqual(txn.reconcile_attempts, 0)
+
+
+class ArchiveTests(TestCase):
+    """Arquivo das transações antigas e leitura nos dois níveis."""
+
+    def _txn(self, reference, days_ago, **fields):
+        txn = Transaction.objects.create(transaction_type='C2B', transaction_reference=reference,
+                                         customer_msisdn='258840000001', amount=Decimal('10.00'), **fields)
+        Transaction.objects.filter(pk=txn.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return txn
+
+    def test_moves_old_transactions_with_cold_fields(self):
+        old = self._txn('OLD', 400, status='success', conversation_id='CONV1', raw_response={'output_ResponseCode': 'INS-0'})
+        recent = self._txn('NEW', 1)
+        self.assertEqual(archive_transactions(months=6), 1)
+        self.assertEqual(list(Transaction.objects.values_list('pk', flat=True)), [recent.pk])
+        archived = TransactionArchive.objects.get(pk=old.pk)
+        self.assertEqual(archived.status, 'success')
+        self.assertEqual(archived.cold_fields['conversation_id'], 'CONV1')
+        self.assertEqual(archived.cold_fields['raw_response'], {'output_ResponseCode': 'INS-0'})
+
+    def test_transaction_with_queued_job_stays_hot(self):
+        txn, _ = enqueue_payment('C2B', 'QUEUED', 'TPQ', '258840000001', Decimal('10.00'), 'tests')
+        Transaction.objects.filter(pk=txn.pk).update(created_at=timezone.now() - timedelta(days=400))
+        self.assertEqual(archive_transactions(months=6), 0)
+        self.assertTrue(Transaction.objects.filter(pk=txn.pk).exists())
+
+    def test_find_transaction_falls_back_to_archive(self):
+        self._txn('OLD', 400)
+        archive_transactions(months=6)
+        self.assertIsInstance(find_transaction('OLD', ['status', 'created_at']), TransactionArchive)
+        self.assertIsNone(find_transaction('MISSING', ['status']))
+
+    def test_tiered_pages_follow_keyset_across_tiers(self):
+        for i in range(3):
+            self._txn(f'OLD{i}', 400 + i)
+        for i in range(3):
+            self._txn(f'NEW{i}', i)
+        # Transação antiga com job por processar: intercalada com o arquivo
+        blocked, _ = enqueue_payment('C2B', 'BLOCKED', 'TPB', '258840000001', Decimal('10.00'), 'tests')
+        Transaction.objects.filter(pk=blocked.pk).update(created_at=timezone.now() - timedelta(days=401, hours=12))
+        archive_transactions(months=6)
+
+        fields = ('id', 'transaction_reference', 'created_at')
+        seen = []
+        cursor = None
+        while True:
+            hot, cold = [apply_keyset(model.objects.all(), cursor).values(*fields)
+                         for model in (Transaction, TransactionArchive)]
+            page = tiered_page(hot, cold, 3)
+            seen.extend(row['transaction_reference'] for row in page)
+            if len(page) < 3:
+                break
+            cursor = encode_cursor(page[-1]['created_at'], page[-1]['id'])
+        self.assertEqual(seen, ['NEW0', 'NEW1', 'NEW2', 'OLD0', 'OLD1', 'BLOCKED', 'OLD2'])
+
+    def test_archive_cutoff_is_start_of_month(self):
+        now = timezone.make_aware(datetime(2025, 8, 15, 12, 0))
+        cutoff = archive_cutoff(6, now)
+        self.assertEqual((cutoff.year, cutoff.month, cutoff.day, cutoff.hour), (2025, 2, 1, 0))
+
+
+class ReplicaRoutingTests(TestCase):
+    """Leituras de relatório na réplica só quando é seguro; escritas sempre no primário."""
+
+    def setUp(self):
+        self.router = replicas.ReplicaRouter()
+        self.request = RequestFactory().get('/transactions/list')
+        patcher = mock.patch.object(replicas, 'replica_configured', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(replicas.lag_monitor, 'healthy', return_value=True)
+        self.healthy = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_inside_use_replica_go_to_replica(self):
+        seen = {}
+
+        @replicas.use_replica
+        def view(request):
+            seen['transaction'] = self.router.db_for_read(Transaction)
+            seen['idempotency'] = self.router.db_for_read(IdempotencyKey)
+            return HttpResponse()
+
+        view(self.request)
+        self.assertEqual(seen, {'transaction': 'replica', 'idempotency': None})
+        self.assertIsNone(self.router.db_for_read(Transaction))  # Fora da view
+
+    def test_write_in_request_pins_reads_to_primary(self):
+        token = replicas.start_request()
+        try:
+            self.assertEqual(replicas.choose_read_alias(self.request), 'replica')
+            self.assertEqual(self.router.db_for_write(Transaction), 'default')
+            self.assertIsNone(replicas.choose_read_alias(self.request))
+        finally:
+            self.assertTrue(replicas.finish_request(token))
+
+    def test_pin_cookie_and_lag_use_primary(self):
+        self.request.COOKIES['db_pinned'] = '1'
+        self.assertIsNone(replicas.choose_read_alias(self.request))
+        self.healthy.return_value = False
+        self.assertIsNone(replicas.choose_read_alias(RequestFactory().get('/')))
+
+    def test_middleware_sets_pin_cookie_after_write(self):
+        def write(request):
+            self.router.db_for_write(Transaction)
+            return HttpResponse()
+
+        response = ReplicaPinningMiddleware(write)(self.request)
+        self.assertIn('db_pinned', response.cookies)
+        response = ReplicaPinningMiddleware(lambda request: HttpResponse())(self.request)
+        self.assertNotIn('db_pinned', response.cookies)
+
+    def test_lag_measurement(self):
+        monitor = replicas.LagMonitor()
+        now = timezone.now()
+        latest = {'replica': now - timedelta(seconds=30), 'default': now}
+        config = dict(replicas.DEFAULT_READ_REPLICA_CONFIG, MAX_LAG=10)
+        with mock.patch.object(monitor, '_latest', side_effect=latest.get):
+            self.assertFalse(monitor.healthy(config))
+            self.assertEqual(monitor.lag, 30)
+            latest['replica'] = now
+            monitor.reset()
+            self.assertTrue(monitor.healthy(config))
+
+
+class MerchantRegistryTests(TestCase):
+    """Comerciantes e carteiras validados a partir do snapshot em memória."""
+
+    def setUp(self):
+        self.merchant = Merchant(name='Loja', client_id='loja-tests')
+        self.merchant.set_secret('segredo')
+        self.merchant.save()
+        Wallet.objects.create(merchant=self.merchant, wallet_id=990001, provider='mpesa')
+        self.registry = MerchantRegistry()
+
+    def test_authenticate_caches_verified_secret(self):
+        with mock.patch('payments_mpesa.merchants.check_password', wraps=check_password) as check:
+            self.assertIsNotNone(self.registry.authenticate('loja-tests', 'segredo'))
+            self.assertIsNotNone(self.registry.authenticate('loja-tests', 'segredo'))
+            self.assertIsNone(self.registry.authenticate('loja-tests', 'errado'))
+            self.assertIsNone(self.registry.authenticate('desconhecido', 'segredo'))
+        self.assertEqual(check.call_count, 2)  # Segredo certo uma vez, errado uma vez
+
+    def test_rotated_secret_is_verified_again(self):
+        self.assertIsNotNone(self.registry.authenticate('loja-tests', 'segredo'))
+        self.merchant.set_secret('novo')
+        self.merchant.save()
+        self.registry.invalidate()
+        self.assertIsNone(self.registry.authenticate('loja-tests', 'segredo'))
+        self.assertIsNotNone(self.registry.authenticate('loja-tests', 'novo'))
+
+    def test_snapshot_reloads_only_when_version_changes(self):
+        snapshot = self.registry.snapshot()
+        self.registry.invalidate()
+        self.assertIs(self.registry.snapshot(), snapshot)
+        Merchant.objects.filter(pk=self.merchant.pk).update(is_active=False, updated_at=timezone.now())
+        self.registry.invalidate()
+        self.assertIsNone(self.registry.snapshot().merchant('loja-tests'))
+        self.assertEqual(self.registry.reloads, 2)
+
+    def test_check_wallet(self):
+        snapshot = self.registry.snapshot()
+        self.assertIsNone(snapshot.check_wallet(990001, 'loja-tests', 'mpesa'))
+        self.assertEqual(snapshot.check_wallet(990002, 'loja-tests'), "carteira inexistente ou inativa")
+        self.assertIn('não pertence', snapshot.check_wallet(990001, 'outro'))
+        self.assertIn('emola', snapshot.check_wallet(990001, 'loja-tests', 'emola'))
+
+
+class TokenCacheTests(TestCase):
+    """Tokens OAuth validados ficam em cache (LRU com TTL) e dispensam a BD."""
+
+    def _token(self, access_token, seconds=3600):
+        return OAuthToken.objects.create(client_id='tests', access_token=access_token, expires_in=seconds,
+                                         expires_at=timezone.now() + timedelta(seconds=seconds))
+
+    def test_cached_token_skips_database(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self._token('tok1')
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='Bearer tok1')
+        self.assertTrue(views.validate_bearer_token(request)[0])
+        with self.assertNumQueries(0):
+            self.assertTrue(views.validate_bearer_token(request)[0])
+
+    def test_expired_and_evicted_entries(self):
+        cache = TokenCache(max_size=2, max_ttl=300)
+        cache.set('a', self._token('a'))
+        cache.set('b', self._token('b'))
+        cache.get('a')
+        cache.set('c', self._token('c'))  # Remove 'b', o menos usado
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.set('x', self._token('x', seconds=-1))  # Já expirado: não entra
+        self.assertIsNone(cache.get('x'))
+        with mock.patch('payments_mpesa.tokens.time.monotonic', return_value=time.monotonic() + 301):
+            self.assertIsNone(cache.get('a'))  # TOKEN_CACHE_MAX_TTL
+
+
+class RoutingTests(TestCase):
+    """Normalização do MSISDN e escolha do provider pelo prefixo mais longo."""
+
+    def test_normalize_msisdn(self):
+        for phone in ('841234567', '258841234567', '+258841234567', '00258841234567', '+258 84 123-4567',
+                      '(84) 123.45.67'):
+            self.assertEqual(normalize_msisdn(phone), '258841234567', phone)
+
+    def test_invalid_msisdn(self):
+        for phone in (None, '', '84123456', '8412345678', '259841234567', '25884123456a', '+00258841234567'):
+            with self.assertRaises(InvalidMsisdn, msg=phone):
+                normalize_msisdn(phone)
+
+    def test_longest_prefix_wins(self):
+        routes = compile_routes({'PREFIXES': {'84': 'mpesa', '86': 'emola'}})
+        self.assertEqual(routes.lookup('258841234567'), 'mpesa')
+        self.assertEqual(routes.lookup('258861234567'), 'emola')
+        self.assertIsNone(routes.lookup('258821234567'))
+        merchant = routes.with_overrides({'8610': 'mpesa', '84': None})
+        self.assertEqual(merchant.lookup('258861034567'), 'mpesa')
+        self.assertEqual(merchant.lookup('258861134567'), 'emola')
+        self.assertIsNone(merchant.lookup('258841234567'))
+
+    def test_validate_routing_rules(self):
+        validate_routing_rules({'8610': 'mpesa', '87': None})
+        for rules in ([], {'8a': 'mpesa'}, {'84': 'vodacom'}, {'8' * 10: 'mpesa'}):
+            with self.assertRaises(ValidationError, msg=rules):
+                validate_routing_rules(rules)
+
+    def test_merchant_rules_in_registry(self):
+        merchant = Merchant(name='Loja', client_id='loja-rotas', routing_rules={'87': None, '8610': 'mpesa'})
+        merchant.set_secret('segredo')
+        merchant.save()
+        snapshot = MerchantRegistry().snapshot()
+        self.assertEqual(snapshot.route('loja-rotas', '258861034567'), 'mpesa')
+        self.assertEqual(snapshot.route('outro', '258861034567'), 'emola')
+        with self.assertRaises(UnroutableMsisdn):
+            snapshot.route('loja-rotas', '258871234567')
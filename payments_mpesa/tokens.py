@@ -0,0 +1,124 @@
+"""
+Cache em memória dos tokens OAuth validados e limpeza dos tokens expirados.
+
+Cada processo guarda até OAUTH_CONFIG['TOKEN_CACHE_SIZE'] tokens (LRU), indexados
+pelo SHA-256 do token, de modo que requisições com um token "quente" não
+consultam a base de dados. Uma entrada expira no expires_at do token ou após
+TOKEN_CACHE_MAX_TTL segundos, o que ocorrer primeiro.
+"""
+
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import OAuthToken
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OAUTH_CONFIG = {
+    'TOKEN_CACHE_SIZE': 10000,
+    'TOKEN_CACHE_MAX_TTL': 300,
+    'PURGE_BATCH_SIZE': 1000,
+}
+
+
+def get_oauth_config():
+    """Retorna OAUTH_CONFIG completado com os valores padrão."""
+    return {**DEFAULT_OAUTH_CONFIG, **getattr(settings, 'OAUTH_CONFIG', {})}
+
+
+def hash_token(token):
+    """Chave do cache: o token nunca é guardado em claro."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    """Cache LRU com TTL, thread-safe, de tokens OAuth já validados."""
+
+    def __init__(self, max_size=DEFAULT_OAUTH_CONFIG['TOKEN_CACHE_SIZE'],
+                 max_ttl=DEFAULT_OAUTH_CONFIG['TOKEN_CACHE_MAX_TTL']):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()  # hash -> (deadline monotónico, OAuthToken)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        """Retorna o OAuthToken em cache ou None se ausente/expirado."""
+        key = hash_token(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            deadline, oauth_token = entry
+            if now >= deadline:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return oauth_token
+
+    def set(self, token, oauth_token):
+        """Guarda um token validado até ao seu expires_at (limitado por max_ttl)."""
+        remaining = (oauth_token.expires_at - timezone.now()).total_seconds()
+        ttl = min(remaining, self.max_ttl)
+        if ttl <= 0:
+            return
+        key = hash_token(token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, oauth_token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        """Remove um token do cache (ex.: revogação)."""
+        with self._lock:
+            self._entries.pop(hash_token(token), None)
+
+    def clear(self):
+        """Esvazia o cache e zera as estatísticas."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Retorna as estatísticas de uso do cache."""
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_config = get_oauth_config()
+token_cache = TokenCache(max_size=_config['TOKEN_CACHE_SIZE'], max_ttl=_config['TOKEN_CACHE_MAX_TTL'])
+
+
+def purge_expired_tokens(batch_size=None, now=None):
+    """
+    Apaga os OAuthToken expirados em lotes, para não bloquear a tabela.
+
+    Retorna o número total de linhas apagadas.
+    """
+    batch_size = batch_size or get_oauth_config()['PURGE_BATCH_SIZE']
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            OAuthToken.objects.filter(expires_at__lte=now)
+            .order_by('expires_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        deleted, _ = OAuthToken.objects.filter(id__in=ids).delete()
+        total += deleted
+        logger.info(f"Tokens OAuth expirados apagados: {deleted} (total {total})")
+    return total
@@ -11,16 +11,52 @@ urlpatterns = [
     # OAuth
     path('oauth/token', views.oauth_token, name='oauth_token'),
     
+    # C2B com provider escolhido pelo prefixo do número
+    path('v1/c2b/payment',
+         views.c2b_payment,
+         name='c2b_payment'),
+    
     # M-Pesa C2B
     path('v1/c2b/mpesa-payment/<int:wallet_id>', 
          views.mpesa_c2b_payment, 
          name='mpesa_c2b_payment'),
     
+    # eMola C2B
+    path('v1/c2b/emola-payment/<int:wallet_id>',
+         views.emola_c2b_payment,
+         name='emola_c2b_payment'),
+    
+    # B2C em massa
+    path('v1/b2c/bulk-disbursement/<int:wallet_id>',
+         views.bulk_disbursement,
+         name='bulk_disbursement'),
+    
+    path('v1/b2c/bulk-disbursement/batches/<int:batch_id>',
+         views.bulk_disbursement_status,
+         name='bulk_disbursement_status'),
+    
+    path('transactions/status/<str:transaction_reference>',
+         views.transaction_status,
+         name='transaction_status'),
+    
+    # Estado interno
+    path('internal/circuit-breakers',
+         views.circuit_breakers,
+         name='circuit_breakers'),
+    
+    path('internal/metrics',
+         views.prometheus_metrics,
+         name='prometheus_metrics'),
+    
     # Relatórios
     path('transactions/list', 
          views.transactions_list, 
          name='transactions_list'),
     
+    path('transactions/export',
+         views.transactions_export,
+         name='transactions_export'),
+    
     path('transactions/daily-report', 
          views.transactions_daily_report, 
          name='transactions_daily_report'),
@@ -3,19 +3,43 @@ Endpoints da API adaptados para funcionar com o frontend Vuex/Quasar.
 Suporta autenticação OAuth2 e processamento de pagamentos M-Pesa C2B.
 """
 
-from django.http import JsonResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET
-from .mpesa import Mpesa
+from .mpesa import Mpesa, request_not_sent
+import asyncio
+import functools
+import hmac
+import heapq
 import json
 import logging
 import uuid
 from datetime import datetime, timedelta
 from django.db import models
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views import View
 
-from .models import Transaction, OAuthToken
+from .models import Transaction, TransactionArchive, OAuthToken, TransactionDailyStats, DisbursementBatch
+from .jobs import enqueue_payment, get_queue_config, apply_mpesa_result
+from .tokens import token_cache
+from .idempotency import (
+    aclaim_key, claim_key, complete_key, release_key, mark_key_ambiguous, make_key, hash_request,
+    REPLAY, MISMATCH, IN_PROGRESS, AMBIGUOUS,
+)
+from .breaker import breakers
+from .ratelimit import aadmit, upstream_slot, rejection_response, AdmissionRejected
+from .metrics import metrics, render, get_metrics_config
+from .bulk import parse_csv, validate_items, create_batch, batch_progress, InvalidBatch
+from .pagination import apply_keyset, encode_cursor, iterate_keyset, stream_json_rows, InvalidCursor
+from .export import parse_filters, export_stream, export_filename, InvalidExport
+from .replicas import use_replica
+from .archive import tiered_page, find_transaction, row_key
+from .merchants import registry
+from .routing import normalize_msisdn, InvalidMsisdn, UnroutableMsisdn
+from payments_emola.emola import EmolaClient
+from payments_emola.models import Transaction as EmolaTransaction
 from django.db.models import Sum, Count
 
 logger = logging.getLogger(__name__)
@@ -36,20 +60,74 @@ def generate_third_party_reference():
     return uuid_str[:20]
 
 
-def validate_bearer_token(request):
-    """Valida o token Bearer enviado no header Authorization."""
+def generate_emola_trans_id():
+    """Gera o transId de um pedido à eMola (único na tabela payments_emola)."""
+    return str(uuid.uuid4())[:30]
+
+
+def _extract_bearer_token(request):
+    """Extrai o token do header Authorization (None se ausente)."""
     auth_header = request.headers.get('Authorization', '')
     
     if not auth_header.startswith('Bearer '):
+        return None
+    
+    return auth_header.replace('Bearer ', '').strip()
+
+
+def validate_bearer_token(request):
+    """Valida o token Bearer enviado no header Authorization."""
+    token = _extract_bearer_token(request)
+    if token is None:
         return False, "Token inválido ou ausente"
     
-    token = auth_header.replace('Bearer ', '').strip()
+    # Tokens recentemente validados dispensam a consulta à base de dados
+    oauth_token = token_cache.get(token)
+    if oauth_token is not None:
+        return True, oauth_token
     
     try:
         oauth_token = OAuthToken.objects.get(
             access_token=token,
             expires_at__gt=datetime.now()
         )
+        token_cache.set(token, oauth_token)
+        return True, oauth_token
+    except OAuthToken.DoesNotExist:
+        return False, "Token expirado ou inválido"
+
+
+def _replay_response(record):
+    """Resposta guardada de um pedido idempotente já concluído."""
+    response = JsonResponse(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def use_accept_mode(request):
+    """Indica se o pagamento deve ser enfileirado (202) em vez de processado na hora."""
+    if 'respond-async' in request.headers.get('Prefer', ''):
+        return True
+    return bool(get_queue_config()['ENABLED'])
+
+
+async def avalidate_bearer_token(request):
+    """Versão assíncrona de validate_bearer_token para views async."""
+    token = _extract_bearer_token(request)
+    if token is None:
+        return False, "Token inválido ou ausente"
+    
+    # Tokens recentemente validados dispensam a consulta à base de dados
+    oauth_token = token_cache.get(token)
+    if oauth_token is not None:
+        return True, oauth_token
+    
+    try:
+        oauth_token = await OAuthToken.objects.aget(
+            access_token=token,
+            expires_at__gt=datetime.now()
+        )
+        token_cache.set(token, oauth_token)
         return True, oauth_token
     except OAuthToken.DoesNotExist:
         return False, "Token expirado ou inválido"
@@ -65,8 +143,8 @@ def oauth_token(request):
     POST /oauth/token
     Body: {
         "grant_type": "client_credentials",
-        "client_id": "a0140c9f-4c66-426e-beea-73bef5ac5023",
-        "client_secret": "4lmO05AdGlnwmkrbDXDhm4eFTvxi5j0Sb8YsviVx"
+        "client_id": "<client_id>",
+        "client_secret": "<client_secret>"
     }
     """
     try:
@@ -80,11 +158,8 @@ def oauth_token(request):
         if grant_type != 'client_credentials':
             return JsonResponse({'error': 'grant_type inválido'}, status=400)
         
-        # Credenciais válidas (da carteira Mawonelo)
-        VALID_CLIENT_ID = 'a0140c9f-4c66-426e-beea-73bef5ac5023'
-        VALID_CLIENT_SECRET = '4lmO05AdGlnwmkrbDXDhm4eFTvxi5j0Sb8YsviVx'
-        
-        if client_id != VALID_CLIENT_ID or client_secret != VALID_CLIENT_SECRET:
+        # Credenciais do registo de comerciantes (Merchant, em memória)
+        if registry.authenticate(client_id, client_secret) is None:
             logger.warning(f"Tentativa de autenticação com credenciais inválidas: {client_id}")
             return JsonResponse({'error': 'Credenciais inválidas'}, status=401)
         
@@ -119,16 +194,176 @@ def oauth_token(request):
 
 # ==================== MPESA C2B PAYMENT ENDPOINT ====================
 
+async def _execute_c2b(request, transaction_reference, third_party_reference, customer_msisdn, amount, from_app):
+    """Enfileira ou executa o C2B e retorna (corpo, status HTTP) da resposta final."""
+    # Modo aceitar-e-processar: grava 'pending', enfileira e responde 202
+    if use_accept_mode(request):
+        await sync_to_async(enqueue_payment)(
+            "C2B",
+            transaction_reference,
+            third_party_reference,
+            customer_msisdn,
+            amount,
+            from_app=from_app
+        )
+        return {
+            'success': True,
+            'status': 'pending',
+            'third_party_reference': third_party_reference,
+            'customer_msisdn': customer_msisdn,
+            'amount': amount,
+            'transaction_reference': transaction_reference,
+            'status_url': f'/transactions/status/{transaction_reference}',
+            'message': 'Pagamento aceite para processamento'
+        }, 202
+
+    # Vaga limitada por MAX_IN_FLIGHT, ocupada antes de gravar: um pedido recusado
+    # não deixa linha 'pending'. A linha é gravada antes da chamada: se o processo
+    # morrer a meio, a reconciliação encontra-a e consulta o estado no M-Pesa
+    mpesa = Mpesa.get_instance()
+    async with upstream_slot():
+        txn = await Transaction.objects.acreate(
+            transaction_type="C2B",
+            transaction_reference=transaction_reference,
+            third_party_reference=third_party_reference,
+            customer_msisdn=customer_msisdn,
+            amount=amount,
+            status='pending',
+            message='Pagamento em processamento',
+            from_app=from_app
+        )
+        response = await mpesa.ac2b(
+            transaction_reference,
+            customer_msisdn,
+            amount,
+            third_party_reference,
+            service_provider_code=None  # Usa o padrão
+        )
+
+    # Salva o resultado na transação
+    await sync_to_async(apply_mpesa_result)(txn, response)
+
+    if response.get('success', False):
+        logger.info("Transação M-Pesa C2B bem-sucedida: %s", response['response']['output_TransactionID'],
+                    extra={'reference': transaction_reference})
+
+        return {
+            'success': True,
+            'status': 'success',
+            'transaction_id': response['response'].get('output_TransactionID'),
+            'conversation_id': response['response'].get('output_ConversationID'),
+            'third_party_reference': third_party_reference,
+            'customer_msisdn': customer_msisdn,
+            'amount': amount,
+            'transaction_reference': transaction_reference,
+            'message': response['error_message']
+        }, 200
+    else:
+        logger.error(f"Falha na transação M-Pesa C2B: {response['error_message']}")
+
+        return {
+            'success': False,
+            'status': 'error',
+            'message': response['error_message'],
+            'response': response['response']
+        }, 400
+
+
+# Pagamentos em curso protegidos do cancelamento da view (referência forte até terminarem)
+_settling = set()
+
+
+async def _shielded(coro):
+    """
+    Executa `coro` numa task que não é cancelada quando o cliente desliga.
+
+    Sob ASGI o Django cancela a view se o cliente fechar a ligação (p.ex.
+    timeout à espera do PIN USSD); a chamada ao fornecedor, a gravação da
+    transação e a da chave de idempotência continuam até ao fim.
+    """
+    task = asyncio.ensure_future(coro)
+    _settling.add(task)
+    task.add_done_callback(_settling.discard)
+    return await asyncio.shield(task)
+
+
+async def _settle_c2b(record, client_id, from_app, customer_msisdn, execute):
+    """Admissão, chamada ao provider e resultado da chave de idempotência (`record` pode ser None)."""
+    try:
+        await aadmit(client_id, from_app, customer_msisdn)
+        body, status = await execute()
+    except AdmissionRejected as e:
+        if record is not None:
+            await sync_to_async(release_key)(record)
+        return rejection_response(e)
+    except Exception as e:
+        if record is not None:
+            # Só um pedido que não chegou ao fornecedor pode ser repetido com a mesma chave
+            if request_not_sent(e):
+                await sync_to_async(release_key)(record)
+            else:
+                await sync_to_async(mark_key_ambiguous)(record)
+        raise
+    if record is not None:
+        await sync_to_async(complete_key)(record, status, body)
+    return JsonResponse(body, status=status)
+
+
+async def _run_c2b(request, client_id, data, reference, from_app, customer_msisdn, execute, provider,
+                   upstream_reference):
+    """
+    Idempotência e controlo de admissão comuns aos pagamentos C2B.
+    
+    `execute` é a coroutine do provider, que devolve (body, status);
+    `upstream_reference` é a referência enviada ao provider (third_party_reference
+    no M-Pesa, transId na eMola), guardada na chave para a reconciliação.
+    """
+    # Idempotência: header Idempotency-Key ou, na sua falta, a referência do cliente
+    idempotency_key = request.headers.get('Idempotency-Key') or reference
+    if not idempotency_key:
+        return await _shielded(_settle_c2b(None, client_id, from_app, customer_msisdn, execute))
+    
+    outcome, record = await aclaim_key(
+        make_key("C2B", client_id, idempotency_key), "C2B", hash_request(data),
+        provider=provider, upstream_reference=upstream_reference
+    )
+    if outcome == REPLAY:
+        logger.info(f"Pedido C2B repetido, devolvida a resposta original: {idempotency_key}")
+        return _replay_response(record)
+    if outcome == MISMATCH:
+        return JsonResponse({'error': 'Idempotency-Key já utilizada com outro pedido'}, status=422)
+    if outcome == IN_PROGRESS:
+        return JsonResponse({'error': 'Pedido original ainda em processamento'}, status=409)
+    if outcome == AMBIGUOUS:
+        return JsonResponse({'error': 'Resultado do pedido original desconhecido: a aguardar consulta de estado'},
+                            status=409)
+    
+    # Pedidos repetidos (replay) não consomem tokens
+    return await _shielded(_settle_c2b(record, client_id, from_app, customer_msisdn, execute))
+
+
 @csrf_exempt
 @require_POST
-def mpesa_c2b_payment(request, wallet_id):
+async def mpesa_c2b_payment(request, wallet_id):
     """
     Endpoint para processar pagamentos M-Pesa C2B.
     POST /v1/c2b/mpesa-payment/{wallet_id}
     
+    View assíncrona: sob ASGI o worker não fica bloqueado enquanto o
+    cliente confirma o PIN USSD. Com o header "Prefer: respond-async" (ou
+    PAYMENT_QUEUE_CONFIG['ENABLED']) o pagamento é enfileirado e a resposta
+    é 202; o resultado é consultado em GET /transactions/status/{reference}.
+    
+    Pedidos repetidos com o mesmo Idempotency-Key (ou a mesma "reference")
+    recebem a resposta original, sem novo push USSD.
+    
+    Controlo de admissão (RATE_LIMIT_CONFIG): token buckets por client_id,
+    fromApp e MSISDN; acima do limite a resposta é 429 com Retry-After.
+    
     Headers:
         Authorization: Bearer {token}
         Content-Type: application/json
+        Idempotency-Key: {chave única do pedido} (opcional)
     
     Body: {
         "client_id": "a0140c9f-4c66-426e-beea-73bef5ac5023",
@@ -140,7 +375,7 @@ def mpesa_c2b_payment(request, wallet_id):
     """
     try:
         # Valida o token
-        is_valid, result = validate_bearer_token(request)
+        is_valid, result = await avalidate_bearer_token(request)
         if not is_valid:
             logger.warning(f"Tentativa de pagamento com token inválido: {result}")
             return JsonResponse({'error': result}, status=401)
@@ -162,14 +397,21 @@ def mpesa_c2b_payment(request, wallet_id):
                 'required': ['client_id', 'phone', 'amount']
             }, status=400)
         
-        # Valida o wallet_id
-        VALID_WALLET_ID = 132722
-        if int(wallet_id) != VALID_WALLET_ID:
-            logger.warning(f"Wallet ID inválido: {wallet_id}")
+        if client_id != result.client_id:
+            logger.warning(f"client_id do pedido difere do token: {client_id}")
+            return JsonResponse({'error': 'client_id não corresponde ao token'}, status=403)
+        
+        # Valida o wallet_id (registo de comerciantes em memória)
+        snapshot = await registry.asnapshot()
+        reason = snapshot.check_wallet(wallet_id, client_id, 'mpesa')
+        if reason:
+            logger.warning(f"Wallet ID inválido: {wallet_id} ({reason})")
             return JsonResponse({'error': 'Wallet ID inválido'}, status=400)
         
-        # Normaliza o número de telefone (adiciona 258 se necessário)
-        customer_msisdn = phone if phone.startswith('258') else f'258{phone}'
+        try:
+            customer_msisdn = normalize_msisdn(phone)
+        except InvalidMsisdn as e:
+            return JsonResponse({'error': str(e)}, status=400)
         
         # Gera referências se não fornecidas
         transaction_reference = reference or generate_transaction_reference()
@@ -180,68 +422,14 @@ def mpesa_c2b_payment(request, wallet_id):
             logger.warning(f"transaction_reference muito longo: {transaction_reference}")
             return JsonResponse({'error': 'Referência excede 20 caracteres'}, status=400)
         
-        logger.info(f"Processando pagamento M-Pesa C2B: {customer_msisdn}, {amount} MT, App: {from_app}")
+        logger.info("Processando pagamento M-Pesa C2B: %s, %s MT, App: %s", customer_msisdn, amount, from_app,
+                    extra={'reference': transaction_reference})
         
-        # Processa o pagamento via M-Pesa
-        mpesa = Mpesa()
-        response = mpesa.c2b(
-            transaction_reference,
-            customer_msisdn,
-            amount,
-            third_party_reference,
-            service_provider_code=None  # Usa o padrão
+        execute = functools.partial(
+            _execute_c2b, request, transaction_reference, third_party_reference, customer_msisdn, amount, from_app
         )
-        
-        # Salva a transação no banco de dados
-        if response.get('success', False):
-            logger.info(f"Transação M-Pesa C2B bem-sucedida: {response['response']['output_TransactionID']}")
-            
-            Transaction.objects.create(
-                transaction_type="C2B",
-                transaction_id=response['response'].get('output_TransactionID'),
-                conversation_id=response['response'].get('output_ConversationID'),
-                transaction_reference=transaction_reference,
-                third_party_reference=third_party_reference,
-                customer_msisdn=customer_msisdn,
-                amount=amount,
-                status='success',
-                message=response['error_message'],
-                raw_response=response['response'],
-                from_app=from_app
-            )
-            
-            return JsonResponse({
-                'success': True,
-                'status': 'success',
-                'transaction_id': response['response'].get('output_TransactionID'),
-                'conversation_id': response['response'].get('output_ConversationID'),
-                'third_party_reference': third_party_reference,
-                'customer_msisdn': customer_msisdn,
-                'amount': amount,
-                'transaction_reference': transaction_reference,
-                'message': response['error_message']
-            }, status=200)
-        else:
-            logger.error(f"Falha na transação M-Pesa C2B: {response['error_message']}")
-            
-            Transaction.objects.create(
-                transaction_type="C2B",
-                transaction_reference=transaction_reference,
-                third_party_reference=third_party_reference,
-                customer_msisdn=customer_msisdn,
-                amount=amount,
-                status='error',
-                message=response['error_message'],
-                raw_response=response['response'],
-                from_app=from_app
-            )
-            
-            return JsonResponse({
-                'success': False,
-                'status': 'error',
-                'message': response['error_message'],
-                'response': response['response']
-            }, status=400)
+        return await _run_c2b(request, result.client_id, data, reference, from_app, customer_msisdn, execute,
+                              'mpesa', third_party_reference)
             
     except json.JSONDecodeError:
         return JsonResponse({'error': 'JSON inválido'}, status=400)
@@ -250,29 +438,315 @@ def mpesa_c2b_payment(request, wallet_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+# ==================== STATUS DE TRANSAÇÃO ====================
+
+@require_GET
+@csrf_exempt
+def transaction_status(request, transaction_reference):
+    """
+    Consulta o estado de uma transação (usado no modo aceitar-e-processar).
+    GET /transactions/status/{transaction_reference}
+    """
+    is_valid, result = validate_bearer_token(request)
+    if not is_valid:
+        return JsonResponse({'error': result}, status=401)
+
+    # Tabela quente e, se não estiver lá, o arquivo
+    txn = find_transaction(
+        transaction_reference,
+        ('transaction_type', 'transaction_id', 'transaction_reference', 'third_party_reference',
+         'status', 'message', 'created_at', 'updated_at')
+    )
+    if txn is None:
+        return JsonResponse({'error': 'Transação não encontrada'}, status=404)
+
+    return JsonResponse({
+        'transaction_reference': txn.transaction_reference,
+        'third_party_reference': txn.third_party_reference,
+        'transaction_type': txn.transaction_type,
+        'transaction_id': txn.transaction_id,
+        'status': txn.status,
+        'message': txn.message,
+        'created_at': txn.created_at.isoformat(),
+        'updated_at': txn.updated_at.isoformat(),
+    })
+
+
+# ==================== DESEMBOLSO B2C EM MASSA ====================
+
+BATCH_ITEM_FIELDS = (
+    'id', 'transaction_reference', 'third_party_reference', 'customer_msisdn', 'amount',
+    'status', 'message', 'transaction_id', 'created_at', 'updated_at',
+)
+
+
+@csrf_exempt
+@require_POST
+def bulk_disbursement(request, wallet_id):
+    """
+    Cria um lote de desembolsos B2C processado em segundo plano pelos workers.
+    POST /v1/b2c/bulk-disbursement/{wallet_id}
+    
+    Headers:
+        Authorization: Bearer {token}
+        Idempotency-Key: {chave única do lote} (opcional)
+    
+    Body JSON: {
+        "provider": "mpesa",            # ou "emola"
+        "fromApp": "CartaFacil",
+        "content": "Pagamento mensal",  # opcional (SMS eMola)
+        "items": [{"msisdn": "258840000000", "amount": "100", "reference": "SAL2025100001"}, ...]
+    }
+    ou multipart/form-data com o ficheiro "file" (CSV: msisdn,amount,reference)
+    e os campos provider/fromApp/content.
+    """
+    is_valid, result = validate_bearer_token(request)
+    if not is_valid:
+        return JsonResponse({'error': result}, status=401)
+
+    # O provider do lote é escolhido no corpo: só se exige que a carteira seja do cliente
+    reason = registry.snapshot().check_wallet(wallet_id, result.client_id)
+    if reason:
+        logger.warning(f"Wallet ID inválido: {wallet_id} ({reason})")
+        return JsonResponse({'error': 'Wallet ID inválido'}, status=400)
+
+    try:
+        if request.content_type == 'multipart/form-data':
+            upload = request.FILES.get('file')
+            if upload is None:
+                return JsonResponse({'error': 'Ficheiro CSV ausente (campo "file")'}, status=400)
+            options = request.POST
+            try:
+                text = upload.read().decode('utf-8')
+            except UnicodeDecodeError:
+                return JsonResponse({'error': 'O CSV deve estar em UTF-8'}, status=400)
+            items = parse_csv(text)
+            fingerprint = {'file': hash_request(text)}
+        else:
+            options = json.loads(request.body)
+            items = options.get('items')
+            fingerprint = {'items': items}
+
+        provider = options.get('provider', 'mpesa')
+        from_app = options.get('fromApp', 'Unknown')
+        content = options.get('content', '')
+        if provider not in dict(Transaction.PROVIDERS):
+            return JsonResponse({'error': 'provider inválido', 'allowed': list(dict(Transaction.PROVIDERS))}, status=400)
+
+        items = validate_items(items)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    except InvalidBatch as e:
+        return JsonResponse({'error': str(e), 'errors': e.errors[:100]}, status=400)
+
+    # Idempotência: reenviar o mesmo lote não duplica os desembolsos
+    record = None
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        fingerprint.update(provider=provider, fromApp=from_app, content=content)
+        outcome, record = claim_key(make_key("BULK", result.client_id, idempotency_key), "BULK", hash_request(fingerprint))
+        if outcome == REPLAY:
+            return _replay_response(record)
+        if outcome == MISMATCH:
+            return JsonResponse({'error': 'Idempotency-Key já utilizada com outro pedido'}, status=422)
+        if outcome == IN_PROGRESS:
+            return JsonResponse({'error': 'Pedido original ainda em processamento'}, status=409)
+        if outcome == AMBIGUOUS:
+            # O processo original morreu: o lote pode ter sido criado, não se cria outro
+            return JsonResponse({'error': 'Resultado do pedido original desconhecido'}, status=409)
+
+    try:
+        batch = create_batch(items, provider=provider, from_app=from_app, client_id=result.client_id, content=content)
+    except Exception as e:
+        if record is not None:
+            release_key(record)
+        logger.error(f"Erro ao criar lote de desembolso: {str(e)}")
+        return JsonResponse({'error': 'Erro interno do servidor'}, status=500)
+
+    body = {
+        'success': True,
+        'batch_id': batch.pk,
+        'status': batch.status,
+        'provider': provider,
+        'total_items': batch.total_items,
+        'total_amount': str(batch.total_amount),
+        'status_url': f'/v1/b2c/bulk-disbursement/batches/{batch.pk}',
+        'message': 'Lote aceite para processamento'
+    }
+    if record is not None:
+        complete_key(record, 202, body)
+    return JsonResponse(body, status=202)
+
+
+@require_GET
+@csrf_exempt
+def bulk_disbursement_status(request, batch_id):
+    """
+    Progresso de um lote e, com ?items=1, os resultados por item (paginados).
+    GET /v1/b2c/bulk-disbursement/batches/{batch_id}?items=1&status=error&limit=100&cursor=...
+    """
+    is_valid, result = validate_bearer_token(request)
+    if not is_valid:
+        return JsonResponse({'error': result}, status=401)
+
+    batch = DisbursementBatch.objects.filter(pk=batch_id).first()
+    if batch is None:
+        return JsonResponse({'error': 'Lote não encontrado'}, status=404)
+
+    response = {
+        'batch_id': batch.pk,
+        'provider': batch.provider,
+        'status': batch.status,
+        'from_app': batch.from_app,
+        'total_amount': batch.total_amount,
+        'created_at': batch.created_at,
+        'completed_at': batch.completed_at,
+        'progress': batch_progress(batch),
+    }
+
+    if request.GET.get('items'):
+        try:
+            limit = min(max(int(request.GET.get('limit', LIST_DEFAULT_LIMIT)), 1), LIST_MAX_LIMIT)
+        except ValueError:
+            return JsonResponse({'error': 'limit inválido'}, status=400)
+        qs = Transaction.objects.filter(batch=batch)
+        if request.GET.get('status'):
+            qs = qs.filter(status=request.GET['status'])
+        try:
+            qs = apply_keyset(qs, request.GET.get('cursor'))
+        except InvalidCursor:
+            return JsonResponse({'error': 'cursor inválido'}, status=400)
+
+        rows = list(qs.values(*BATCH_ITEM_FIELDS)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        response['items'] = rows
+        response['next_cursor'] = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None
+
+    return JsonResponse(response)
+
+
+# ==================== ESTADO INTERNO ====================
+
+@require_GET
+@csrf_exempt
+def circuit_breakers(request):
+    """
+    Estado dos circuit breakers e timeouts adaptativos de cada upstream/operação.
+    GET /internal/circuit-breakers
+    """
+    is_valid, result = validate_bearer_token(request)
+    if not is_valid:
+        return JsonResponse({'error': result}, status=401)
+    return JsonResponse({'breakers': breakers.snapshot()})
+
+
+@require_GET
+@csrf_exempt
+def prometheus_metrics(request):
+    """
+    Métricas no formato de texto Prometheus.
+    GET /internal/metrics
+
+    Com METRICS_CONFIG['TOKEN'] definido, o scraper envia esse token estático
+    (Authorization: Bearer {token}); caso contrário exige um token OAuth válido.
+    """
+    static_token = get_metrics_config()['TOKEN']
+    if static_token:
+        token = _extract_bearer_token(request) or ''
+        if not hmac.compare_digest(token.encode(), static_token.encode()):
+            return JsonResponse({'error': "Token inválido ou ausente"}, status=401)
+    else:
+        is_valid, result = validate_bearer_token(request)
+        if not is_valid:
+            return JsonResponse({'error': result}, status=401)
+    return HttpResponse(render(metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ==================== EMOLA C2B PAYMENT ENDPOINT ====================
 
+async def _execute_emola_c2b(transaction_reference, trans_id, customer_msisdn, amount, content):
+    """
+    Envia o push USSD eMola e grava a transação (payments_emola) como 'pending'.
+    
+    A linha é gravada antes do push (um callback nunca chega antes dela); o
+    resultado final chega pelo callback eMola (payments_emola.callbacks).
+    Retorna (body, status) como _execute_c2b.
+    """
+    emola = EmolaClient.get_instance()
+    async with upstream_slot():
+        txn = await EmolaTransaction.objects.acreate(
+            trans_id=trans_id,
+            msisdn=customer_msisdn,
+            amount=amount,
+            content=content or '',
+            ref_no=transaction_reference,
+            status='pending'
+        )
+        response = await emola.apush_used_message(
+            customer_msisdn, amount, content or f'Pagamento {transaction_reference}', trans_id,
+            ref_no=transaction_reference
+        )
+    
+    if response.ok:
+        # O callback pode já ter finalizado a linha: só o request_id é gravado
+        await EmolaTransaction.objects.filter(pk=txn.pk).aupdate(
+            request_id=response.request_id, updated_at=timezone.now()
+        )
+        logger.info("Push eMola C2B enviado: %s (transId %s)", customer_msisdn, trans_id,
+                    extra={'reference': transaction_reference})
+        return {
+            'success': True,
+            'status': 'pending',
+            'provider': 'emola',
+            'trans_id': trans_id,
+            'request_id': response.request_id,
+            'transaction_reference': transaction_reference,
+            'customer_msisdn': customer_msisdn,
+            'amount': amount,
+            'message': response.message or 'Aguarda confirmação do cliente'
+        }, 202
+    
+    await EmolaTransaction.objects.filter(pk=txn.pk, status='pending').aupdate(
+        status='failed', updated_at=timezone.now()
+    )
+    message = response.message if response.error_code is not None else (response.description or response.error)
+    logger.error(f"Falha no push eMola C2B: {message}")
+    return {
+        'success': False,
+        'status': 'error',
+        'provider': 'emola',
+        'message': message,
+        'response': response.to_dict()
+    }, 400
+
+
 @csrf_exempt
 @require_POST
-def emola_c2b_payment(request, wallet_id):
+async def emola_c2b_payment(request, wallet_id):
     """
-    Endpoint para processar pagamentos eMola C2B.
+    Endpoint para processar pagamentos eMola C2B (push USSD).
     POST /v1/c2b/emola-payment/{wallet_id}
     
+    A confirmação do cliente chega pelo callback eMola: a resposta é 202
+    com status 'pending' e o trans_id da transação.
+    
     Headers:
         Authorization: Bearer {token}
         Content-Type: application/json
+        Idempotency-Key: {chave única do pedido} (opcional)
     
     Body: {
         "client_id": "a0140c9f-4c66-426e-beea-73bef5ac5023",
         "phone": "258860000000",
         "amount": "100",
-        "reference": "CUSTOM_REF_123"
+        "reference": "CUSTOM_REF_123",
+        "content": "Pagamento da fatura 123"
     }
     """
     try:
         # Valida o token
-        is_valid, result = validate_bearer_token(request)
+        is_valid, result = await avalidate_bearer_token(request)
         if not is_valid:
             logger.warning(f"Tentativa de pagamento eMola com token inválido: {result}")
             return JsonResponse({'error': result}, status=401)
@@ -284,6 +758,7 @@ def emola_c2b_payment(request, wallet_id):
         phone = data.get('phone')
         amount = data.get('amount')
         reference = data.get('reference')
+        from_app = data.get('fromApp', 'Unknown')
         
         # Validação dos campos obrigatórios
         if not all([client_id, phone, amount]):
@@ -293,32 +768,35 @@ def emola_c2b_payment(request, wallet_id):
                 'required': ['client_id', 'phone', 'amount']
             }, status=400)
         
-        # Valida o wallet_id
-        VALID_WALLET_ID = 989473  # Wallet ID para eMola
-        if int(wallet_id) != VALID_WALLET_ID:
-            logger.warning(f"Wallet ID eMola inválido: {wallet_id}")
+        if client_id != result.client_id:
+            logger.warning(f"client_id do pedido eMola difere do token: {client_id}")
+            return JsonResponse({'error': 'client_id não corresponde ao token'}, status=403)
+        
+        # Valida o wallet_id (registo de comerciantes em memória)
+        snapshot = await registry.asnapshot()
+        reason = snapshot.check_wallet(wallet_id, client_id, 'emola')
+        if reason:
+            logger.warning(f"Wallet ID eMola inválido: {wallet_id} ({reason})")
             return JsonResponse({'error': 'Wallet ID inválido'}, status=400)
         
-        # Normaliza o número de telefone
-        customer_msisdn = phone if phone.startswith('258') else f'258{phone}'
+        try:
+            customer_msisdn = normalize_msisdn(phone)
+        except InvalidMsisdn as e:
+            return JsonResponse({'error': str(e)}, status=400)
         
-        # Gera referências
         transaction_reference = reference or generate_transaction_reference()
-        third_party_reference = generate_third_party_reference()
-        
-        logger.info(f"Processando pagamento eMola C2B: {customer_msisdn}, {amount} MT")
+        if len(transaction_reference) > 20:
+            return JsonResponse({'error': 'Referência excede 20 caracteres'}, status=400)
         
-        # TODO: Implementar integração com eMola
-        # Por enquanto, retorna sucesso simulado
+        logger.info("Processando pagamento eMola C2B: %s, %s MT, App: %s", customer_msisdn, amount, from_app,
+                    extra={'reference': transaction_reference})
         
-        return JsonResponse({
-            'success': True,
-            'status': 'success',
-            'message': 'Pagamento eMola processado com sucesso',
-            'transaction_reference': transaction_reference,
-            'customer_msisdn': customer_msisdn,
-            'amount': amount
-        }, status=200)
+        trans_id = generate_emola_trans_id()
+        execute = functools.partial(
+            _execute_emola_c2b, transaction_reference, trans_id, customer_msisdn, amount, data.get('content')
+        )
+        return await _run_c2b(request, client_id, data, reference, from_app, customer_msisdn, execute,
+                              'emola', trans_id)
         
     except json.JSONDecodeError:
         return JsonResponse({'error': 'JSON inválido'}, status=400)
@@ -327,79 +805,260 @@ def emola_c2b_payment(request, wallet_id):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+# ==================== PAGAMENTO C2B UNIFICADO ====================
+
+@csrf_exempt
+@require_POST
+async def c2b_payment(request):
+    """
+    Pagamento C2B com escolha automática do provider pelo número do cliente.
+    POST /v1/c2b/payment
+    
+    O MSISDN é normalizado uma vez e roteado pela tabela de prefixos em
+    memória (PAYMENT_ROUTING_CONFIG: 84/85 -> M-Pesa, 86/87 -> eMola, com
+    as regras do comerciante em Merchant.routing_rules por cima). O pedido
+    segue o fluxo do provider escolhido (idempotência, controlo de admissão,
+    modo aceitar-e-processar no M-Pesa) usando a carteira do comerciante
+    nesse provider; o header Payment-Provider indica o provider usado.
+    
+    Headers:
+        Authorization: Bearer {token}
+        Content-Type: application/json
+        Idempotency-Key: {chave única do pedido} (opcional)
+    
+    Body: {
+        "client_id": "a0140c9f-4c66-426e-beea-73bef5ac5023",
+        "phone": "840000000",
+        "amount": "100",
+        "reference": "CUSTOM_REF_123",
+        "fromApp": "CartaFacil",
+        "content": "Pagamento da fatura 123"  # opcional (SMS eMola)
+    }
+    """
+    try:
+        is_valid, result = await avalidate_bearer_token(request)
+        if not is_valid:
+            logger.warning(f"Tentativa de pagamento com token inválido: {result}")
+            return JsonResponse({'error': result}, status=401)
+        
+        data = json.loads(request.body)
+        
+        client_id = data.get('client_id')
+        phone = data.get('phone')
+        amount = data.get('amount')
+        reference = data.get('reference')
+        from_app = data.get('fromApp', 'Unknown')
+        
+        if not all([client_id, phone, amount]):
+            return JsonResponse({
+                'error': 'Parâmetros obrigatórios ausentes',
+                'required': ['client_id', 'phone', 'amount']
+            }, status=400)
+        
+        if client_id != result.client_id:
+            logger.warning(f"client_id do pedido difere do token: {client_id}")
+            return JsonResponse({'error': 'client_id não corresponde ao token'}, status=403)
+        
+        try:
+            customer_msisdn = normalize_msisdn(phone)
+        except InvalidMsisdn as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        snapshot = await registry.asnapshot()
+        try:
+            provider = snapshot.route(client_id, customer_msisdn)
+        except UnroutableMsisdn as e:
+            return JsonResponse({'error': str(e)}, status=422)
+        if snapshot.wallet_for(client_id, provider) is None:
+            logger.warning(f"Cliente {client_id} sem carteira {provider} para {customer_msisdn}")
+            return JsonResponse({'error': f'Sem carteira {provider} para este cliente'}, status=422)
+        
+        transaction_reference = reference or generate_transaction_reference()
+        if len(transaction_reference) > 20:
+            return JsonResponse({'error': 'Referência excede 20 caracteres'}, status=400)
+        
+        logger.info("Processando pagamento C2B via %s: %s, %s MT, App: %s", provider, customer_msisdn, amount,
+                    from_app, extra={'reference': transaction_reference})
+        
+        if provider == 'emola':
+            upstream_reference = generate_emola_trans_id()
+            execute = functools.partial(
+                _execute_emola_c2b, transaction_reference, upstream_reference, customer_msisdn, amount,
+                data.get('content')
+            )
+        else:
+            upstream_reference = generate_third_party_reference()
+            execute = functools.partial(
+                _execute_c2b, request, transaction_reference, upstream_reference, customer_msisdn, amount, from_app
+            )
+        response = await _run_c2b(request, client_id, data, reference, from_app, customer_msisdn, execute,
+                                  provider, upstream_reference)
+        response['Payment-Provider'] = provider
+        return response
+        
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    except Exception as e:
+        logger.error(f"Erro no endpoint C2B unificado: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+
 # ==================== ENDPOINTS DE RELATÓRIOS ====================
+# Só leitura: com réplica configurada (READ_REPLICA_CONFIG) as queries vão para ela
+
+# Colunas devolvidas pela listagem (raw_response nunca é carregado)
+TRANSACTION_LIST_FIELDS = (
+    "id", "transaction_type", "transaction_reference", "third_party_reference",
+    "customer_msisdn", "amount", "status", "message", "from_app", "created_at",
+)
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+EXPORT_CHUNK_SIZE = 2000
+
+
+def _serialize_transaction_row(row):
+    """Converte uma linha de .values() no formato JSON da listagem."""
+    row["created_at"] = row["created_at"].isoformat()
+    return row
+
 
 @require_GET
 @csrf_exempt
+@use_replica
 def transactions_list(request):
-    """Listar transações com filtros opcionais."""
+    """
+    Listar transações com filtros opcionais, paginadas por cursor.
+    GET /transactions/list?limit=100&cursor=...
+    
+    A resposta inclui "next_cursor" (null na última página). Com stream=1
+    todas as transações filtradas são enviadas numa resposta em streaming,
+    com memória constante independentemente do volume.
+    
+    As páginas continuam nas transações arquivadas (TransactionArchive)
+    quando a tabela quente se esgota.
+    """
     customer_msisdn = request.GET.get('customer_msisdn')
     transaction_type = request.GET.get('transaction_type')
     from_app = request.GET.get('from_app')
 
-    qs = Transaction.objects.all()
-
+    filters = {}
     if customer_msisdn:
-        qs = qs.filter(customer_msisdn=customer_msisdn)
+        filters['customer_msisdn'] = customer_msisdn
     if transaction_type:
-        qs = qs.filter(transaction_type=transaction_type)
+        filters['transaction_type'] = transaction_type
     if from_app:
-        qs = qs.filter(from_app=from_app)
+        filters['from_app'] = from_app
 
-    data = [
-        {
-            "id": t.id,
-            "transaction_type": t.transaction_type,
-            "transaction_reference": t.transaction_reference,
-            "third_party_reference": t.third_party_reference,
-            "customer_msisdn": t.customer_msisdn,
-            "amount": t.amount,
-            "status": t.status,
-            "message": t.message,
-            "from_app": t.from_app,
-            "created_at": t.created_at.isoformat(),
-        }
-        for t in qs.order_by("-created_at")
-    ]
-    return JsonResponse({"transactions": data}, safe=False)
+    try:
+        hot, cold = [
+            apply_keyset(model.objects.filter(**filters), request.GET.get('cursor')).values(*TRANSACTION_LIST_FIELDS)
+            for model in (Transaction, TransactionArchive)
+        ]
+    except InvalidCursor:
+        return JsonResponse({'error': 'Cursor inválido'}, status=400)
+
+    # Exportação completa em streaming
+    if request.GET.get('stream') in ('1', 'true'):
+        rows = heapq.merge(
+            iterate_keyset(hot, EXPORT_CHUNK_SIZE, descending=True),
+            iterate_keyset(cold, EXPORT_CHUNK_SIZE, descending=True),
+            key=row_key, reverse=True
+        )
+        return StreamingHttpResponse(
+            stream_json_rows(rows, "transactions", _serialize_transaction_row),
+            content_type='application/json'
+        )
+
+    try:
+        limit = min(max(int(request.GET.get('limit', LIST_DEFAULT_LIMIT)), 1), LIST_MAX_LIMIT)
+    except ValueError:
+        return JsonResponse({'error': 'limit inválido'}, status=400)
+
+    # Busca uma linha extra para saber se existe página seguinte
+    page = tiered_page(hot, cold, limit + 1)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1]["created_at"], page[-1]["id"])
+
+    data = [_serialize_transaction_row(row) for row in page]
+    return JsonResponse({"transactions": data, "next_cursor": next_cursor}, safe=False)
 
 
 @require_GET
 @csrf_exempt
-def transactions_daily_report(request):
-    """Relatório diário de transações."""
-    today = datetime.today().date()
-    qs = Transaction.objects.filter(created_at__date=today)
+@use_replica
+def transactions_export(request):
+    """
+    Exportação completa de transações (M-Pesa e eMola) em streaming.
+    GET /transactions/export?format=csv&gzip=1&date_from=2025-01-01&date_to=2025-03-31
+
+    Parâmetros: format (csv | ndjson), gzip, date_from/date_to (datas
+    inclusivas ou data/hora ISO), type, status, from_app, source
+    (all | mpesa | emola) e include_raw (inclui raw_response).
+    """
+    is_valid, result = validate_bearer_token(request)
+    if not is_valid:
+        return JsonResponse({'error': result}, status=401)
+
+    fmt = request.GET.get('format', 'csv')
+    compress = request.GET.get('gzip') in ('1', 'true')
+    try:
+        stream = export_stream(parse_filters(request.GET), fmt, compress)
+    except InvalidExport as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    content_type = 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(stream, content_type='application/gzip' if compress else content_type)
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(fmt, compress)}"'
+    response['X-Accel-Buffering'] = 'no'  # nginx: envia os blocos sem os acumular
+    return response
 
-    total_amount = qs.filter(status="success").aggregate(Sum("amount"))["amount__sum"] or 0
-    total_success = qs.filter(status="success").count()
-    total_errors = qs.filter(status="error").count()
+
+@require_GET
+@csrf_exempt
+@use_replica
+def transactions_daily_report(request):
+    """Relatório diário de transações (lido do rollup TransactionDailyStats)."""
+    today = timezone.localdate()
+    totals = TransactionDailyStats.objects.filter(date=today).aggregate(
+        total_amount=Sum("total_amount", filter=models.Q(status="success")),
+        total_success=Sum("count", filter=models.Q(status="success")),
+        total_errors=Sum("count", filter=models.Q(status="error"))
+    )
 
     return JsonResponse({
         "date": str(today),
-        "total_amount": float(total_amount),
-        "total_success": total_success,
-        "total_errors": total_errors
+        "total_amount": float(totals["total_amount"] or 0),
+        "total_success": totals["total_success"] or 0,
+        "total_errors": totals["total_errors"] or 0
     })
 
 
 @csrf_exempt
 @require_GET
+@use_replica
 def transactions_monthly_report(request):
-    """Relatório mensal de transações."""
-    today = datetime.today()
-    first_day = today.replace(day=1)
-
-    qs = Transaction.objects.filter(created_at__gte=first_day)
+    """Relatório mensal de transações (lido do rollup TransactionDailyStats)."""
+    first_day = timezone.localdate().replace(day=1)
 
     daily_stats = (
-        qs.values("created_at__date")
+        TransactionDailyStats.objects.filter(date__gte=first_day)
+        .values("date")
         .annotate(
-            total_amount=Sum("amount", filter=models.Q(status="success")),
-            total_success=Count("id", filter=models.Q(status="success")),
-            total_errors=Count("id", filter=models.Q(status="error"))
+            total_amount=Sum("total_amount", filter=models.Q(status="success")),
+            total_success=Sum("count", filter=models.Q(status="success")),
+            total_errors=Sum("count", filter=models.Q(status="error"))
         )
-        .order_by("created_at__date")
+        .order_by("date")
     )
 
-    return JsonResponse({"monthly_report": list(daily_stats)})
+    return JsonResponse({"monthly_report": [
+        {
+            "created_at__date": row["date"],
+            "total_amount": row["total_amount"],
+            "total_success": row["total_success"] or 0,
+            "total_errors": row["total_errors"] or 0,
+        }
+        for row in daily_stats
+    ]})